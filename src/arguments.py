@@ -35,8 +35,8 @@ def define_arguments(parser: argparse.ArgumentParser, with_bucket=True):
         default=default_output_dir(), type=str
     )
     parser.add_argument(
-        "--limit", help="Query limit for resources, defaults to 10000",
-        type=int, default=10000
+        "--limit", help="Query limit for resources, defaults to all resources",
+        type=int, default=None
     )
 
     parser.add_argument(
@@ -49,4 +49,10 @@ def define_arguments(parser: argparse.ArgumentParser, with_bucket=True):
         choices=Deployment._member_names_
     )
 
+    parser.add_argument(
+        "--trace_memory", help="Trace Python memory allocations to report their peak, slows down the run. "
+                               "Valid values: yes, no",
+        type=str, choices=["yes", "no"], default="no"
+    )
+
     return parser
@@ -0,0 +1,154 @@
+"""
+Flat index of the brain regions of a parcellation ontology (hierarchy json as provided
+with atlas releases, e.g. data/atlas/1.json), queryable by id, label, notation/acronym and synonyms.
+
+The index is built once from the ontology file and can be persisted to disk next to it,
+so that resolving brain region labels doesn't require any call to Nexus.
+"""
+import json
+import os
+from typing import Dict, List, Optional, Union
+
+from kgforge.core import Resource
+
+from src.helpers import get_path, get_file_digest
+from src.logger import logger
+
+DEFAULT_BRAIN_REGION_ONTOLOGY = get_path("./data/atlas/1.json")
+BRAIN_REGION_INDEX_FILENAME = "brain_region_index.json"
+REGION_ID_PREFIX = "http://api.brain-map.org/api/v2/data/Structure/"
+
+SYNONYM_KEYS = ["synonyms", "altLabel", "prefLabel"]
+
+
+def _hierarchy_roots(content: Union[Dict, List]) -> List[Dict]:
+    if isinstance(content, list):
+        return content
+    if "msg" in content:
+        return content["msg"]
+    return [content]
+
+
+class BrainRegionIndex:
+
+    def __init__(self, regions: List[Dict], source_digest: Optional[str] = None):
+        """
+        :param regions: a list of dictionaries with keys id (int), label, notation, parent (int or None) and synonyms
+        :param source_digest: the digest of the ontology file the regions come from
+        """
+        self.regions = regions
+        self.source_digest = source_digest
+
+        self._by_id: Dict[int, Dict] = {}
+        self._by_text: Dict[str, Dict] = {}
+        self._by_text_lower: Dict[str, Dict] = {}
+
+        for region in regions:
+            self._by_id[region["id"]] = region
+
+            for text in [region["label"], region["notation"], *region["synonyms"]]:
+                if not text:
+                    continue
+                # Regions come in a breadth first order, the first occurrence of a text wins
+                self._by_text.setdefault(text, region)
+                self._by_text_lower.setdefault(text.lower(), region)
+
+    @staticmethod
+    def from_hierarchy_file(ontology_path: str) -> 'BrainRegionIndex':
+        with open(ontology_path, "r") as f:
+            content = json.load(f)
+
+        regions = []
+        queue = [(node, None) for node in _hierarchy_roots(content)]
+        i = 0
+        while i < len(queue):
+            node, parent = queue[i]
+            i += 1
+            synonyms = []
+            for key in SYNONYM_KEYS:
+                value = node.get(key, None)
+                if value:
+                    synonyms.extend(value if isinstance(value, list) else [value])
+
+            regions.append({
+                "id": int(node["id"]),
+                "label": node.get("name", None),
+                "notation": node.get("acronym", None),
+                "parent": parent,
+                "synonyms": synonyms
+            })
+            queue.extend((child, int(node["id"])) for child in node.get("children", []))
+
+        logger.info(f"Indexed {len(regions)} brain regions from {ontology_path}")
+
+        return BrainRegionIndex(regions, source_digest=get_file_digest(ontology_path))
+
+    @staticmethod
+    def load(index_path: str) -> 'BrainRegionIndex':
+        with open(index_path, "r") as f:
+            content = json.load(f)
+        return BrainRegionIndex(content["regions"], source_digest=content["source_digest"])
+
+    def save(self, index_path: str):
+        with open(index_path, "w") as f:
+            json.dump({"source_digest": self.source_digest, "regions": self.regions}, f)
+
+    @staticmethod
+    def build_or_load(ontology_path: str = DEFAULT_BRAIN_REGION_ONTOLOGY, index_path: Optional[str] = None) -> 'BrainRegionIndex':
+        """
+        Loads the index persisted at index_path if it was built from the current content of ontology_path,
+        else builds it from ontology_path and persists it at index_path
+        """
+        if index_path is None:
+            index_path = os.path.join(os.path.dirname(ontology_path), BRAIN_REGION_INDEX_FILENAME)
+
+        if os.path.isfile(index_path):
+            index = BrainRegionIndex.load(index_path)
+            if index.source_digest == get_file_digest(ontology_path):
+                return index
+            logger.info(f"Brain region index {index_path} is out of date, rebuilding it")
+
+        index = BrainRegionIndex.from_hierarchy_file(ontology_path)
+        try:
+            index.save(index_path)
+        except OSError as e:
+            logger.warning(f"Could not persist brain region index at {index_path}: {e}")
+        return index
+
+    def get(self, region: Union[int, str]) -> Optional[Dict]:
+        """
+        Get a region by its integer id or its iri
+        """
+        if isinstance(region, str):
+            region = region.split("/")[-1]
+            if not region.isdigit():
+                return None
+        return self._by_id.get(int(region), None)
+
+    def find(self, text: str, case_sensitive: bool = True) -> Optional[Dict]:
+        """
+        Get a region by label, notation/acronym or synonym
+        """
+        if text is None:
+            return None
+        text = str(text).strip()
+        return self._by_text.get(text, None) if case_sensitive else self._by_text_lower.get(text.lower(), None)
+
+    def resolve(self, text: str, strategy: str = "EXACT_MATCH") -> Optional[Resource]:
+        """
+        Equivalent of forge.resolve(text, scope="ontology", target="BrainRegion", strategy=strategy),
+        for the exact match strategies
+        """
+        region = self.find(text, case_sensitive=strategy != "EXACT_CASE_INSENSITIVE_MATCH")
+        if region is None:
+            return None
+        return Resource(
+            id=f"{REGION_ID_PREFIX}{region['id']}", type="Class",
+            label=region["label"], notation=region["notation"]
+        )
+
+    def id_to_label(self) -> Dict[int, str]:
+        """
+        Returns the label of each region by integer id, e.g. to label the region ids of a parcellation volume
+        """
+        return dict((region["id"], region["label"]) for region in self.regions)
@@ -2,10 +2,12 @@ from datetime import datetime
 from typing import Optional, Dict
 from kgforge.core import Resource, KnowledgeGraphForge
 
+from src.resolve_cache import get_resolve_cache
+
 
 def create_brain_region(forge: KnowledgeGraphForge, region_label: str) -> Optional[Dict]:
     """Create BrainLocation field from a brain region label"""
-    region = forge.resolve(region_label, scope='ontology', target='BrainRegion', strategy='EXACT_CASE_INSENSITIVE_MATCH')
+    region = get_resolve_cache().resolve(forge, region_label, scope='ontology', target='BrainRegion', strategy='EXACT_CASE_INSENSITIVE_MATCH')
     if region:
         return {'id': region.id, 'label': region.label}
     else:
@@ -28,7 +30,7 @@ def create_bbp_person_contribution(given_name: str, last_name: str, user_name: s
 
 
 def create_existing_agent_contribution(forge: KnowledgeGraphForge, name: str) -> Optional[Dict]:
-    resolved_agent = forge.resolve(name, scope='agent', target="agents", strategy='EXACT_CASE_INSENSITIVE_MATCH')
+    resolved_agent = get_resolve_cache().resolve(forge, name, scope='agent', target="agents", strategy='EXACT_CASE_INSENSITIVE_MATCH')
     if resolved_agent:
         return {"type": "Contribution",
                 "agent": resolved_agent
@@ -83,14 +85,14 @@ def create_date(date, begin=True) -> Dict:
 
 def create_subject_dictionary(forge: KnowledgeGraphForge, subject_dict: Dict) -> Optional[Dict]:
     """The minimum requirement is the species label"""
-    species_info = forge.resolve(subject_dict['species'], scope="ontology", target="Species", strategy='EXACT_CASE_INSENSITIVE_MATCH')
+    species_info = get_resolve_cache().resolve(forge, subject_dict['species'], scope="ontology", target="Species", strategy='EXACT_CASE_INSENSITIVE_MATCH')
     if not species_info:
         raise ValueError(f"Species label provided {subject_dict['species']} was not found in our ontologies")
     else:
         species = {'id': species_info.id,
                    'label': species_info.label}
     if 'strain' in subject_dict and subject_dict['strain']:
-        strain = forge.resolve(subject_dict['strain'], scope="ontology", target="Species", strategy='EXACT_CASE_INSENSITIVE_MATCH')
+        strain = get_resolve_cache().resolve(forge, subject_dict['strain'], scope="ontology", target="Species", strategy='EXACT_CASE_INSENSITIVE_MATCH')
         if not strain:
             raise ValueError(f"Strain label provided {subject_dict['strain']} was not found in our ontologies")
     else:
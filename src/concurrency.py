@@ -0,0 +1,210 @@
+"""
+Adaptive concurrency limit for requests to Nexus, shared by the bulk operations of a process.
+
+The limit follows an AIMD (additive increase, multiplicative decrease) scheme: it grows by one after each round of
+successful requests whose latency stays close to the lowest latency recently observed for their kind of request,
+and is cut by a factor on connection errors, overload responses (429, 5xx) or when the latency rises. Latencies are
+tracked per kind of request (see src.instrumentation._url_kind), so that a download or a query taking seconds isn't
+compared with resource retrievals taking milliseconds. Throughput thus settles close to what the
+deployment can serve, without tuning a fixed pool size per deployment.
+
+The controller is fed by the request layer: a slot is held for a single HTTP exchange (an attempt of DeltaClient.request,
+a request of an aiohttp session), and its outcome is the status of the response. The request layer names the
+kind of the request it holds a slot for. Work around requests
+(parsing, conversion, retries' back-off) doesn't hold a slot, and a task failing for its own reasons doesn't back off.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.logger import logger
+
+OVERLOAD_STATUSES = {429, 500, 502, 503, 504}
+DEFAULT_KIND = "request"
+
+
+class RequestOutcome:
+    """
+    Outcome of the request sent within a slot, set by the caller once the response is received.
+    A request is failed if it raised out of its slot (connection error, timeout), if it was marked failed,
+    or if its response status signals overload
+    """
+
+    def __init__(self):
+        self.status: Optional[int] = None
+        self.failed = False
+
+    @property
+    def succeeded(self) -> bool:
+        return not self.failed and self.status not in OVERLOAD_STATUSES
+
+
+class AdaptiveConcurrency:
+
+    def __init__(
+            self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 64,
+            decrease_factor: float = 0.5, latency_tolerance: float = 2.0, smoothing: float = 0.2,
+            baseline_drift: float = 0.001
+    ):
+        """
+        :param decrease_factor: the factor the limit is multiplied by when backing off
+        :param latency_tolerance: how many times the reference latency of a kind of request its recent latency
+        can reach before backing off
+        :param smoothing: the weight of the last latency in the moving average of recent latencies of its kind
+        :param baseline_drift: how much the reference latency rises with each request, so that it follows
+        the latency of a workload that changed
+        """
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.baseline_drift = baseline_drift
+
+        self.in_flight = 0
+        # By kind of request
+        self.latency: Dict[str, float] = {}
+        self.baseline_latency: Dict[str, float] = {}
+        self.increases = 0
+        self.decreases = 0
+
+        self._successes_in_round = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def _try_acquire(self) -> bool:
+        with self._condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        while not self._try_acquire():
+            await asyncio.sleep(0.01)
+
+    def _decrease(self, reason: str, kind: str):
+        # Failures of requests sent before the last decrease don't decrease the limit again
+        if time.monotonic() - self._last_decrease < self.latency.get(kind, 0):
+            return
+        previous = self.limit
+        self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+        self._successes_in_round = 0
+        self._last_decrease = time.monotonic()
+        self.decreases += 1
+        if self.limit != previous:
+            logger.debug(f"Concurrency limit decreased from {previous} to {self.limit} ({reason})")
+
+    def release(self, latency: Optional[float], succeeded: bool, kind: str = DEFAULT_KIND):
+        """
+        :param latency: the duration of the request, in seconds
+        :param succeeded: whether the request succeeded, a failure backs off
+        :param kind: the kind of the request, its latency is only compared with latencies of the same kind
+        """
+        with self._condition:
+            self.in_flight -= 1
+
+            if not succeeded:
+                self._decrease("error or overload", kind)
+            elif latency is not None:
+                recent = latency if kind not in self.latency else \
+                    self.smoothing * latency + (1 - self.smoothing) * self.latency[kind]
+                # The reference is the lowest recent latency, slowly drifting up
+                baseline = recent if kind not in self.baseline_latency else \
+                    min(recent, self.baseline_latency[kind] * (1 + self.baseline_drift))
+                self.latency[kind], self.baseline_latency[kind] = recent, baseline
+
+                if recent > self.latency_tolerance * baseline:
+                    self._decrease(f"rising latency of {kind}", kind)
+                else:
+                    self._successes_in_round += 1
+                    if self._successes_in_round >= self.limit and self.limit < self.max_limit:
+                        self.limit += 1
+                        self._successes_in_round = 0
+                        self.increases += 1
+
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, kind: str = DEFAULT_KIND):
+        """
+        Waits until a request can be sent, and accounts for its latency and outcome.
+        Holds a single HTTP exchange: the RequestOutcome yielded is to be given the status of its response
+
+        :param kind: the kind of the request, as given by src.instrumentation._url_kind
+        """
+        self.acquire()
+        outcome = RequestOutcome()
+        start = time.monotonic()
+        try:
+            yield outcome
+        except BaseException:
+            outcome.failed = True
+            raise
+        finally:
+            self.release(time.monotonic() - start, outcome.succeeded, kind)
+
+    @asynccontextmanager
+    async def slot_async(self, kind: str = DEFAULT_KIND):
+        """
+        Same as slot, for a request of an aiohttp session
+        """
+        await self.acquire_async()
+        outcome = RequestOutcome()
+        start = time.monotonic()
+        try:
+            yield outcome
+        except BaseException:
+            outcome.failed = True
+            raise
+        finally:
+            self.release(time.monotonic() - start, outcome.succeeded, kind)
+
+    def starmap(self, fn: Callable, args_list: Iterable[Tuple]) -> List:
+        """
+        Same as multiprocessing.Pool().starmap for I/O-bound functions: calls run in as many threads as
+        the concurrency limit when starmap is called. The calls don't hold slots themselves: forge calls
+        (retrieve, update, tag...) don't go through DeltaClient, they are only bounded by the number of threads
+        """
+        args_list = list(args_list)
+        if len(args_list) == 0:
+            return []
+        with self._condition:
+            n_workers = min(self.limit, len(args_list))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(lambda args: fn(*args), args_list))
+
+    def metrics(self) -> Dict:
+        with self._condition:
+            return {
+                "concurrency_limit": self.limit,
+                "in_flight": self.in_flight,
+                "latency_ewma": dict(self.latency),
+                "baseline_latency": dict(self.baseline_latency),
+                "increases": self.increases,
+                "decreases": self.decreases
+            }
+
+
+_concurrency_controller: Optional[AdaptiveConcurrency] = None
+_concurrency_controller_lock = threading.Lock()
+
+
+def get_concurrency_controller() -> AdaptiveConcurrency:
+    """
+    Returns the concurrency controller shared by the bulk operations of this process
+    """
+    global _concurrency_controller
+    with _concurrency_controller_lock:
+        if _concurrency_controller is None:
+            _concurrency_controller = AdaptiveConcurrency()
+        return _concurrency_controller
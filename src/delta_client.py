@@ -0,0 +1,244 @@
+"""
+Shared HTTP client for Nexus Delta.
+
+A single requests Session per process keeps connections alive and pooled, so that consecutive requests to Delta
+don't each pay a TCP and TLS handshake. Requests failing with a 429 or a 5xx status, or with a connection error,
+are retried with an exponential backoff with jitter (or after the delay given by Retry-After). Requests that may
+modify data (POST, PUT, DELETE, other than queries) are only retried when they can't have been processed:
+on a 429 or a 503 status, or when the connection couldn't be established.
+Timeouts depend on the kind of endpoint: downloads and queries get longer ones than plain resource requests.
+
+If a token provider is set, bearer tokens about to expire are replaced by a fresh token before sending a request,
+and a request failing with a 401 is retried once with a fresh token.
+"""
+import base64
+import json
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from src.concurrency import get_concurrency_controller
+from src.instrumentation import get_request_stats, _accept, _url_kind
+from src.logger import logger
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Statuses of requests rejected before being processed, the only ones retried for requests that may modify data
+UNPROCESSED_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+# POST requests to these endpoints only read data, they are retried like GET requests
+QUERY_ENDPOINTS = ["/_search", "/_pit", "/sparql", "/search/query", "/trial/"]
+
+# (connect, read) timeouts in seconds, by url fragment, the first match applies
+ENDPOINT_TIMEOUTS = [
+    ("/files/", (10, 600)),
+    ("/_search", (10, 300)),
+    ("/sparql", (10, 300)),
+    ("/search/query", (10, 300)),
+    ("/trial/", (10, 300)),
+]
+DEFAULT_TIMEOUT = (10, 120)
+
+TOKEN_EXPIRY_MARGIN = 60
+
+
+def _token_claims(token: str) -> Dict:
+    """
+    Returns the claims of a JWT, from its (unverified) payload, none if it can't be decoded
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return claims if isinstance(claims, dict) else {}
+    except (IndexError, TypeError, ValueError):
+        return {}
+
+
+def _token_expiry(token: str) -> Optional[float]:
+    """
+    Returns the expiry timestamp of a JWT, from its (unverified) payload
+    """
+    try:
+        return float(_token_claims(token)["exp"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _token_subject(headers: Dict) -> Optional[str]:
+    """
+    Returns the user the bearer token of the Authorization header was issued to, from its (unverified) payload
+    """
+    authorization = next((v for k, v in headers.items() if k.lower() == "authorization"), "")
+    if not authorization.startswith("Bearer "):
+        return None
+    claims = _token_claims(authorization[len("Bearer "):])
+    return claims.get("preferred_username", None) or claims.get("sub", None)
+
+
+def _is_idempotent(method: str, url: str) -> bool:
+    return method.upper() in IDEMPOTENT_METHODS or \
+        (method.upper() == "POST" and any(fragment in url for fragment in QUERY_ENDPOINTS))
+
+
+def _is_connect_error(e: requests.RequestException) -> bool:
+    """
+    Whether the request failed before reaching the server, so that it wasn't sent
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.ConnectionError) or len(e.args) == 0:
+        return False
+    return isinstance(getattr(e.args[0], "reason", e.args[0]), NewConnectionError)
+
+
+class DeltaClient:
+
+    def __init__(self, max_retries: int = 5, backoff: float = 0.5, max_backoff: float = 60, pool_size: int = 32):
+        """
+        :param backoff: the base delay before the first retry, doubled at each following retry
+        :param pool_size: the number of connections kept alive per host
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.token_provider: Optional[Callable[[], str]] = None
+        self._token: Optional[str] = None
+        self._token_lock = threading.Lock()
+
+    def set_token_provider(self, token_provider: Callable[[], str], token: Optional[str] = None):
+        """
+        :param token_provider: a function returning a fresh token
+        :param token: the current token, if already obtained from the provider
+        """
+        self.token_provider = token_provider
+        self._token = token
+
+    def _fresh_token(self, expired_token: Optional[str] = None) -> str:
+        with self._token_lock:
+            expiry = _token_expiry(self._token) if self._token is not None else None
+            expiring = expiry is not None and expiry - time.time() < TOKEN_EXPIRY_MARGIN
+            if self._token is None or expiring or self._token == expired_token:
+                logger.info("Refreshing the token")
+                self._token = self.token_provider()
+            return self._token
+
+    def _authorize(self, headers: Dict, force_refresh: bool = False) -> Dict:
+        authorization = next((v for k, v in headers.items() if k.lower() == "authorization"), None)
+        if self.token_provider is None or authorization is None or not authorization.startswith("Bearer "):
+            return headers
+
+        token = authorization[len("Bearer "):]
+        expiry = _token_expiry(token)
+        if not force_refresh and (expiry is None or expiry - time.time() >= TOKEN_EXPIRY_MARGIN):
+            return headers
+
+        fresh = self._fresh_token(expired_token=token if force_refresh else None)
+        return {
+            **{k: v for k, v in headers.items() if k.lower() != "authorization"},
+            "Authorization": f"Bearer {fresh}"
+        }
+
+    @staticmethod
+    def _timeout(url: str) -> Tuple[float, float]:
+        return next((timeout for fragment, timeout in ENDPOINT_TIMEOUTS if fragment in url), DEFAULT_TIMEOUT)
+
+    def _retry_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        retry_after = response.headers.get("Retry-After", None) if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def request(self, method: str, url: str, headers: Optional[Dict] = None, **kwargs) -> requests.Response:
+        """
+        Same as requests.request, with retries. The response of the last attempt is returned, whatever its status
+        """
+        start = time.perf_counter()
+        response = None
+        try:
+            response = self._request(method, url, headers, **kwargs)
+            return response
+        finally:
+            get_request_stats().record_request(
+                method, url, headers, time.perf_counter() - start,
+                response.status_code if response is not None else None
+            )
+
+    def _request(self, method: str, url: str, headers: Optional[Dict] = None, **kwargs) -> requests.Response:
+        headers = self._authorize(headers or {})
+        kwargs.setdefault("timeout", self._timeout(url))
+        refreshed = False
+        attempt = 0
+        idempotent = _is_idempotent(method, url)
+        kind = _url_kind(method, url, _accept(headers))
+        retry_statuses = RETRY_STATUSES if idempotent else UNPROCESSED_STATUSES
+
+        while True:
+            try:
+                with get_concurrency_controller().slot(kind) as outcome:
+                    response = self.session.request(method, url, headers=headers, **kwargs)
+                    outcome.status = response.status_code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries or not (idempotent or _is_connect_error(e)):
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"{method} {url} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status_code == 401 and self.token_provider is not None and not refreshed:
+                headers = self._authorize(headers, force_refresh=True)
+                refreshed = True
+                continue
+
+            if response.status_code in retry_statuses and attempt < self.max_retries:
+                delay = self._retry_delay(attempt, response)
+                logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+
+_delta_client: Optional[DeltaClient] = None
+_delta_client_pid: Optional[int] = None
+
+
+def get_delta_client() -> DeltaClient:
+    """
+    Returns the Delta client of this process. A forked process gets its own, pooled connections can't be shared
+    """
+    global _delta_client, _delta_client_pid
+    if _delta_client is None or _delta_client_pid != os.getpid():
+        parent_client = _delta_client
+        _delta_client = DeltaClient()
+        _delta_client_pid = os.getpid()
+        if parent_client is not None and parent_client.token_provider is not None:
+            _delta_client.set_token_provider(parent_client.token_provider, parent_client._token)
+    return _delta_client
@@ -8,7 +8,7 @@ from kgforge.core import KnowledgeGraphForge, Resource
 
 from src.arguments import define_arguments
 from src.e_model.querying import get_e_models_and_categorisation
-from src.helpers import _as_list, allocate_by_deployment, authenticate_from_parser_arguments
+from src.helpers import _as_list, allocate_by_deployment, authenticate_from_parser_arguments, init_run
 from src.logger import logger
 import requests
 
@@ -206,6 +206,7 @@ if __name__ == "__main__":
     parser = define_arguments(argparse.ArgumentParser())
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     org, project = received_args.bucket.split("/")
@@ -4,6 +4,7 @@ from typing import Dict, Tuple
 from kgforge.core import KnowledgeGraphForge, Resource
 
 from src.helpers import allocate_by_deployment, Deployment
+from src.schemas.query_data import get_resources_by_ids_or_retrieve
 
 # See summary of all e-models: https://docs.google.com/spreadsheets/d/1d0C1FToTc30TMubteFUHMbEph8qNBph5YxruOaahfl0/edit?gid=0#gid=0
 
@@ -118,7 +119,7 @@ def curated_e_models(forge: KnowledgeGraphForge):
 def get_emodels_in_hippocampus(forge_emodels, get_rat: bool):
     res = "https://bbp.epfl.ch/data/bbp/mmb-point-neuron-framework-model/2f00630e-dd48-4acc-9909-d464858c929e"
     collection = forge_emodels.retrieve(res)
-    parts = [forge_emodels.retrieve(i.get_identifier()) for i in collection.hasPart]
+    parts = get_resources_by_ids_or_retrieve(forge_emodels, [i.get_identifier() for i in collection.hasPart])
     part_from_hippo = [
         i for i in parts
         if i.brainLocation.brainRegion.get_identifier() == FIELD_CA1_ID
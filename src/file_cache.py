@@ -0,0 +1,210 @@
+"""
+Content-addressed cache of downloaded files, shared across runs, pipelines and processes.
+
+Files are stored in CACHE_DIRECTORY under the digest of their content, as found in the digest of the distribution
+that points to them. A download is streamed to a temporary file while its digest is computed, and only moved into
+the cache if the digest matches. Cached files are read-only, and are copied into working directories, so that
+modifying or deleting a working copy leaves the cache untouched. A cached file whose size no longer matches the
+one recorded when it was cached is dropped and downloaded again.
+
+When the cache grows over its maximum size, the least recently used files are evicted.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from src.delta_client import get_delta_client
+from src.helpers import CACHE_DIRECTORY
+from src.logger import logger
+
+FILE_CACHE_DIRNAME = "files"
+FILE_CACHE_MAX_SIZE = 50 * 1024 ** 3
+FETCH_ATTEMPTS = 3
+
+# Nexus digest algorithm names to hashlib names
+DIGEST_ALGORITHMS = {"SHA-256": "sha256", "SHA-1": "sha1", "MD5": "md5", "SHA-512": "sha512"}
+
+
+class DigestMismatch(Exception):
+    ...
+
+
+class FileCache:
+
+    def __init__(self, directory: Optional[str] = None, max_size: int = FILE_CACHE_MAX_SIZE):
+        """
+        :param directory: where files and their index are stored, defaults to FILE_CACHE_DIRNAME in CACHE_DIRECTORY
+        :param max_size: the total size in bytes above which least recently used files are evicted
+        """
+        self.directory = directory if directory is not None else os.path.join(CACHE_DIRECTORY, FILE_CACHE_DIRNAME)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(self.directory, "index.sqlite"), check_same_thread=False, timeout=60
+        )
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "digest TEXT PRIMARY KEY, algorithm TEXT, size INTEGER, last_access REAL)"
+            )
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, digest: str) -> Optional[str]:
+        """
+        Returns the path of the cached file with this digest, if there is one and it still has its cached size.
+        A file without an index entry is being written by another writer, and is a miss
+        """
+        path = self._path(digest)
+        if not os.path.isfile(path):
+            return None
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT size FROM files WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                return None
+            try:
+                if os.path.getsize(path) != row[0]:
+                    logger.warning(f"File cache: dropping {digest}, its size doesn't match the cached size")
+                    self._connection.execute("DELETE FROM files WHERE digest = ?", (digest,))
+                    os.remove(path)
+                    return None
+            except FileNotFoundError:  # Evicted in the meantime
+                return None
+            self._connection.execute("UPDATE files SET last_access = ? WHERE digest = ?", (time.time(), digest))
+        return path
+
+    def put(self, digest: str, algorithm: str, chunks: Iterable[bytes]) -> str:
+        """
+        Writes the content into the cache, verifying its digest as it is written
+
+        :param algorithm: a Nexus digest algorithm name, e.g. SHA-256
+        :return: the path of the cached file
+        """
+        hasher = hashlib.new(DIGEST_ALGORITHMS.get(algorithm, algorithm.replace("-", "").lower()))
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            if hasher.hexdigest() != digest:
+                raise DigestMismatch(f"Expected {algorithm} digest {digest}, got {hasher.hexdigest()}")
+
+            os.chmod(tmp_path, 0o444)
+
+            # Indexed before being moved into place, so that a reader never finds the file without its entry
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO files (digest, algorithm, size, last_access) VALUES (?, ?, ?, ?)",
+                    (digest, algorithm, size, time.time())
+                )
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                with self._lock, self._connection:
+                    self._connection.execute("DELETE FROM files WHERE digest = ?", (digest,))
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict()
+        return path
+
+    def evict(self):
+        """
+        Deletes least recently used files until the total size is under the maximum size.
+        Files already copied into working directories stay available there
+        """
+        with self._lock:
+            total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+            if total <= self.max_size:
+                return
+            rows = self._connection.execute("SELECT digest, size FROM files ORDER BY last_access").fetchall()
+
+            evicted = []
+            for digest, size in rows:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(self._path(digest))
+                except FileNotFoundError:
+                    pass
+                evicted.append((digest,))
+                total -= size
+
+            with self._connection:
+                self._connection.executemany("DELETE FROM files WHERE digest = ?", evicted)
+
+        logger.info(f"File cache: evicted {len(evicted)} files")
+
+    @staticmethod
+    def materialize(cached_path: str, dst_path: str) -> str:
+        """
+        Makes a writable copy of the cached file available at dst_path. It isn't a link to the cached file,
+        as callers may modify it in place
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(dst_path)), exist_ok=True)
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        shutil.copyfile(cached_path, dst_path)
+        return dst_path
+
+    def fetch(self, url: str, digest: str, algorithm: str, dst_path: str, headers: Optional[Dict] = None) -> str:
+        """
+        Makes the file with this digest available at dst_path, downloading it from url only if it isn't cached
+        """
+        for _ in range(FETCH_ATTEMPTS):
+            cached_path = self.get(digest)
+            if cached_path is None:
+                response = get_delta_client().get(url, headers={**(headers or {}), "Accept": "*/*"}, stream=True)
+                response.raise_for_status()
+                cached_path = self.put(digest, algorithm, response.iter_content(chunk_size=1024 * 1024))
+            try:
+                return self.materialize(cached_path, dst_path)
+            except FileNotFoundError:  # Evicted in the meantime, by this or another process
+                continue
+
+        raise FileNotFoundError(f"File {digest} was evicted from the cache {FETCH_ATTEMPTS} times before being copied")
+
+
+def distribution_digest(distribution) -> Optional[tuple]:
+    """
+    Returns the (value, algorithm) digest of a distribution (Resource or dictionary), if it has one
+    """
+    digest = distribution.get("digest", None) if isinstance(distribution, dict) else \
+        getattr(distribution, "digest", None)
+    if digest is None:
+        return None
+    if isinstance(digest, dict):
+        value, algorithm = digest.get("value", None), digest.get("algorithm", "SHA-256")
+    else:
+        value, algorithm = getattr(digest, "value", None), getattr(digest, "algorithm", "SHA-256")
+    return (value, algorithm) if value else None
+
+
+_file_cache: Optional[FileCache] = None
+
+
+def get_file_cache() -> FileCache:
+    """
+    Returns the file cache of this process, located in CACHE_DIRECTORY
+    """
+    global _file_cache
+    if _file_cache is None:
+        _file_cache = FileCache()
+    return _file_cache
@@ -1,8 +1,7 @@
-from typing import Optional, List, Tuple, Dict, Union, Any
+from typing import Optional, List, Tuple, Dict, Union, Any, Iterator
 
 import os
 import asyncio
-import requests
 from urllib.parse import quote_plus
 
 from aiohttp import ClientSession
@@ -14,10 +13,45 @@ from kgforge.specializations.stores.nexus import Service
 from kgforge.specializations.stores.nexus.batch_request_handler import BatchRequestHandler
 from kgforge.core import Resource, KnowledgeGraphForge
 
+from src.concurrency import get_concurrency_controller
+from src.delta_client import get_delta_client
+from src.file_cache import get_file_cache
+from src.instrumentation import get_request_stats, _call_site, _url_kind
+from src.metrics import DOWNLOAD, get_run_metrics
+
+
+def _error_status(e: BaseException) -> Optional[int]:
+    """
+    Returns the HTTP status of the response an error was raised for,
+    from the aiohttp or requests error it was raised while handling
+    """
+    while e is not None:
+        status = getattr(e, "status", None) or getattr(getattr(e, "response", None), "status_code", None)
+        if isinstance(status, int):
+            return status
+        e = e.__cause__ or e.__context__
+    return None
+
+
+def _account_error(outcome, e: RetrievalError):
+    """
+    Gives the outcome of a request the status of the error it raised,
+    an error whose status can't be found counts as a failed request
+    """
+    outcome.status = _error_status(e)
+    outcome.failed = outcome.status is None
+
 
 def download_file(content_url: str, forge: KnowledgeGraphForge, path: Optional[str] = None) -> Union[str, bytes]:
+    with get_run_metrics().stage(DOWNLOAD):
+        return _download_file(content_url, forge, path)
+
+
+def _download_file(content_url: str, forge: KnowledgeGraphForge, path: Optional[str] = None) -> Union[str, bytes]:
 
-    response_1 = requests.get(
+    client = get_delta_client()
+
+    response_1 = client.get(
         url=content_url,
         headers={**forge._store.service.headers, "Accept": "application/json"}
     )
@@ -29,15 +63,22 @@ def download_file(content_url: str, forge: KnowledgeGraphForge, path: Optional[s
     if full_path and os.path.isfile(full_path):  # already exists don't download again - could be error-prone, pay attention to this
         return full_path
 
+    digest = metadata.get("_digest", {})
+    if full_path and digest.get("_value", None):
+        return get_file_cache().fetch(
+            content_url, digest["_value"], digest.get("_algorithm", "SHA-256"), full_path,
+            headers=forge._store.service.headers
+        )
+
     headers = {**forge._store.service.headers, "Accept": "*/*"}
 
-    response = requests.get(url=content_url, headers=headers)
+    response = client.get(url=content_url, headers=headers, stream=path is not None)
 
     if path is None:
         return response.content
 
     with open(full_path, "wb") as f:
-        for chunk in response.iter_content(chunk_size=4096):
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
             f.write(chunk)
 
     return full_path
@@ -46,6 +87,7 @@ def download_file(content_url: str, forge: KnowledgeGraphForge, path: Optional[s
 def _exists(provided_id: Union[str, List[str]], forge: KnowledgeGraphForge, is_file: bool) -> Union[Action, List[Action]]:
 
     store: BlueBrainNexus = forge._store
+    call_site = _call_site()
 
     def _exists_one(id_: str) -> Action:
 
@@ -58,23 +100,16 @@ def _exists(provided_id: Union[str, List[str]], forge: KnowledgeGraphForge, is_f
                 store.service.url_resources, schema_id=None, resource_id=id_
             )
 
-        response = requests.get(url=url, headers=store.service.headers)
+        # Transient failures are retried with backoff by the client
+        response = get_delta_client().get(url=url, headers=store.service.headers)
 
         try:
             catch_http_error_nexus(
                 response, RetrievalError, aiohttp_error=False
             )
             return Action(action_name, True, None)
-        except RetrievalError:
-            # Try again, sometimes fails for no reason
-            response_2 = requests.get(url=url, headers=store.service.headers)
-            try:
-                catch_http_error_nexus(
-                    response_2, RetrievalError, aiohttp_error=False
-                )
-                return Action(action_name, True, None)
-            except RetrievalError as e:
-                return Action(action_name, False, e)
+        except RetrievalError as e:
+            return Action(action_name, False, e)
 
     def _exists_many(ids: List[str]) -> List[Optional[Resource]]:
 
@@ -96,16 +131,18 @@ def _exists(provided_id: Union[str, List[str]], forge: KnowledgeGraphForge, is_f
                         store.service.url_resources, schema_id=None, resource_id=id_
                     )
 
-                async with semaphore:
+                async with semaphore, get_concurrency_controller().slot_async(_url_kind("GET", url)) as outcome:
 
-                    async with client_session.get(url=url, headers=store.service.headers) as response:
-                        try:
-                            catch_http_error_nexus(
-                                response, RetrievalError, aiohttp_error=True
-                            )
-                            return Action(action_name, True, None)
-                        except RetrievalError as e:
-                            return Action(action_name, False, e)
+                    with get_request_stats().timed_request("GET", url, call_site=call_site):
+                        async with client_session.get(url=url, headers=store.service.headers) as response:
+                            outcome.status = response.status
+                            try:
+                                catch_http_error_nexus(
+                                    response, RetrievalError, aiohttp_error=True
+                                )
+                                return Action(action_name, True, None)
+                            except RetrievalError as e:
+                                return Action(action_name, False, e)
 
             return BatchRequestHandler.create_tasks_and_sessions(loop, ids_, do_catch, callback=None)
 
@@ -117,6 +154,7 @@ def _exists(provided_id: Union[str, List[str]], forge: KnowledgeGraphForge, is_f
 def _retrieve_file_metadata(file_id: Union[str, List[str]], forge: KnowledgeGraphForge, is_content_url=False) -> Union[List[Union[Resource, Action]], Union[Resource, Action]]:
 
     store: BlueBrainNexus = forge._store
+    call_site = _call_site()
 
     def _retrieve_file_metadata_one(id_: str) -> Union[Resource, Action]:
 
@@ -125,7 +163,8 @@ def _retrieve_file_metadata(file_id: Union[str, List[str]], forge: KnowledgeGrap
         url = "/".join((store.service.url_files, quote_plus(id_))) if not is_content_url else id_
 
         try:
-            return store._get_resource_sync(url, {})
+            with get_request_stats().timed_request("GET", url, call_site=call_site):
+                return store._get_resource_sync(url, {})
         except RetrievalError as e:
             return Action(action_name, False, e)
 
@@ -158,12 +197,14 @@ def _retrieve_file_metadata(file_id: Union[str, List[str]], forge: KnowledgeGrap
 
                 url = "/".join((store.service.url_files, quote_plus(id_))) if not is_content_url else id_
 
-                async with semaphore:
+                async with semaphore, get_concurrency_controller().slot_async(_url_kind("GET", url)) as outcome:
                     try:
-                        return await store._get_resource_async(
-                            session=client_session, url=url, query_params={}
-                        )
+                        with get_request_stats().timed_request("GET", url, call_site=call_site):
+                            return await store._get_resource_async(
+                                session=client_session, url=url, query_params={}
+                            )
                     except RetrievalError as e:
+                        _account_error(outcome, e)
                         return Action(action_name, False, e)
 
             return BatchRequestHandler.create_tasks_and_sessions(
@@ -174,3 +215,111 @@ def _retrieve_file_metadata(file_id: Union[str, List[str]], forge: KnowledgeGrap
 
     return _retrieve_file_metadata_one(file_id) if isinstance(file_id, str) else\
         (_retrieve_file_metadata_many(file_id) if isinstance(file_id, list) else None)
+
+
+def _retrieve_many(ids: List[str], forge: KnowledgeGraphForge, cross_bucket: bool = True) -> List[Union[Resource, Action]]:
+    """
+    Retrieves resources concurrently, through the resolvers of the project if cross_bucket is True
+    """
+    store: BlueBrainNexus = forge._store
+    call_site = _call_site()
+
+    action_name = _retrieve_many.__name__
+
+    def _url(id_: str) -> str:
+        if cross_bucket:
+            return "/".join((store.service.url_resolver, "_", quote_plus(id_)))
+        return Service.add_schema_and_id_to_endpoint(store.service.url_resources, schema_id=None, resource_id=id_)
+
+    async def create_tasks(
+            semaphore: asyncio.Semaphore,
+            loop: asyncio.AbstractEventLoop,
+            ids_: List[str],
+            service,
+    ) -> Tuple[List[asyncio.Task], List[ClientSession]]:
+
+        def retrieve_done_callback(task: asyncio.Task):
+            result = task.result()
+
+            if isinstance(result, Resource):
+                store.service.synchronize_resource(
+                    resource=result,
+                    response=None,
+                    action_name=action_name,
+                    succeeded=True,
+                    synchronized=True,
+                )
+
+        async def do_catch(id_: str, client_session: ClientSession) -> Union[Resource, Action]:
+            async with semaphore, get_concurrency_controller().slot_async(_url_kind("GET", _url(id_))) as outcome:
+                try:
+                    with get_request_stats().timed_request("GET", _url(id_), call_site=call_site):
+                        return await store._get_resource_async(
+                            session=client_session, url=_url(id_), query_params={}
+                        )
+                except RetrievalError as e:
+                    _account_error(outcome, e)
+                    return Action(action_name, False, e)
+
+        return BatchRequestHandler.create_tasks_and_sessions(
+            loop, ids_, do_catch, retrieve_done_callback
+        )
+
+    return BatchRequestHandler.batch_request(task_creator=create_tasks, data=ids, service=store.service)
+
+
+def iter_sparql_keyset(
+        forge: KnowledgeGraphForge, select: str, where: str, id_var: str = "id",
+        page_size: int = 10000, limit: Optional[int] = None, debug: bool = False
+) -> Iterator[Resource]:
+    """
+    Streams the results of a SPARQL query page by page, with keyset pagination: each page is filtered on the ids
+    greater than the last id of the previous page, instead of skipping the results of the previous pages with an
+    OFFSET, which would require the server to produce them again.
+
+    :param select: the variables selected, besides ?<id_var>, e.g. "?name ?schema"
+    :param where: the body of the where clause, binding ?<id_var>
+    :param limit: the maximum number of rows to yield, all if None
+    """
+    last_id = None
+    count = 0
+    size = page_size if limit is None else min(page_size, limit)
+
+    while True:
+        # When the last page ended in the middle of the rows of an id, those rows are fetched again as a whole
+        keyset_filter = f'FILTER (STR(?{id_var}) >= "{last_id}")' if last_id is not None else ""
+
+        q = """
+            SELECT ?%s %s WHERE {
+                %s
+                %s
+            }
+            ORDER BY ASC(?%s)
+            LIMIT %s
+        """ % (id_var, select, where, keyset_filter, id_var, size)
+
+        rows = forge.sparql(q, debug=debug)
+        is_last_page = len(rows) < size
+
+        if is_last_page:
+            complete_rows = rows
+        else:
+            page_last_id = getattr(rows[-1], id_var)
+            complete_rows = [row for row in rows if getattr(row, id_var) != page_last_id]
+
+            if len(complete_rows) == 0:
+                if size >= page_size:
+                    raise ValueError(f"More than {size} rows for {page_last_id}, increase page_size")
+                size = page_size
+                continue
+
+            last_id = page_last_id
+
+        for row in complete_rows:
+            if limit is not None and count >= limit:
+                return
+            yield row
+            count += 1
+
+        if is_last_page or (limit is not None and count >= limit):
+            return
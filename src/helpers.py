@@ -2,10 +2,14 @@ import argparse
 import base64
 from enum import Enum
 import getpass
+import hashlib
 import os
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from typing import Union, Dict, Tuple
+from typing import Union, Dict, Tuple, Iterator, Optional, List
 
 from kgforge.core.commons import files
 from kgforge.specializations.stores import bluebrain_nexus
@@ -13,12 +17,17 @@ import numpy as np
 from kgforge.core import KnowledgeGraphForge, Resource
 
 
+from src.delta_client import get_delta_client
+from src.instrumentation import InstrumentedForge, get_request_stats
+from src.metrics import DOWNLOAD, get_run_metrics
 from src.logger import logger
 
 PROD_CONFIG_URL = "https://raw.githubusercontent.com/BlueBrain/nexus-forge/master/examples/notebooks/use-cases/prod-forge-nexus.yml"
 
 ASSETS_DIRECTORY = os.path.join(os.getcwd(), "./assets")
 
+CACHE_DIRECTORY = os.path.join(os.getcwd(), "./cache")
+
 ORG_OF_INTEREST = ["bbp", "bbp-external", "public"]
 
 DELTA_METADATA_KEYS = [
@@ -31,12 +40,14 @@ DEFAULT_ES_VIEW = "https://bluebrain.github.io/nexus/vocabulary/defaultElasticSe
 DEFAULT_SPARQL_VIEW = "https://bluebrain.github.io/nexus/vocabulary/defaultSparqlIndex"
 DATASET_ES_VIEW = "https://bbp.epfl.ch/neurosciencegraph/data/views/es/dataset"
 ES_SIZE_LIMIT = 2000
+ES_IDS_CHUNK_SIZE = 1000
 
 
 class Deployment(Enum):
     PRODUCTION = "https://bbp.epfl.ch/nexus/v1"
     STAGING = "https://staging.nise.bbp.epfl.ch/nexus/v1"
     AWS = "https://openbluebrain.com/api/nexus/v1"
+    LOCAL = "http://localhost:8080/v1"  # src.mock_delta.server
     # SANDBOX = "https://sandbox.bluebrainnexus.io/v1"
 
 
@@ -58,11 +69,11 @@ def _delta_get(relative_url: str, token: str, deployment: Deployment = Deploymen
     if debug:
         logger.info(f"Querying {url}")
 
-    return requests.get(url, headers=_make_header(token))
+    return get_delta_client().get(url, headers=_make_header(token))
 
 
 def _post_delta(body, token, url=SEARCH_QUERY_URL):
-    req = requests.post(
+    req = get_delta_client().post(
         url,
         headers=_make_header(token),
         data=json.dumps(body),
@@ -85,6 +96,79 @@ def run_trial_request(body, endpoint, bucket, token):
     return _post_delta(body, token, url)
 
 
+def _open_point_in_time(search_url: str, token: str, keep_alive: str) -> Optional[str]:
+    pit_url = f"{search_url[:-len('/_search')]}/_pit"
+    try:
+        response = get_delta_client().post(pit_url, params={"keep_alive": keep_alive}, headers=_make_header(token))
+        response.raise_for_status()
+        return response.json()["id"]
+    except (requests.RequestException, KeyError, ValueError) as e:
+        logger.info(f"Point in time not supported by {pit_url}, paginating without it: {e}")
+        return None
+
+
+def _close_point_in_time(search_url: str, token: str, pit_id: str):
+    pit_url = f"{search_url[:-len('/_search')]}/_pit"
+    try:
+        get_delta_client().delete(pit_url, json={"id": pit_id}, headers=_make_header(token))
+    except requests.RequestException as e:
+        logger.warning(f"Failed to close point in time of {pit_url}: {e}")
+
+
+def iter_es_hits(
+        url: str, token: str, es_query: Dict, page_size: int = ES_SIZE_LIMIT, limit: Optional[int] = None,
+        point_in_time: bool = False, keep_alive: str = "5m"
+) -> Iterator[Dict]:
+    """
+    Streams the hits of an Elastic Search query, page by page, with search_after.
+    Unlike from/size pagination, every page costs the same to the server, and the result window isn't capped.
+    Hits are sorted by the query's sort if it has one, with @id as tie-breaker, so that the order is stable.
+
+    :param url: the _search endpoint of a view, or the search query endpoint
+    :param limit: the maximum number of hits to yield, all if None
+    :param point_in_time: whether to search a point in time of the view, so that indexing happening while
+    paginating doesn't shift pages. Falls back to a plain search_after pagination if the view doesn't support it
+    """
+    query = {k: v for k, v in es_query.items() if k not in ["from", "size", "search_after"]}
+    sort = list(query.get("sort", []))
+    if not any("@id" in s for s in sort if isinstance(s, dict)):
+        sort.append({"@id": "asc"})
+    query["sort"] = sort
+
+    pit_id = _open_point_in_time(url, token, keep_alive) if point_in_time and url.endswith("/_search") else None
+
+    count = 0
+    try:
+        while limit is None or count < limit:
+            query["size"] = page_size if limit is None else min(page_size, limit - count)
+            if pit_id is not None:
+                query["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+
+            try:
+                response_json, _ = _post_delta(query, token, url)
+            except requests.HTTPError as e:
+                if pit_id is None or count > 0:
+                    raise
+                logger.info(f"Searching a point in time of {url} failed, paginating without it: {e}")
+                _close_point_in_time(url, token, pit_id)
+                pit_id = None
+                query.pop("pit")
+                continue
+
+            hits = response_json["hits"]["hits"]
+            pit_id = response_json.get("pit_id", pit_id)
+
+            yield from hits
+            count += len(hits)
+
+            if len(hits) < query["size"]:
+                break
+            query["search_after"] = hits[-1]["sort"]
+    finally:
+        if pit_id is not None:
+            _close_point_in_time(url, token, pit_id)
+
+
 def write_obj(filepath, obj):
     class NumpyTypeEncoder(json.JSONEncoder):
         def default(self, obj_):
@@ -99,6 +183,47 @@ def write_obj(filepath, obj):
         f.write(content)
 
 
+FORGE_CONFIG_FILENAME = "forge-config.yml"
+LOCAL_CONFIG_URL = f"{Deployment.LOCAL.value.rsplit('/v1', 1)[0]}/forge-config.yml"
+FORGE_CONFIG_MAX_AGE = 24 * 3600
+
+_forge_sessions: Dict[Tuple, KnowledgeGraphForge] = {}
+_forge_session_locks: Dict[Tuple, threading.Lock] = {}
+_forge_sessions_lock = threading.Lock()
+
+
+def get_forge_configuration(deployment: Optional[Deployment] = None) -> str:
+    """
+    Returns the path of a local copy of the forge configuration at PROD_CONFIG_URL, in CACHE_DIRECTORY.
+    The copy is downloaded again once older than FORGE_CONFIG_MAX_AGE seconds. If it can't be, the existing copy
+    is used, or the configuration url if there is none.
+    The local deployment serves its own configuration, which isn't copied
+    """
+    if deployment == Deployment.LOCAL:
+        return LOCAL_CONFIG_URL
+
+    path = os.path.join(CACHE_DIRECTORY, FORGE_CONFIG_FILENAME)
+
+    if os.path.isfile(path) and time.time() - os.path.getmtime(path) < FORGE_CONFIG_MAX_AGE:
+        return path
+
+    try:
+        response = get_delta_client().get(PROD_CONFIG_URL, timeout=30)
+        response.raise_for_status()
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(response.text)
+        os.replace(tmp_path, path)
+    except (requests.RequestException, OSError) as e:
+        if not os.path.isfile(path):
+            logger.warning(f"Could not cache the forge configuration, using {PROD_CONFIG_URL}: {e}")
+            return PROD_CONFIG_URL
+        logger.warning(f"Could not refresh the forge configuration, using the cached one: {e}")
+
+    return path
+
+
 def allocate_with_default_views(org: str, project: str, deployment: Deployment, token: str):
     return allocate_by_deployment(
         org=org, project=project, deployment=deployment, token=token,
@@ -106,9 +231,9 @@ def allocate_with_default_views(org: str, project: str, deployment: Deployment,
     )
 
 
-def allocate_by_deployment(
+def _allocate(
         org: str, project: str, deployment: Deployment, token: str, es_view=None, sparql_view=None
-):
+) -> KnowledgeGraphForge:
 
     bucket = f"{org}/{project}"
 
@@ -116,7 +241,7 @@ def allocate_by_deployment(
     bluebrain_nexus.REQUEST_TIMEOUT = 300
 
     args = dict(
-        configuration=PROD_CONFIG_URL,
+        configuration=get_forge_configuration(deployment),
         endpoint=deployment.value,
         token=token,
         bucket=bucket,
@@ -135,7 +260,53 @@ def allocate_by_deployment(
         args["searchendpoints"] = search_endpoints
 
     logger.info(f"Allocating forge session tied to bucket {bucket}")
-    return KnowledgeGraphForge(**args)
+    return InstrumentedForge(**args)
+
+
+def allocate_by_deployment(
+        org: str, project: str, deployment: Deployment, token: str, es_view=None, sparql_view=None, cached=True
+) -> KnowledgeGraphForge:
+    """
+    Returns a forge session tied to a bucket. Sessions are kept for the lifetime of the process: allocating
+    again with the same bucket, deployment, views and token returns the same session, with its model context
+    already loaded. Use cached=False to get a new session
+    """
+    if not cached:
+        return _allocate(org, project, deployment, token, es_view, sparql_view)
+
+    key = (org, project, deployment, es_view, sparql_view, token)
+
+    with _forge_sessions_lock:
+        if key in _forge_sessions:
+            return _forge_sessions[key]
+        key_lock = _forge_session_locks.setdefault(key, threading.Lock())
+
+    with key_lock:  # Sessions of different buckets can be allocated concurrently, each one only once
+        if key not in _forge_sessions:
+            forge = _allocate(org, project, deployment, token, es_view, sparql_view)
+            with _forge_sessions_lock:
+                _forge_sessions[key] = forge
+
+    return _forge_sessions[key]
+
+
+def warm_up_forge_sessions(
+        buckets: List[Tuple[str, str]], deployment: Deployment, token: str,
+        es_view=None, sparql_view=None, n_workers: int = 8
+):
+    """
+    Allocates the forge sessions of several buckets in parallel, so that the following calls to
+    allocate_by_deployment for these buckets return immediately
+    """
+    def allocate(org_project):
+        org, project = org_project
+        try:
+            allocate_by_deployment(org, project, deployment, token, es_view=es_view, sparql_view=sparql_view)
+        except Exception as e:
+            logger.warning(f"Could not allocate a forge session tied to {org}/{project}: {e}")
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(allocate, buckets))
 
 
 def open_file(filename):
@@ -170,6 +341,14 @@ def get_path(path):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", path)
 
 
+def get_file_digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
 class CustomEx(Exception):
     ...
 
@@ -219,24 +398,62 @@ def _download_from(  # TODO better name and doc
     if os.path.isfile(filepath):  # If already present, no need to download
         return filepath
 
-    forge.download(d, path=download_dir, follow="contentUrl")
-    if rename:
-        os.rename(os.path.join(download_dir, orig_filename), os.path.join(download_dir, filename))
-    return os.path.join(download_dir, filename)
+    from src.file_cache import get_file_cache, distribution_digest  # src.file_cache depends on this module
+
+    with get_run_metrics().stage(DOWNLOAD):
+        digest = distribution_digest(d)
+        if digest is not None:
+            value, algorithm = digest
+            return get_file_cache().fetch(d.contentUrl, value, algorithm, filepath, headers=forge._store.service.headers)
+
+        forge.download(d, path=download_dir, follow="contentUrl")
+        if rename:
+            os.rename(os.path.join(download_dir, orig_filename), os.path.join(download_dir, filename))
+        return os.path.join(download_dir, filename)
 
 
 def _format_boolean(bool_value: bool, sparse: bool):
     return str(bool_value) if not sparse else ("" if bool_value else str(bool_value))
 
 
+_run_initialized = False
+
+
+def init_run(received_args):
+    """
+    Sets up the reports of a run from the arguments of its script: request statistics and run metrics written at exit,
+    and memory tracing if requested. To be called once, from the __main__ of the script, further calls are ignored
+    """
+    global _run_initialized
+    if _run_initialized:
+        return
+    _run_initialized = True
+
+    output_dir = getattr(received_args, "output_dir", None)
+    get_request_stats().report_at_exit(output_dir)
+    if getattr(received_args, "trace_memory", "no") == "yes":
+        get_run_metrics().start_memory_tracing()
+    get_run_metrics().report_at_exit(output_dir)
+
+
 def authenticate_from_parser_arguments(received_args) -> Tuple[Deployment, str]:
+    """
+    Authenticates with the credentials of the arguments. Requests going through the Delta client then use a token
+    refreshed with these credentials before it expires, each call replaces the credentials they are refreshed with
+    """
     deployment = Deployment[received_args.deployment]
-    auth_token = authenticate(
-        username=received_args.username,
-        password=received_args.password,
-        deployment=deployment,
-        is_service_account=received_args.is_service_account == "yes"
-    )
+
+    def token_provider():
+        return authenticate(
+            username=received_args.username,
+            password=received_args.password,
+            deployment=deployment,
+            is_service_account=received_args.is_service_account == "yes"
+        )
+
+    auth_token = token_provider()
+    # Requests going through the Delta client get the token refreshed before it expires
+    get_delta_client().set_token_provider(token_provider, auth_token)
     return deployment, auth_token
 
 
@@ -247,6 +464,9 @@ def authenticate(username, password, is_service_account: bool, deployment: Deplo
     realm, server_url = ("SBO", "https://openbluebrain.com/auth") \
         if is_aws else ("BBP", "https://bbpauth.epfl.ch/auth")
 
+    if deployment == Deployment.LOCAL:
+        realm, server_url = "BBP", f"{Deployment.LOCAL.value.rsplit('/v1', 1)[0]}/auth"
+
     res = _auth(
         username, password,
         realm=realm,
@@ -278,7 +498,7 @@ def _auth(username, password, realm, server_url, is_service=True) -> requests.Re
         'scope': "openid"
     }
 
-    return requests.post(
+    return get_delta_client().post(
         url=url,
         headers={
             'Content-Type': "application/x-www-form-urlencoded",
@@ -294,13 +514,24 @@ def get_ext_path(resource: Resource, ext_download_folder: str,
     if i_res is not None and n_resources is not None:
         logger.info(f"Getting {ext} file for Resource {i_res +1} of {n_resources}")
     distributions = resource.distribution if isinstance(resource.distribution, list) else [resource.distribution]
-    distribution_name = next(d.name for d in distributions if d.encodingFormat.split('/')[-1] == ext)
+    distribution = next(d for d in distributions if d.encodingFormat.split('/')[-1] == ext)
 
-    file_path = os.path.join(ext_download_folder, distribution_name)
+    file_path = os.path.join(ext_download_folder, distribution.name)
 
     if not os.path.isfile(file_path):  # If already present, no need to download
         logger.info(f"Downloading {ext} file for resource {resource.get_identifier()}")
-        forge.download(resource, follow='distribution.contentUrl', content_type=f'application/{ext}', path=ext_download_folder)
+
+        from src.file_cache import get_file_cache, distribution_digest  # src.file_cache depends on this module
+
+        with get_run_metrics().stage(DOWNLOAD):
+            digest = distribution_digest(distribution)
+            if digest is not None:
+                value, algorithm = digest
+                get_file_cache().fetch(
+                    distribution.contentUrl, value, algorithm, file_path, headers=forge._store.service.headers
+                )
+            else:
+                forge.download(resource, follow='distribution.contentUrl', content_type=f'application/{ext}', path=ext_download_folder)
 
     return file_path
 
@@ -0,0 +1,232 @@
+"""
+Counts and times the requests of a run, per kind of call (retrieve, search, sparql, download, update...),
+endpoint and call site, to make N+1 access patterns visible: a search issued once per item of a loop
+shows up as one call site with as many calls as there are items.
+
+Requests going through the Delta client are recorded, as well as calls to the methods of forge sessions allocated
+by src.helpers, which are InstrumentedForge sessions. At the end of the run, a summary table is logged and the statistics are written as JSON.
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from kgforge.core import KnowledgeGraphForge
+
+from src.concurrency import get_concurrency_controller
+from src.logger import logger
+from src.metrics import FORGE_METHOD_STAGES, get_run_metrics
+
+REQUEST_STATS_FILENAME = "request_stats.json"
+
+SRC_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that issue requests on behalf of their callers, the call site is looked for above them
+PLUMBING_MODULES = {
+    os.path.join(SRC_DIRECTORY, f"{name}.py") for name in [
+        "instrumentation", "delta_client", "helpers", "forge_extension", "concurrency",
+        "file_cache", "metadata_cache", "resolve_cache", os.path.join("schemas", "trial_client")
+    ]
+}
+
+FORGE_METHODS = [
+    "retrieve", "search", "sparql", "elastic", "download", "register", "update", "deprecate", "tag", "validate",
+    "resolve"
+]
+
+# (url fragment, kind) for requests to Delta, the first match applies
+URL_KINDS = [
+    ("/_pit", "pit"),
+    ("/_search", "search"),
+    ("/sparql", "sparql"),
+    ("/search/query", "search"),
+    ("/trial/", "validate"),
+    ("/openid-connect/token", "token"),
+]
+
+
+def _call_site() -> str:
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(SRC_DIRECTORY) and filename not in PLUMBING_MODULES:
+            return f"{os.path.relpath(filename, os.path.dirname(SRC_DIRECTORY))}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+
+def _accept(headers: Optional[Dict]) -> Optional[str]:
+    return next((v for k, v in (headers or {}).items() if k.lower() == "accept"), None)
+
+
+def _url_kind(method: str, url: str, accept: Optional[str] = None) -> str:
+    kind = next((kind for fragment, kind in URL_KINDS if fragment in url), None)
+    if kind is not None:
+        return kind
+    if method == "GET":
+        return "download" if "/files/" in url and accept != "application/json" else "retrieve"
+    return {"POST": "register", "PUT": "update", "DELETE": "deprecate"}.get(method, method.lower())
+
+
+def _url_endpoint(url: str) -> str:
+    """
+    The url without its host and the identifiers of the resources, e.g. resources/bbp/atlas or views/bbp/atlas/_search
+    """
+    path = urlparse(url).path.split("/v1/", 1)[-1].strip("/").split("/")
+    endpoint = "/".join(path[:3])
+    suffix = next((s for s in ["_search", "sparql", "_pit", "query"] if s in path[3:]), None)
+    return f"{endpoint}/{suffix}" if suffix else endpoint
+
+
+class RequestStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats: Dict[Tuple[str, str, str], Dict] = {}
+        self.started_at = time.time()
+
+    def record(self, kind: str, endpoint: str, duration: float, succeeded: bool, call_site: Optional[str] = None):
+        key = (kind, endpoint, call_site or _call_site())
+        with self._lock:
+            entry = self.stats.setdefault(key, {"count": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0})
+            entry["count"] += 1
+            entry["errors"] += 0 if succeeded else 1
+            entry["total_time"] += duration
+            entry["max_time"] = max(entry["max_time"], duration)
+
+    @contextmanager
+    def timed(self, kind: str, endpoint: str, call_site: Optional[str] = None):
+        """
+        Records the duration of the block as a call. A block that raises is recorded as an error
+
+        :param call_site: where the call comes from, found from the stack if not provided. To be provided
+        for calls made by tasks of an event loop, whose stack doesn't go up to the caller
+        """
+        call_site = call_site or _call_site()
+        start = time.perf_counter()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            self.record(kind, endpoint, time.perf_counter() - start, succeeded, call_site)
+
+    def record_request(self, method: str, url: str, headers: Optional[Dict], duration: float, status: Optional[int]):
+        self.record(
+            _url_kind(method, url, _accept(headers)), _url_endpoint(url), duration,
+            status is not None and status < 400
+        )
+
+    def timed_request(
+            self, method: str, url: str, headers: Optional[Dict] = None, call_site: Optional[str] = None
+    ):
+        """
+        Same as timed, for a request to Delta sent without the Delta client
+        """
+        return self.timed(_url_kind(method, url, _accept(headers)), _url_endpoint(url), call_site or _call_site())
+
+    def as_json(self) -> Dict:
+        with self._lock:
+            rows = [
+                {
+                    "kind": kind, "endpoint": endpoint, "call_site": call_site, **entry,
+                    "mean_time": entry["total_time"] / entry["count"]
+                }
+                for (kind, endpoint, call_site), entry in self.stats.items()
+            ]
+        rows.sort(key=lambda row: row["total_time"], reverse=True)
+        return {
+            "duration": time.time() - self.started_at,
+            "requests": sum(row["count"] for row in rows),
+            "calls": rows,
+            "concurrency": get_concurrency_controller().metrics()
+        }
+
+    def summary(self) -> str:
+        rows = self.as_json()["calls"]
+        lines = [f"{'kind':<10} {'count':>7} {'errors':>6} {'total s':>9} {'mean ms':>9} {'max ms':>9}  endpoint  call site"]
+        lines.extend(
+            f"{row['kind']:<10} {row['count']:>7} {row['errors']:>6} {row['total_time']:>9.2f} "
+            f"{row['mean_time'] * 1000:>9.1f} {row['max_time'] * 1000:>9.1f}  {row['endpoint']}  {row['call_site']}"
+            for row in rows
+        )
+        return "\n".join(lines)
+
+    def write(self, output_dir: str) -> str:
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, REQUEST_STATS_FILENAME)
+        with open(path, "w") as f:
+            json.dump(self.as_json(), f, indent=4)
+        return path
+
+    def report_at_exit(self, output_dir: Optional[str]):
+        """
+        Logs the summary table at the end of the run, and writes the statistics in output_dir if provided
+        """
+        def report():
+            if len(self.stats) == 0:
+                return
+            logger.info(f"Requests issued during the run:\n{self.summary()}")
+            if output_dir is not None:
+                logger.info(f"Request statistics written at {self.write(output_dir)}")
+
+        atexit.register(report)
+
+
+_request_stats: Optional[RequestStats] = None
+_request_stats_lock = threading.Lock()
+
+
+def get_request_stats() -> RequestStats:
+    """
+    Returns the request statistics of this process
+    """
+    global _request_stats
+    with _request_stats_lock:
+        if _request_stats is None:
+            _request_stats = RequestStats()
+        return _request_stats
+
+
+def _plain_forge(state: Dict) -> KnowledgeGraphForge:
+    forge = KnowledgeGraphForge.__new__(KnowledgeGraphForge)
+    forge.__dict__.update(state)
+    return forge
+
+
+def _instrumented(name: str):
+    method = getattr(KnowledgeGraphForge, name)
+    stage = FORGE_METHOD_STAGES.get(name, None)
+
+    @wraps(method)
+    def instrumented_method(self, *args, **kwargs):
+        with get_request_stats().timed(name, f"forge/{self._store.bucket}"):
+            if stage is None:
+                return method(self, *args, **kwargs)
+            with get_run_metrics().stage(stage):
+                return method(self, *args, **kwargs)
+
+    return instrumented_method
+
+
+class InstrumentedForge(KnowledgeGraphForge):
+    """
+    A forge session whose calls issuing requests are timed, and counted in the stage of the run they belong to
+    (see src.metrics). The timing lives in the class, not in the session:
+    a session sent to another process (e.g. to a multiprocessing pool) arrives as a plain KnowledgeGraphForge,
+    the statistics being those of the process that allocated it
+    """
+
+    def __reduce__(self):
+        return _plain_forge, (self.__dict__,)
+
+
+for _name in FORGE_METHODS:
+    if hasattr(KnowledgeGraphForge, _name):
+        setattr(InstrumentedForge, _name, _instrumented(_name))
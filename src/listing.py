@@ -0,0 +1,123 @@
+"""
+Lightweight listing of dataset resources (morphologies, traces...).
+
+Only the fields that bulk jobs need to select and locate data are fetched, through a SPARQL projection:
+id, revision, name, distribution, brain region, coordinates in the brain atlas and species. Results are paged with
+keyset pagination and returned as plain dictionaries shaped like the json of the resources, forge.from_json turns one
+into a Resource if needed.
+"""
+from itertools import groupby
+from typing import Dict, Iterator, List, Optional
+
+from kgforge.core import KnowledgeGraphForge
+
+from src.forge_extension import iter_sparql_keyset
+
+RECORD_SELECT = """
+    ?_rev ?name ?brainRegion ?brainRegionLabel ?species ?speciesLabel
+    ?contentUrl ?encodingFormat ?distributionName ?digest ?valueX ?valueY ?valueZ
+"""
+
+RECORD_WHERE = """
+    ?id a %s ;
+        _deprecated false ;
+        _rev ?_rev .
+    OPTIONAL { ?id name ?name }
+    OPTIONAL {
+        ?id brainLocation/brainRegion ?brainRegion .
+        OPTIONAL { ?brainRegion label ?brainRegionLabel }
+    }
+    OPTIONAL {
+        ?id brainLocation/coordinatesInBrainAtlas ?coordinates .
+        ?coordinates valueX ?valueX ;
+            valueY ?valueY ;
+            valueZ ?valueZ .
+    }
+    OPTIONAL {
+        ?id subject/species ?species .
+        OPTIONAL { ?species label ?speciesLabel }
+    }
+    OPTIONAL {
+        ?id distribution ?d .
+        ?d contentUrl ?contentUrl .
+        OPTIONAL { ?d encodingFormat ?encodingFormat }
+        OPTIONAL { ?d name ?distributionName }
+        OPTIONAL { ?d digest/value ?digest }
+    }
+    %s
+"""
+
+
+def _term(id_, label) -> Dict:
+    return {"id": id_, "label": label} if label is not None else {"id": id_}
+
+
+def _one_or_many(values: List):
+    return values[0] if len(values) == 1 else values
+
+
+def _rows_to_record(id_: str, type_: str, rows: List) -> Dict:
+    """
+    Merges the rows of a resource (one per combination of its multi-valued fields) into a single record
+    """
+    record = {"id": id_, "type": type_, "_rev": int(rows[0]._rev)}
+    names = list(dict.fromkeys(row.name for row in rows if getattr(row, "name", None) is not None))
+    regions, species, distributions = {}, {}, {}
+    coordinates = next(
+        (
+            dict((f"value{axis}", float(getattr(row, f"value{axis}"))) for axis in "XYZ")
+            for row in rows if getattr(row, "valueX", None) is not None
+        ),
+        None
+    )
+
+    for row in rows:
+        if getattr(row, "brainRegion", None) is not None:
+            regions[row.brainRegion] = _term(row.brainRegion, getattr(row, "brainRegionLabel", None))
+        if getattr(row, "species", None) is not None:
+            species[row.species] = _term(row.species, getattr(row, "speciesLabel", None))
+        if getattr(row, "contentUrl", None) is not None and row.contentUrl not in distributions:
+            distribution = {"type": "DataDownload", "contentUrl": row.contentUrl}
+            for key, attribute in [("encodingFormat", "encodingFormat"), ("name", "distributionName")]:
+                if getattr(row, attribute, None) is not None:
+                    distribution[key] = getattr(row, attribute)
+            if getattr(row, "digest", None) is not None:
+                distribution["digest"] = {"value": row.digest}
+            distributions[row.contentUrl] = distribution
+
+    if names:
+        record["name"] = _one_or_many(names)
+    if distributions:
+        record["distribution"] = _one_or_many(list(distributions.values()))
+    if regions or coordinates:
+        record["brainLocation"] = {"type": "BrainLocation"}
+    if regions:
+        record["brainLocation"]["brainRegion"] = _one_or_many(list(regions.values()))
+    if coordinates:
+        record["brainLocation"]["coordinatesInBrainAtlas"] = coordinates
+    if species:
+        record["subject"] = {"type": "Subject", "species": _one_or_many(list(species.values()))}
+
+    return record
+
+
+def iter_records(
+        forge: KnowledgeGraphForge, type_: str, extra_q: Optional[str] = None,
+        limit: Optional[int] = None, page_size: int = 10000, debug: bool = False
+) -> Iterator[Dict]:
+    """
+    Streams the records of the non-deprecated resources of a type in the project of forge
+
+    :param type_: the type, as a term of the forge context or a full iri between <>
+    :param extra_q: additional graph patterns / filters on ?id
+    :param limit: the maximum number of records, all if None
+    """
+    rows = iter_sparql_keyset(
+        forge, select=RECORD_SELECT, where=RECORD_WHERE % (type_, extra_q or ""),
+        page_size=page_size, debug=debug
+    )
+
+    for count, (id_, id_rows) in enumerate(groupby(rows, key=lambda row: row.id)):
+        if limit is not None and count >= limit:
+            return
+        yield _rows_to_record(id_, type_.strip("<>"), list(id_rows))
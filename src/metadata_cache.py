@@ -0,0 +1,167 @@
+"""
+Disk-backed cache of small metadata resources (agents, organizations, ontology terms, schemas, stimulus types...),
+shared across runs and processes.
+
+Entries are keyed by url, which holds the deployment, and by the user the token they were retrieved with was issued
+to (preferred_username or sub), as users can't all read the same resources. Payloads are stored with the ETag and the
+_rev they were retrieved with. An entry validated less than METADATA_MAX_AGE seconds ago is used as is. An older entry is revalidated with a conditional request
+(If-None-Match), which the server answers with an empty 304 if the resource hasn't changed. If the server doesn't
+provide an ETag, the resource is retrieved again and the entry is replaced if its _rev changed.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib.parse import quote_plus
+
+from kgforge.core import KnowledgeGraphForge, Resource
+from kgforge.specializations.stores.bluebrain_nexus import BlueBrainNexus
+from kgforge.specializations.stores.nexus import Service
+
+from src.concurrency import get_concurrency_controller
+from src.delta_client import get_delta_client, _token_subject
+from src.helpers import CACHE_DIRECTORY
+from src.logger import logger
+
+METADATA_CACHE_FILENAME = "metadata_cache.sqlite"
+METADATA_MAX_AGE = 3600
+
+
+class MetadataCache:
+
+    def __init__(self, path: Optional[str] = None, max_age: float = METADATA_MAX_AGE):
+        """
+        :param max_age: how long, in seconds, an entry is used without being revalidated
+        """
+        if path is None:
+            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+            path = os.path.join(CACHE_DIRECTORY, METADATA_CACHE_FILENAME)
+
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            columns = [c[1] for c in self._connection.execute("PRAGMA table_info(metadata)").fetchall()]
+            if len(columns) > 0 and "subject" not in columns:
+                logger.info(f"Metadata cache {path} doesn't key entries by user, dropping its entries")
+                self._connection.execute("DROP TABLE metadata")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "url TEXT, subject TEXT, etag TEXT, rev INTEGER, payload TEXT, validated_at REAL, "
+                "PRIMARY KEY (url, subject))"
+            )
+
+    def _get(self, url: str, subject: str) -> Optional[tuple]:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT etag, rev, payload, validated_at FROM metadata WHERE url = ? AND subject = ?", (url, subject)
+            ).fetchone()
+
+    def _put(self, url: str, subject: str, etag: Optional[str], payload: Dict):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO metadata (url, subject, etag, rev, payload, validated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, subject, etag, payload.get("_rev", None), json.dumps(payload), time.time())
+            )
+
+    def _touch(self, url: str, subject: str):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE metadata SET validated_at = ? WHERE url = ? AND subject = ?", (time.time(), url, subject)
+            )
+
+    def invalidate(self, url: Optional[str] = None):
+        """
+        Drops the entries of a url, for all users, or all entries if no url is provided
+        """
+        with self._lock, self._connection:
+            if url is None:
+                self._connection.execute("DELETE FROM metadata")
+            else:
+                self._connection.execute("DELETE FROM metadata WHERE url = ?", (url,))
+
+    def get_json(self, url: str, headers: Dict) -> Optional[Dict]:
+        """
+        Returns the payload at url, from the cache if it is fresh or still valid.
+        Returns None if the resource can't be retrieved
+
+        :param headers: the headers of the request, entries are only shared by requests whose token was issued
+        to the same user
+        """
+        subject = _token_subject(headers) or ""
+        row = self._get(url, subject)
+        headers = {**headers, "Accept": "application/ld+json"}
+
+        if row is not None:
+            etag, rev, payload, validated_at = row
+            if time.time() - validated_at < self.max_age:
+                return json.loads(payload)
+            if etag is not None:
+                headers["If-None-Match"] = etag
+
+        response = get_delta_client().get(url, headers=headers)
+
+        if response.status_code == 304:
+            self._touch(url, subject)
+            return json.loads(row[2])
+
+        if response.status_code != 200:
+            logger.warning(f"Metadata cache: couldn't retrieve {url}, status {response.status_code}")
+            return None
+
+        fetched = response.json()
+        if row is not None and row[1] is not None and row[1] == fetched.get("_rev", None):
+            self._touch(url, subject)
+        else:
+            self._put(url, subject, response.headers.get("ETag", None), fetched)
+        return fetched
+
+    def retrieve(self, id_: str, forge: KnowledgeGraphForge, cross_bucket: bool = True) -> Optional[Resource]:
+        """
+        Same as forge.retrieve, through the cache
+        """
+        store: BlueBrainNexus = forge._store
+
+        if cross_bucket:
+            url = "/".join((store.service.url_resolver, "_", quote_plus(id_)))
+        else:
+            url = Service.add_schema_and_id_to_endpoint(store.service.url_resources, schema_id=None, resource_id=id_)
+
+        payload = self.get_json(url, store.service.headers)
+        if payload is None:
+            return None
+
+        resource = store.service.to_resource(payload)
+        store.service.synchronize_resource(
+            resource=resource, response=None, action_name="retrieve", succeeded=True, synchronized=True
+        )
+        return resource
+
+    def retrieve_many(
+            self, ids: List[str], forge: KnowledgeGraphForge, cross_bucket: bool = True
+    ) -> List[Optional[Resource]]:
+        """
+        Retrieves resources concurrently through the cache, ids that can't be retrieved map to None
+        """
+        return get_concurrency_controller().starmap(self.retrieve, [(id_, forge, cross_bucket) for id_ in ids])
+
+
+_metadata_cache: Optional[MetadataCache] = None
+_metadata_cache_pid: Optional[int] = None
+
+
+def get_metadata_cache() -> MetadataCache:
+    """
+    Returns the metadata cache of this process, located in CACHE_DIRECTORY.
+    A forked process opens its own connection to it, sqlite connections can't be shared
+    """
+    global _metadata_cache, _metadata_cache_pid
+    if _metadata_cache is None or _metadata_cache_pid != os.getpid():
+        _metadata_cache = MetadataCache()
+        _metadata_cache_pid = os.getpid()
+    return _metadata_cache
@@ -0,0 +1,207 @@
+"""
+Stage timers, counters and memory gauges of a pipeline run, written at the end of the run as JSON and as an
+OpenMetrics textfile in the output directory, so that runs can be compared with each other.
+
+Time spent in a stage is summed over the threads running it, so it can exceed the duration of the run.
+A stage nested in another one (e.g. a download within a compute stage) is also counted in the outer stage's time,
+but not in its self time.
+"""
+import atexit
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from src.logger import logger
+
+RUN_METRICS_FILENAME = "run_metrics.json"
+RUN_METRICS_TEXTFILE_FILENAME = "run_metrics.prom"
+
+DOWNLOAD = "download"
+PARSE = "parse"
+COMPUTE = "compute"
+VALIDATE = "validate"
+REGISTER = "register"
+
+# Methods of forge sessions and the stage they belong to, see src.instrumentation.InstrumentedForge
+FORGE_METHOD_STAGES = {
+    "download": DOWNLOAD,
+    "validate": VALIDATE,
+    "register": REGISTER,
+    "update": REGISTER,
+    "deprecate": REGISTER,
+    "tag": REGISTER
+}
+
+
+def _peak_rss() -> int:
+    """
+    The peak resident set size of this process and of its waited-for children, in bytes
+    """
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in kilobytes on Linux
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    ) * scale
+
+
+class RunMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stack = threading.local()
+        self.started_at = time.time()
+        self.stages: Dict[str, Dict] = {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+
+    def start_memory_tracing(self):
+        """
+        Traces Python memory allocations, to report their peak. Slows down allocation-heavy code
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the block as part of a stage
+        """
+        if not hasattr(self._stack, "frames"):
+            self._stack.frames = []
+        stack = self._stack.frames
+
+        # Within a stage, the thread can enter the same stage again freely: it is part of the same operation
+        if any(frame["name"] == name for frame in stack):
+            yield
+            return
+
+        frame = {"name": name, "children": 0.0}
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            if len(stack) > 0:
+                stack[-1]["children"] += duration
+
+            with self._lock:
+                entry = self.stages.setdefault(
+                    name, {"calls": 0, "seconds": 0.0, "self_seconds": 0.0, "peak_rss_bytes": 0}
+                )
+                entry["calls"] += 1
+                entry["seconds"] += duration
+                entry["self_seconds"] += duration - frame["children"]
+                entry["peak_rss_bytes"] = max(entry["peak_rss_bytes"], _peak_rss())
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    def _sample_memory(self):
+        self.set_gauge("peak_rss_bytes", _peak_rss())
+        if tracemalloc.is_tracing():
+            self.set_gauge("tracemalloc_peak_bytes", tracemalloc.get_traced_memory()[1])
+
+    def as_json(self) -> Dict:
+        self._sample_memory()
+        with self._lock:
+            return {
+                "script": os.path.basename(sys.argv[0]),
+                "started_at": self.started_at,
+                "duration": time.time() - self.started_at,
+                "stages": {name: dict(entry) for name, entry in self.stages.items()},
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges)
+            }
+
+    def as_openmetrics(self) -> str:
+        data = self.as_json()
+        job = re.sub(r"\.py$", "", data["script"])
+
+        def name_of(s: str) -> str:
+            return re.sub(r"[^a-zA-Z0-9_]", "_", s)
+
+        lines = [
+            "# TYPE pipeline_run_duration_seconds gauge",
+            f'pipeline_run_duration_seconds{{job="{job}"}} {data["duration"]}',
+            "# TYPE pipeline_stage_seconds counter",
+            *(
+                f'pipeline_stage_seconds_total{{job="{job}",stage="{stage}"}} {entry["seconds"]}'
+                for stage, entry in data["stages"].items()
+            ),
+            "# TYPE pipeline_stage_self_seconds counter",
+            *(
+                f'pipeline_stage_self_seconds_total{{job="{job}",stage="{stage}"}} {entry["self_seconds"]}'
+                for stage, entry in data["stages"].items()
+            ),
+            "# TYPE pipeline_stage_calls counter",
+            *(
+                f'pipeline_stage_calls_total{{job="{job}",stage="{stage}"}} {entry["calls"]}'
+                for stage, entry in data["stages"].items()
+            ),
+            "# TYPE pipeline_stage_peak_rss_bytes gauge",
+            *(
+                f'pipeline_stage_peak_rss_bytes{{job="{job}",stage="{stage}"}} {entry["peak_rss_bytes"]}'
+                for stage, entry in data["stages"].items()
+            )
+        ]
+        for counter, value in data["counters"].items():
+            lines.extend([f"# TYPE pipeline_{name_of(counter)} counter", f'pipeline_{name_of(counter)}_total{{job="{job}"}} {value}'])
+        for gauge, value in data["gauges"].items():
+            lines.extend([f"# TYPE pipeline_{name_of(gauge)} gauge", f'pipeline_{name_of(gauge)}{{job="{job}"}} {value}'])
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, output_dir: str):
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, RUN_METRICS_FILENAME), "w") as f:
+            json.dump(self.as_json(), f, indent=4)
+        with open(os.path.join(output_dir, RUN_METRICS_TEXTFILE_FILENAME), "w") as f:
+            f.write(self.as_openmetrics())
+
+    def report_at_exit(self, output_dir: Optional[str]):
+        """
+        Logs the stage timings at the end of the run, and writes the metrics in output_dir if provided
+        """
+        def report():
+            data = self.as_json()
+            for stage, entry in sorted(data["stages"].items(), key=lambda kv: kv[1]["seconds"], reverse=True):
+                logger.info(
+                    f"Stage {stage}: {entry['calls']} calls, {entry['seconds']:.2f}s "
+                    f"({entry['self_seconds']:.2f}s excluding nested stages)"
+                )
+            logger.info(f"Peak RSS: {data['gauges']['peak_rss_bytes'] / 1024 ** 2:.1f} MiB")
+            if output_dir is not None:
+                self.write(output_dir)
+                logger.info(f"Run metrics written in {output_dir}")
+
+        atexit.register(report)
+
+
+_run_metrics: Optional[RunMetrics] = None
+_run_metrics_lock = threading.Lock()
+
+
+def get_run_metrics() -> RunMetrics:
+    """
+    Returns the metrics of the run of this process
+    """
+    global _run_metrics
+    with _run_metrics_lock:
+        if _run_metrics is None:
+            _run_metrics = RunMetrics()
+        return _run_metrics
@@ -0,0 +1,436 @@
+"""
+Seeds the local Nexus Delta stand-in with the data of the repository: the Allen hierarchy and annotation volume
+of data/atlas as an atlas release, the morphologies of data/swcs and data/test_data, and synthetic NWB traces,
+along with the contexts, ontologies, agents and schemas the pipelines look up.
+
+Buckets are the ones the pipelines use: bbp/atlas, neurosciencegraph/datamodels, bbp/agents, bbp-external/seu,
+bbp/mmb-point-neuron-framework-model (the default bucket of the scripts) and bbp/lnmce.
+"""
+import glob
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import h5py
+import numpy as np
+from voxcell import VoxelData
+from voxcell.exceptions import VoxcellError
+
+from src.brain_region_index import BrainRegionIndex, REGION_ID_PREFIX
+from src.helpers import CACHE_DIRECTORY, get_path, get_filename_and_ext_from_filepath
+from src.logger import logger
+from src.mock_delta.store import (
+    MockStore, MockResource, MOCK_CONTEXT, METADATA_KEYS, NEUROSHAPES_CONTEXT_IRI, MODEL_CONTEXT_IRI,
+    METADATA_CONTEXT_IRI, BMO
+)
+from src.neuron_morphology.conversion import convert_morphologies
+from src.neuron_morphology.soma_extraction import get_soma_center_fast
+from src.resolve_cache import TARGET_TO_ONTOLOGY, TARGET_TO_CLASS
+from src.trace.types_and_schemas import (
+    EXPERIMENTAL_TRACE_SCHEMA, TRACE_SCHEMA, TRACE_WEB_DATA_CONTAINER_SCHEMA
+)
+
+DATA_DIRECTORY = get_path("./data")
+
+ATLAS_BUCKET = "bbp/atlas"
+DATAMODELS_BUCKET = "neurosciencegraph/datamodels"
+AGENTS_BUCKET = "bbp/agents"
+MORPHOLOGY_BUCKET = "bbp-external/seu"
+TEST_MORPHOLOGY_BUCKET = "bbp/mmb-point-neuron-framework-model"
+TRACE_BUCKET = "bbp/lnmce"
+
+ATLAS_RELEASE_ID = "https://bbp.epfl.ch/neurosciencegraph/data/4906ab85-694f-469d-962f-c0174e901885"
+ATLAS_RELEASE_TAG = "v1.1.0"
+SPATIAL_REFERENCE_SYSTEM_ID = "https://bbp.epfl.ch/neurosciencegraph/data/allen_ccfv3_spatial_reference_system"
+ROOT_REGION = 997
+
+SPECIES = ("http://purl.obolibrary.org/obo/NCBITaxon_10090", "Mus musculus")
+STRAIN = ("http://bbp.epfl.ch/neurosciencegraph/ontologies/speciestaxonomy/RBS4NcT", "C57BL/6")
+ORGANIZATION = ("https://www.grid.ac/institutes/grid.263826.b", "Southeast University")
+PERSON = ("https://bbp.epfl.ch/neurosciencegraph/data/mock-contributor", "Mock", "Contributor")
+
+STIMULUS_TYPE_PREFIX = "http://bbp.epfl.ch/neurosciencegraph/ontologies/stimulustypes/"
+STIMULUS_TYPES = ["APWaveform", "IDRest", "IDthresh", "IV", "SpikeRec", "FirePattern"]
+
+CURATED_ANNOTATION = {
+    "type": ["QualityAnnotation", "Annotation"],
+    "hasBody": {"id": "https://neuroshapes.org/Curated", "type": ["AnnotationBody", "DataMaturity"], "label": "Curated"},
+    "motivatedBy": {"id": "https://neuroshapes.org/qualityAssessment", "type": "Motivation"},
+    "name": "Data maturity annotation",
+    "note": "NeuronMorphology dataset contains complete and curated morphologies"
+}
+
+# Required properties of the schemas, as SHACL minCount constraints checked by the trial endpoint
+SCHEMA_REQUIRED_PROPERTIES = {
+    "https://neuroshapes.org/dash/morphology": ["name"],
+    "https://neuroshapes.org/dash/neuronmorphology": ["name", "distribution", "brainLocation", "subject"],
+    "https://neuroshapes.org/dash/reconstructedneuronmorphology": [
+        "name", "distribution", "brainLocation", "subject", "contribution", "atlasRelease"
+    ],
+    TRACE_SCHEMA: ["name", "distribution"],
+    EXPERIMENTAL_TRACE_SCHEMA: ["name", "distribution", "stimulus", "image", "subject"],
+    TRACE_WEB_DATA_CONTAINER_SCHEMA: ["isPartOf", "distribution"],
+    "https://neuroshapes.org/dash/dataset": ["name"],
+}
+
+MORPHOLOGY_FORMATS = {".swc": "application/swc", ".asc": "application/asc", ".h5": "application/h5"}
+
+
+def _term(id_: str, label: str) -> Dict:
+    return {"id": id_, "label": label}
+
+
+def seed_contexts(store: MockStore):
+    """
+    The model context of forge sessions and the contexts resources refer to
+    """
+    for id_ in [NEUROSHAPES_CONTEXT_IRI, MODEL_CONTEXT_IRI]:
+        store.create(DATAMODELS_BUCKET, {"@context": MOCK_CONTEXT, "@id": id_, "@type": "Ontology"}, id_=id_)
+
+    metadata_context = dict((key, MOCK_CONTEXT[key]) for key in METADATA_KEYS)
+    store.create(
+        DATAMODELS_BUCKET, {"@context": {**metadata_context, "nxv": MOCK_CONTEXT["nxv"]}, "@id": METADATA_CONTEXT_IRI},
+        id_=METADATA_CONTEXT_IRI
+    )
+
+
+def seed_brain_regions(store: MockStore, hierarchy_path: str) -> BrainRegionIndex:
+    """
+    A class per region of the hierarchy, subclass of BrainRegion and part of its parent region
+    """
+    index = BrainRegionIndex.from_hierarchy_file(hierarchy_path)
+    ontology_id = TARGET_TO_ONTOLOGY["BrainRegion"]
+
+    children: Dict[int, List[int]] = {}
+    for region in index.regions:
+        if region["parent"] is not None:
+            children.setdefault(region["parent"], []).append(region["id"])
+
+    store.create(DATAMODELS_BUCKET, {"@id": ontology_id, "type": "Ontology", "label": "Brain Region Ontology"}, id_=ontology_id)
+    store.create(DATAMODELS_BUCKET, {"@id": TARGET_TO_CLASS["BrainRegion"], "type": "Class", "label": "Brain Region"})
+
+    for region in index.regions:
+        payload = {
+            "@id": f"{REGION_ID_PREFIX}{region['id']}",
+            "type": "Class",
+            "label": region["label"],
+            "notation": region["notation"],
+            "subClassOf": TARGET_TO_CLASS["BrainRegion"],
+            "isDefinedBy": ontology_id,
+        }
+        if region["synonyms"]:
+            payload["altLabel"] = region["synonyms"]
+        if region["parent"] is not None:
+            payload["isPartOf"] = f"{REGION_ID_PREFIX}{region['parent']}"
+        if region["id"] in children:
+            payload["hasPart"] = [f"{REGION_ID_PREFIX}{child}" for child in children[region["id"]]]
+        store.create(DATAMODELS_BUCKET, payload)
+
+    return index
+
+
+def seed_vocabularies(store: MockStore):
+    """
+    Species, strains and stimulus types
+    """
+    taxonomy_id = TARGET_TO_ONTOLOGY["Species"]
+    store.create(DATAMODELS_BUCKET, {"@id": taxonomy_id, "type": "Ontology", "label": "Species Taxonomy"})
+    for target, (id_, label) in [("Species", SPECIES), ("Strain", STRAIN)]:
+        store.create(DATAMODELS_BUCKET, {"@id": TARGET_TO_CLASS[target], "type": "Class", "label": target})
+        store.create(DATAMODELS_BUCKET, {
+            "@id": id_, "type": "Class", "label": label, "subClassOf": TARGET_TO_CLASS[target],
+            "isDefinedBy": taxonomy_id
+        })
+
+    single_cell_stimulus = f"{STIMULUS_TYPE_PREFIX}SingleCellProtocolStimulus"
+    store.create(DATAMODELS_BUCKET, {"@id": f"{BMO}ElectricalStimulus", "type": "Class", "label": "Electrical Stimulus"})
+    store.create(DATAMODELS_BUCKET, {
+        "@id": single_cell_stimulus, "type": "Class", "label": "Single Cell Protocol Stimulus",
+        "subClassOf": f"{BMO}ElectricalStimulus"
+    })
+    for stimulus_type in STIMULUS_TYPES:
+        store.create(DATAMODELS_BUCKET, {
+            "@id": f"{STIMULUS_TYPE_PREFIX}{stimulus_type}", "type": "Class", "label": stimulus_type,
+            "subClassOf": single_cell_stimulus
+        })
+
+
+def seed_agents(store: MockStore):
+    store.create(AGENTS_BUCKET, {"@id": ORGANIZATION[0], "type": ["Agent", "Organization"], "name": ORGANIZATION[1]})
+    id_, given_name, family_name = PERSON
+    store.create(AGENTS_BUCKET, {
+        "@id": id_, "type": ["Agent", "Person"], "givenName": given_name, "familyName": family_name,
+        "name": f"{given_name} {family_name}"
+    })
+
+
+def seed_schemas(store: MockStore):
+    for schema_id, properties in SCHEMA_REQUIRED_PROPERTIES.items():
+        store.create(DATAMODELS_BUCKET, {
+            "@id": schema_id,
+            "type": "Schema",
+            "shapes": [{
+                "@id": f"{schema_id}/shapes/MainShape",
+                "@type": "sh:NodeShape",
+                "sh:property": [{"sh:path": p, "sh:minCount": 1} for p in properties]
+            }]
+        }, schema="https://bluebrain.github.io/nexus/schemas/shacl-20170720.ttl")
+
+
+def _tagged(store: MockStore, resource: MockResource) -> MockResource:
+    store.tag(resource, ATLAS_RELEASE_TAG, resource.rev)
+    return resource
+
+
+def seed_atlas(store: MockStore, atlas_dir: str) -> VoxelData:
+    """
+    An atlas release at ATLAS_RELEASE_TAG, with the hierarchy as parcellation ontology and the annotation volume
+    as parcellation volume. The annotation volume also stands in for the other volumes of the release
+
+    :return: the annotation volume, to place morphologies in brain regions
+    """
+    hierarchy_path = os.path.join(atlas_dir, "1.json")
+    volume_path = os.path.join(atlas_dir, "annotation_25_ccf2017.nrrd")
+
+    hierarchy_file = store.add_file(ATLAS_BUCKET, "1.json", "application/json", path=hierarchy_path)
+    volume_file = store.add_file(ATLAS_BUCKET, "annotation_25_ccf2017.nrrd", "application/nrrd", path=volume_path)
+    catalog_file = store.add_file(
+        ATLAS_BUCKET, "placement_hints_data_catalog.json", "application/json",
+        content=json.dumps({"placementHints": [], "voxelDistanceToRegionBottom": []}).encode()
+    )
+
+    def layer(name: str, type_: str, file) -> str:
+        resource = store.create(ATLAS_BUCKET, {
+            "type": ["Dataset", type_],
+            "name": name,
+            "atlasRelease": {"id": ATLAS_RELEASE_ID, "type": ["AtlasRelease", "BrainAtlasRelease"]},
+            "brainLocation": {"type": "BrainLocation", "brainRegion": _term(f"{REGION_ID_PREFIX}{ROOT_REGION}", "root")},
+            "subject": {"type": "Subject", "species": _term(*SPECIES)},
+            "distribution": store.distribution(file)
+        })
+        return _tagged(store, resource).id
+
+    links = {
+        "parcellationOntology": layer("Mock parcellation ontology", "ParcellationOntology", hierarchy_file),
+        "parcellationVolume": layer("Mock parcellation volume", "BrainParcellationDataLayer", volume_file),
+        "placementHintsDataCatalog": layer("Mock placement hints data catalog", "DataCatalog", catalog_file),
+        "cellOrientationField": layer("Mock cell orientation field", "CellOrientationField", volume_file),
+        "directionVector": layer("Mock direction vector", "DirectionVectorField", volume_file),
+        "hemisphereVolume": layer("Mock hemisphere volume", "HemisphereAnnotationDataLayer", volume_file),
+    }
+
+    release = store.create(ATLAS_BUCKET, {
+        "@id": ATLAS_RELEASE_ID,
+        "type": ["AtlasRelease", "BrainAtlasRelease", "Entity"],
+        "name": "Mock Blue Brain Atlas",
+        "brainTemplateDataLayer": {"id": links["parcellationVolume"], "type": "BrainTemplateDataLayer"},
+        "spatialReferenceSystem": {"id": SPATIAL_REFERENCE_SYSTEM_ID, "type": "AtlasSpatialReferenceSystem"},
+        "subject": {"type": "Subject", "species": _term(*SPECIES)},
+        **dict((key, {"id": id_}) for key, id_ in links.items())
+    })
+    _tagged(store, release)
+
+    return VoxelData.load_nrrd(volume_path)
+
+
+def _brain_region(
+        morphology_path: str, voxel_data: VoxelData, index: BrainRegionIndex
+) -> Tuple[Dict, Optional[List[float]]]:
+    """
+    The brain region of the soma of a morphology in the annotation volume, and the soma center
+    """
+    try:
+        center = get_soma_center_fast(morphology_path)
+    except Exception:
+        center = None
+
+    region_id = ROOT_REGION
+    if center is not None:
+        try:
+            indices = voxel_data.positions_to_indices(np.array(center))
+            region_id = int(voxel_data.raw[tuple(indices)]) or ROOT_REGION
+        except VoxcellError:
+            pass
+
+    region = index.get(region_id) or index.get(ROOT_REGION)
+    return _term(f"{REGION_ID_PREFIX}{region['id']}", region["label"]), center
+
+
+def _morphology_payload(
+        name: str, distributions: List[Dict], brain_region: Dict, center: Optional[List[float]], reconstructed: bool
+) -> Dict:
+    payload = {
+        "type": ["Dataset", "NeuronMorphology", *(["ReconstructedNeuronMorphology"] if reconstructed else [])],
+        "name": name,
+        "description": "Mock neuron morphology",
+        "brainLocation": {"type": "BrainLocation", "brainRegion": brain_region},
+        "subject": {"type": "Subject", "species": _term(*SPECIES), "strain": _term(*STRAIN)},
+        "contribution": {"type": "Contribution", "agent": {"id": ORGANIZATION[0], "type": ["Agent", "Organization"]}},
+        "objectOfStudy": {
+            "type": "ObjectOfStudy", "label": "Single Cell",
+            "id": "http://bbp.epfl.ch/neurosciencegraph/taxonomies/objectsofstudy/singlecells"
+        },
+        "isRegisteredIn": {"id": SPATIAL_REFERENCE_SYSTEM_ID, "type": ["AtlasSpatialReferenceSystem", "BrainAtlasSpatialReferenceSystem"]},
+        "atlasRelease": {"id": ATLAS_RELEASE_ID, "type": ["BrainAtlasRelease", "AtlasRelease"]},
+        "annotation": CURATED_ANNOTATION,
+        "distribution": distributions
+    }
+    if center is not None:
+        payload["brainLocation"]["coordinatesInBrainAtlas"] = dict(
+            (f"value{axis}", {"@value": float(v), "type": "xsd:float"}) for axis, v in zip("XYZ", center)
+        )
+    return payload
+
+
+def seed_morphologies(
+        store: MockStore, bucket: str, paths: List[str], conversion_dir: str,
+        voxel_data: VoxelData, index: BrainRegionIndex, convert: bool = True
+) -> int:
+    """
+    Registers morphologies with a distribution per format. Morphologies of the same name in several formats
+    make up a single resource. swc morphologies are converted to asc and h5 if convert is True, and are registered
+    as reconstructed morphologies
+    """
+    by_name: Dict[str, Dict[str, str]] = {}
+    for path in paths:
+        name, ext = get_filename_and_ext_from_filepath(path)
+        if ext.lower() in MORPHOLOGY_FORMATS:
+            by_name.setdefault(name, {})[ext.lower()] = path
+
+    if convert:
+        os.makedirs(conversion_dir, exist_ok=True)
+        conversions = dict(
+            (files[".swc"], [os.path.join(conversion_dir, f"{name}{ext}") for ext in [".asc", ".h5"] if ext not in files])
+            for name, files in by_name.items() if ".swc" in files
+        )
+        failures = convert_morphologies(dict((k, v) for k, v in conversions.items() if len(v) > 0))
+        for src_path, outputs in conversions.items():
+            name, _ = get_filename_and_ext_from_filepath(src_path)
+            for output in outputs:
+                if output not in failures:
+                    by_name[name][get_filename_and_ext_from_filepath(output)[1]] = output
+
+    for name, files in sorted(by_name.items()):
+        distributions = [
+            store.distribution(
+                store.add_file(bucket, os.path.basename(path), MORPHOLOGY_FORMATS[ext], path=path)
+            )
+            for ext, path in sorted(files.items())
+        ]
+        brain_region, center = _brain_region(files.get(".swc", next(iter(files.values()))), voxel_data, index)
+        store.create(
+            bucket, _morphology_payload(name, distributions, brain_region, center, reconstructed=".swc" in files),
+            schema="https://neuroshapes.org/dash/reconstructedneuronmorphology" if ".swc" in files
+            else "https://neuroshapes.org/dash/neuronmorphology"
+        )
+
+    return len(by_name)
+
+
+def write_synthetic_nwb(path: str, stimulus_types: List[str], seed: int, n_samples: int = 2000):
+    """
+    A small NWB-like HDF5 file with one sweep per stimulus type, holding the datasets the trace pipelines read
+    """
+    rng = np.random.default_rng(seed)
+    with h5py.File(path, "w") as f:
+        f.attrs["nwb_version"] = "2.5.0"
+        recordings = f.create_group("general/intracellular_ephys/sequential_recordings")
+        recordings.create_dataset("stimulus_type", data=np.array(stimulus_types, dtype=h5py.string_dtype()))
+        recordings.create_dataset("id", data=np.arange(len(stimulus_types)))
+
+        for i, stimulus_type in enumerate(stimulus_types):
+            stimulus = np.zeros(n_samples)
+            stimulus[n_samples // 4: 3 * n_samples // 4] = 0.1 * (i + 1)
+            response = -70 + 10 * stimulus / max(stimulus.max(), 1e-9) + rng.normal(0, 0.5, n_samples)
+
+            for group_name, data, unit in [("acquisition", response, "volts"), ("stimulus/presentation", stimulus, "amperes")]:
+                series = f.create_group(f"{group_name}/{stimulus_type}_{i}")
+                dataset = series.create_dataset("data", data=data.astype(np.float32))
+                dataset.attrs["unit"] = unit
+                dataset.attrs["conversion"] = 1e-3 if unit == "volts" else 1e-9
+                series.create_dataset("starting_time", data=0.0).attrs["rate"] = 10000.0
+                series.attrs["stimulus_description"] = stimulus_type
+
+
+def seed_traces(store: MockStore, bucket: str, trace_dir: str, n_traces: int) -> int:
+    """
+    Registers synthetic experimental traces, each with an NWB distribution and a TraceWebDataContainer
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+
+    for i in range(n_traces):
+        name = f"mock_trace_{i:04d}"
+        stimulus_types = STIMULUS_TYPES[: 2 + i % (len(STIMULUS_TYPES) - 1)]
+        nwb_path = os.path.join(trace_dir, f"{name}.nwb")
+        if not os.path.isfile(nwb_path):
+            write_synthetic_nwb(nwb_path, stimulus_types, seed=i)
+
+        nwb_file = store.add_file(bucket, f"{name}.nwb", "application/nwb", path=nwb_path)
+        stimulus_terms = [_term(f"{STIMULUS_TYPE_PREFIX}{s}", s) for s in stimulus_types]
+
+        trace = store.create(bucket, {
+            "type": ["Dataset", "Trace", "ExperimentalTrace", "SingleCellExperimentalTrace"],
+            "name": name,
+            "description": "Mock experimental trace",
+            "brainLocation": {"type": "BrainLocation", "brainRegion": _term(f"{REGION_ID_PREFIX}{ROOT_REGION}", "root")},
+            "subject": {"type": "Subject", "species": _term(*SPECIES)},
+            "contribution": {"type": "Contribution", "agent": {"id": PERSON[0], "type": ["Agent", "Person"]}},
+            "stimulus": [{"type": "Stimulus", "stimulusType": term} for term in stimulus_terms],
+            "image": [
+                {
+                    "id": store.file_url(bucket, store.new_id(bucket)), "about": "nsg:StimulationTrace",
+                    "repetition": 0, "stimulusType": term
+                }
+                for term in stimulus_terms
+            ],
+            "distribution": store.distribution(nwb_file)
+        }, schema=EXPERIMENTAL_TRACE_SCHEMA)
+
+        container = store.create(bucket, {
+            "type": "TraceWebDataContainer",
+            "name": name,
+            "isPartOf": {"id": trace.id, "type": f"{BMO}ExperimentalTrace"},
+            "distribution": store.distribution(nwb_file)
+        }, schema=TRACE_WEB_DATA_CONTAINER_SCHEMA)
+
+        payload = dict(trace.revisions[-1]["payload"])
+        store.update(trace, {**payload, "hasPart": {"id": container.id, "type": "TraceWebDataContainer"}}, trace.rev)
+
+    return n_traces
+
+
+def seed(store: MockStore, data_dir: str = DATA_DIRECTORY, work_dir: Optional[str] = None,
+         n_traces: int = 20, convert: bool = True) -> MockStore:
+    """
+    :param work_dir: where converted morphologies and synthetic traces are written,
+    defaults to a mock_delta directory in CACHE_DIRECTORY
+    """
+    work_dir = work_dir or os.path.join(CACHE_DIRECTORY, "mock_delta")
+
+    seed_contexts(store)
+    index = seed_brain_regions(store, os.path.join(data_dir, "atlas", "1.json"))
+    seed_vocabularies(store)
+    seed_agents(store)
+    seed_schemas(store)
+    voxel_data = seed_atlas(store, os.path.join(data_dir, "atlas"))
+
+    n_seu = seed_morphologies(
+        store, MORPHOLOGY_BUCKET, sorted(glob.glob(os.path.join(data_dir, "swcs", "*.swc"))),
+        os.path.join(work_dir, "converted", "seu"), voxel_data, index, convert=convert
+    )
+    test_data_paths = [
+        path for sub_dir in ["swc", "neurolucida", os.path.join("h5", "v1")]
+        for path in sorted(glob.glob(os.path.join(data_dir, "test_data", sub_dir, "*")))
+        if os.path.isfile(path)
+    ]
+    n_test_data = seed_morphologies(
+        store, TEST_MORPHOLOGY_BUCKET, test_data_paths,
+        os.path.join(work_dir, "converted", "test_data"), voxel_data, index, convert=convert
+    )
+    n_traces = seed_traces(store, TRACE_BUCKET, os.path.join(work_dir, "traces"), n_traces)
+
+    logger.info(
+        f"Seeded {len(store)} resources: {len(index.regions)} brain regions, {n_seu} morphologies in {MORPHOLOGY_BUCKET}, "
+        f"{n_test_data} in {TEST_MORPHOLOGY_BUCKET}, {n_traces} traces in {TRACE_BUCKET}"
+    )
+    return store
@@ -0,0 +1,570 @@
+"""
+Local stand-in for Nexus Delta, so that pipelines can be run and benchmarked end-to-end without a live Nexus.
+Run with:
+
+    python -m src.mock_delta.server --port 8080 --latency 0.05 --error_rate 0.01
+
+and run the pipelines with --deployment LOCAL. Any username and password are accepted.
+
+Covered: projects, resources (create, update, deprecate, tag, fetch by revision or tag, source), resolvers,
+files (metadata, content, upload), Elastic Search views (_search, point in time), SPARQL views, the trial
+validation endpoint, the search query endpoint and the token endpoint of the authentication server.
+The forge configuration pointing at the server is served at /forge-config.yml.
+
+Elastic Search queries and SPARQL are run on the in-memory store: see src.mock_delta.store for what is supported.
+Latency is added to every response, per kind of request if configured (kinds are the ones of src.instrumentation:
+retrieve, search, sparql, download, register, update, deprecate, validate, pit, token). A fraction of requests can
+be answered with an error status, with a Retry-After header for 429 and 503.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, quote_plus, unquote_plus, urlparse
+
+from src.helpers import ASSETS_DIRECTORY
+from src.instrumentation import _url_kind
+from src.logger import logger
+from src.mock_delta.seed import seed, DATA_DIRECTORY
+from src.mock_delta.store import MockStore, UNCONSTRAINED_SCHEMA, es_search, _expand
+
+MOCK_ASSETS_DIRECTORY = os.path.join(ASSETS_DIRECTORY, "mock_delta")
+FORGE_CONFIG_TEMPLATE = "forge-config.yml"
+MAPPINGS = ["file-to-resource-mapping.hjson", "term-to-resource-mapping.hjson", "agent-to-resource-mapping.hjson"]
+
+RETRY_AFTER_STATUSES = {429, 503}
+
+# Fields of the resources of the default Elastic Search view mapping, with keyword sub-fields for strings
+ES_KEYWORD_FIELDS = ["@id", "@type", "_project", "_constrainedBy", "_createdBy", "_updatedBy", "_self"]
+ES_TEXT_FIELDS = ["name", "label", "description"]
+
+
+def _encode_jwt(payload: Dict) -> str:
+    def b64(obj: Dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+    return f"{b64({'alg': 'none', 'typ': 'JWT'})}.{b64(payload)}.mock"
+
+
+class MockDeltaServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(
+            self, port: int, store: MockStore, latency: float = 0, kind_latency: Optional[Dict[str, float]] = None,
+            error_rate: float = 0, error_statuses: Optional[List[int]] = None, retry_after: int = 1,
+            require_auth: bool = False, token_lifetime: int = 300, seed_value: Optional[int] = None
+    ):
+        """
+        :param latency: the delay added to every response, in seconds
+        :param kind_latency: the delay added to the responses of each kind of request, instead of latency
+        :param error_rate: the fraction of requests answered with one of error_statuses
+        :param require_auth: whether requests without a bearer token issued by the server, and not expired,
+        are answered with a 401
+        :param token_lifetime: the lifetime of the tokens issued, in seconds
+        """
+        super().__init__(("", port), MockDeltaHandler)
+        self.store = store
+        self.latency = latency
+        self.kind_latency = kind_latency or {}
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses or [503]
+        self.retry_after = retry_after
+        self.require_auth = require_auth
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed_value)
+        self._random_lock = threading.Lock()
+        self.points_in_time: Dict[str, List[Dict]] = {}
+
+    @property
+    def base_url(self) -> str:
+        return self.store.endpoint.rsplit("/v1", 1)[0]
+
+    def should_fail(self) -> Optional[int]:
+        with self._random_lock:
+            if self.error_rate > 0 and self.random.random() < self.error_rate:
+                return self.random.choice(self.error_statuses)
+        return None
+
+    def issue_token(self, username: str) -> str:
+        now = int(time.time())
+        return _encode_jwt({
+            "exp": now + self.token_lifetime, "iat": now, "jti": str(uuid.uuid4()),
+            "preferred_username": username, "aud": "https://slack.com", "iss": f"{self.base_url}/auth/realms/mock"
+        })
+
+    def token_is_valid(self, token: str) -> bool:
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"]) > time.time()
+        except (IndexError, KeyError, TypeError, ValueError):
+            return False
+
+
+class MockDeltaHandler(BaseHTTPRequestHandler):
+
+    server: MockDeltaServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.command} {self.path} - {format % args}")
+
+    # Responses
+
+    def _send(self, status: int, body: bytes = b"", content_type: str = "application/json", headers: Optional[Dict] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, status: int, obj, content_type: str = "application/ld+json", headers: Optional[Dict] = None):
+        self._send(status, json.dumps(obj).encode(), content_type, headers)
+
+    def _error(self, status: int, type_: str, reason: str, headers: Optional[Dict] = None):
+        self._json(status, {
+            "@context": "https://bluebrain.github.io/nexus/contexts/error.json", "@type": type_, "reason": reason
+        }, headers=headers)
+
+    def _not_found(self, what: str = "resource"):
+        self._error(404, "ResourceNotFound", f"The {what} was not found")
+
+    # Requests
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        return self.rfile.read(length) if length > 0 else b""
+
+    def _json_body(self) -> Dict:
+        body = self._body()
+        return json.loads(body) if body else {}
+
+    def _multipart_file(self):
+        """
+        The part named file of a multipart/form-data body
+        """
+        header = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode()
+        message = BytesParser(policy=HTTP).parsebytes(header + self._body())
+        if not message.is_multipart():
+            return None
+        return next(
+            (part for part in message.iter_parts() if part.get_param("name", header="content-disposition") == "file"),
+            None
+        )
+
+    def _handle(self):
+        url = urlparse(self.path)
+        segments = [unquote_plus(s) for s in url.path.strip("/").split("/")]
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+
+        if segments[:1] in [["forge-config.yml"], ["mappings"]]:
+            return self._asset(segments)
+
+        kind = _url_kind(self.command, self.path, self.headers.get("Accept", None))
+        time.sleep(self.server.kind_latency.get(kind, self.server.latency))
+
+        status = self.server.should_fail()
+        if status is not None:
+            headers = {"Retry-After": str(self.server.retry_after)} if status in RETRY_AFTER_STATUSES else None
+            self._body()
+            return self._error(status, "MockInjectedError", "Error injected by the mock server", headers=headers)
+
+        if segments[:1] == ["auth"]:
+            return self._token()
+
+        if segments[:1] != ["v1"]:
+            return self._not_found("route")
+
+        if self.server.require_auth:
+            authorization = self.headers.get("Authorization", "")
+            if not authorization.startswith("Bearer ") or not self.server.token_is_valid(authorization[len("Bearer "):]):
+                self._body()
+                return self._error(401, "AuthorizationFailed", "The supplied authentication is invalid or expired")
+
+        route, rest = (segments[1], segments[2:]) if len(segments) > 1 else ("", [])
+        handler = {
+            "projects": self._projects,
+            "resources": self._resources,
+            "resolvers": self._resolvers,
+            "files": self._files,
+            "views": self._views,
+            "trial": self._trial,
+            "search": self._search_query,
+        }.get(route, None)
+
+        if handler is None:
+            return self._not_found("route")
+        return handler(rest, query)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+    # Assets
+
+    def _asset(self, segments: List[str]):
+        name = FORGE_CONFIG_TEMPLATE if segments[0] == FORGE_CONFIG_TEMPLATE else segments[-1]
+        if name != FORGE_CONFIG_TEMPLATE and name not in MAPPINGS:
+            return self._not_found("asset")
+        with open(os.path.join(MOCK_ASSETS_DIRECTORY, name), "r") as f:
+            content = Template(f.read()).safe_substitute(endpoint=self.server.store.endpoint, base_url=self.server.base_url)
+        self._send(200, content.encode(), "text/plain")
+
+    def _token(self):
+        form = parse_qs(self._body().decode())
+        username = form.get("username", [None])[0]
+        if username is None:  # Client credentials, the client id is in the basic authorization header
+            try:
+                basic = self.headers.get("Authorization", "").split(" ", 1)[1]
+                username = base64.b64decode(basic).decode().split(":", 1)[0]
+            except (IndexError, ValueError):
+                username = "service-account"
+        token = self.server.issue_token(username)
+        self._json(200, {
+            "access_token": token, "expires_in": self.server.token_lifetime, "refresh_token": token,
+            "token_type": "Bearer", "scope": "openid"
+        }, content_type="application/json")
+
+    # Projects
+
+    def _projects(self, rest: List[str], query: Dict):
+        project = "/".join(rest[:2])
+        store = self.server.store
+        if self.command == "PUT":
+            self._body()
+            store.create_project(project)
+        if project not in store.projects:
+            return self._not_found("project")
+        self._json(200, store.projects[project])
+
+    # Resources
+
+    def _project_of(self, rest: List[str]) -> Optional[str]:
+        project = "/".join(rest[:2])
+        if project not in self.server.store.projects:
+            self._body()
+            self._not_found("project")
+            return None
+        return project
+
+    def _resource_response(self, resource, query: Dict, source: bool = False):
+        store = self.server.store
+        rev = int(query["rev"]) if "rev" in query else None
+        data = store.resource_json(resource, rev=rev, tag=query.get("tag", None))
+        if data is None:
+            return self._not_found("revision")
+        if source:
+            payload = {k: v for k, v in data.items() if not k.startswith("_")}
+            if query.get("annotate", "false") == "true":
+                payload.update(store.metadata(resource, data["_rev"]))
+            payload["@id"] = resource.id
+            data = payload
+        self._json(200, data)
+
+    def _resources(self, rest: List[str], query: Dict):
+        project = self._project_of(rest)
+        if project is None:
+            return
+        store = self.server.store
+        schema = rest[2] if len(rest) > 2 else "_"
+        schema = UNCONSTRAINED_SCHEMA if schema in ["_", ""] else _expand(schema, vocab=False)
+        id_ = rest[3] if len(rest) > 3 and rest[3] != "" else None
+        suffix = rest[4] if len(rest) > 4 else None
+
+        if id_ is None:
+            if self.command == "POST":
+                payload = self._json_body()
+                try:
+                    resource = store.create(project, payload, schema=schema)
+                except KeyError:
+                    return self._error(409, "ResourceAlreadyExists", "The resource already exists")
+                return self._json(201, store.metadata(resource))
+            if self.command == "GET":
+                return self._json(200, {
+                    "_total": len(store.resources[project]),
+                    "_results": [store.metadata(r) for r in store.resources[project].values()][:int(query.get("size", 20))]
+                })
+            return self._not_found("route")
+
+        resource = store.get(project, id_)
+
+        if self.command == "PUT" and resource is None:
+            payload = self._json_body()
+            resource = store.create(project, payload, schema=schema, id_=id_)
+            return self._json(201, store.metadata(resource))
+
+        if resource is None:
+            self._body()
+            return self._not_found()
+
+        if suffix == "tags":
+            if self.command == "POST":
+                body = self._json_body()
+                if not store.tag(resource, body["tag"], int(body["rev"])):
+                    return self._error(400, "RevisionNotFound", f"Revision {body['rev']} not found")
+                return self._json(201, store.metadata(resource))
+            return self._json(200, {"tags": [{"rev": r, "tag": t} for t, r in resource.tags.items()]})
+
+        if self.command in ["GET", "HEAD"]:
+            return self._resource_response(resource, query, source=suffix == "source")
+
+        rev = int(query.get("rev", 0))
+        if self.command == "PUT":
+            if not store.update(resource, self._json_body(), rev):
+                return self._error(409, "IncorrectRev", f"Expected revision {resource.rev}, got {rev}")
+            return self._json(200, store.metadata(resource))
+        if self.command == "DELETE":
+            self._body()
+            if not store.deprecate(resource, rev):
+                return self._error(409, "IncorrectRev", f"Expected revision {resource.rev}, got {rev}")
+            return self._json(200, store.metadata(resource))
+
+        return self._not_found("route")
+
+    def _resolvers(self, rest: List[str], query: Dict):
+        project = self._project_of(rest)
+        if project is None:
+            return
+        id_ = rest[3] if len(rest) > 3 else None
+        resource = self.server.store.resolve(project, id_) if id_ else None
+        if resource is None:
+            return self._not_found()
+        self._resource_response(resource, query, source=len(rest) > 4 and rest[4] == "source")
+
+    # Files
+
+    def _files(self, rest: List[str], query: Dict):
+        project = self._project_of(rest)
+        if project is None:
+            return
+        store = self.server.store
+        id_ = rest[2] if len(rest) > 2 and rest[2] != "" else None
+
+        if self.command in ["POST", "PUT"]:
+            if id_ is not None and store.get_file(project, id_) is not None:
+                self._body()
+                return self._error(409, "ResourceAlreadyExists", "The file already exists")
+            part = self._multipart_file()
+            if part is None:
+                return self._error(400, "MalformedRequest", "Expected a multipart body with a file part")
+            file = store.add_file(
+                project, part.get_filename(), part.get_content_type(), content=part.get_payload(decode=True), id_=id_
+            )
+            return self._json(201, store.file_json(file))
+
+        file = store.get_file(project, id_) if id_ else None
+        if file is None:
+            return self._not_found("file")
+
+        accept = self.headers.get("Accept", "*/*")
+        if "json" in accept and "*/*" not in accept:
+            return self._json(200, store.file_json(file))
+
+        self.send_response(200)
+        self.send_header("Content-Type", file.media_type)
+        self.send_header("Content-Length", str(file.size))
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote_plus(file.filename)}")
+        self.end_headers()
+        if self.command != "HEAD":
+            for chunk in file.iter_content():
+                self.wfile.write(chunk)
+
+    # Views
+
+    def _views(self, rest: List[str], query: Dict):
+        project = self._project_of(rest)
+        if project is None:
+            return
+        view = rest[2] if len(rest) > 2 else None
+        action = rest[3] if len(rest) > 3 else None
+
+        if action == "_search":
+            return self._es_search(self.server.store.es_documents(project))
+        if action == "_pit":
+            return self._point_in_time(project, query)
+        if action == "sparql":
+            return self._sparql(project, query)
+        if view is not None and action is None and self.command == "GET":
+            return self._json(200, self._view_json(project, view))
+        self._body()
+        return self._not_found("route")
+
+    def _view_json(self, project: str, view: str) -> Dict:
+        properties = dict((field, {"type": "keyword"}) for field in ES_KEYWORD_FIELDS)
+        properties.update(
+            (field, {"type": "text", "fields": {"keyword": {"type": "keyword"}}}) for field in ES_TEXT_FIELDS
+        )
+        properties.update({"_deprecated": {"type": "boolean"}, "_rev": {"type": "long"}})
+        return {
+            "@id": view,
+            "@type": ["ElasticSearchView", "View"],
+            "mapping": {"dynamic": True, "properties": properties},
+            "resourceSchemas": [], "resourceTypes": [], "includeMetadata": True, "includeDeprecated": True,
+            **dict((k, v) for k, v in self.server.store.projects[project].items() if k.startswith("_"))
+        }
+
+    def _es_search(self, documents):
+        body = self._json_body()
+        pit = body.pop("pit", None)
+        if pit is not None:
+            documents = self.server.points_in_time.get(pit["id"], None)
+            if documents is None:
+                return self._error(404, "PointInTimeNotFound", "The point in time has expired or doesn't exist")
+        try:
+            result = es_search(documents, body)
+        except (ValueError, KeyError, TypeError) as e:
+            return self._error(400, "ElasticSearchQueryError", str(e))
+        if pit is not None:
+            result["pit_id"] = pit["id"]
+        self._json(200, result, content_type="application/json")
+
+    def _point_in_time(self, project: str, query: Dict):
+        if self.command == "POST":
+            self._body()
+            pit_id = str(uuid.uuid4())
+            self.server.points_in_time[pit_id] = list(self.server.store.es_documents(project))
+            return self._json(200, {"id": pit_id}, content_type="application/json")
+        if self.command == "DELETE":
+            body = self._json_body()
+            self.server.points_in_time.pop(body.get("id", None), None)
+            return self._json(200, {"succeeded": True, "num_freed": 1}, content_type="application/json")
+        return self._not_found("route")
+
+    def _sparql(self, project: str, query: Dict):
+        if self.command == "GET":
+            q = query.get("query", "")
+        else:
+            body = self._body().decode()
+            q = parse_qs(body).get("query", [body])[0] \
+                if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded") else body
+        try:
+            result = self.server.store.sparql(project, q)
+        except Exception as e:
+            return self._error(400, "SparqlClientError", str(e))
+        self._send(200, result.serialize(format="json"), "application/sparql-results+json")
+
+    def _search_query(self, rest: List[str], query: Dict):
+        store = self.server.store
+        documents = [d for project in list(store.projects) for d in store.es_documents(project)]
+        self._es_search(documents)
+
+    # Trial
+
+    def _trial(self, rest: List[str], query: Dict):
+        if rest[:1] != ["resources"] or self._project_of(rest[1:]) is None:
+            return
+        body = self._json_body()
+        resource = body.get("resource", {})
+        schema_id = body.get("schema", None)
+
+        schema = self.server.store.resolve(rest[1] + "/" + rest[2], _expand(schema_id, vocab=False)) \
+            if schema_id else None
+        if schema_id and schema is None:
+            return self._not_found("schema")
+
+        results = []
+        if "@type" not in resource and "type" not in resource:
+            results.append({"resultMessage": "The resource has no type", "resultPath": "rdf:type"})
+        if schema is not None:
+            for shape in schema.at()["payload"].get("shapes", []):
+                for constraint in shape.get("sh:property", []):
+                    if constraint.get("sh:minCount", 0) > 0 and constraint["sh:path"] not in resource:
+                        results.append({
+                            "focusNode": resource.get("@id", resource.get("id", None)),
+                            "resultMessage": f"Less than {constraint['sh:minCount']} values",
+                            "resultPath": constraint["sh:path"],
+                            "resultSeverity": "sh:Violation",
+                            "sourceShape": shape["@id"]
+                        })
+
+        report = {"@type": "sh:ValidationReport", "conforms": len(results) == 0, "result": results}
+        schema_json = {"@id": schema.id, "_rev": schema.rev} if schema is not None else None
+        if len(results) == 0:
+            return self._json(200, {"schema": schema_json, "result": report})
+        self._json(200, {
+            "schema": schema_json,
+            "error": {"@type": "InvalidResource", "reason": "The resource is not valid against the schema", "details": {"result": report}}
+        })
+
+
+def define_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    parser.add_argument("--port", help="The port to listen on", type=int, default=8080)
+    parser.add_argument(
+        "--latency", help="The delay added to every response, in seconds", type=float, default=0
+    )
+    parser.add_argument(
+        "--kind_latency", help="The delay added to the responses of a kind of request, in seconds, e.g. search=0.2 "
+                               "sparql=0.5. Overrides --latency for that kind", type=str, nargs="*", default=[]
+    )
+    parser.add_argument(
+        "--error_rate", help="The fraction of requests answered with an error status", type=float, default=0
+    )
+    parser.add_argument(
+        "--error_statuses", help="The error statuses to pick from", type=int, nargs="+", default=[503]
+    )
+    parser.add_argument(
+        "--retry_after", help="The Retry-After of 429 and 503 responses, in seconds", type=int, default=1
+    )
+    parser.add_argument(
+        "--require_auth", help="Whether requests need a valid token issued by the server. Valid values: yes, no",
+        type=str, choices=["yes", "no"], default="no"
+    )
+    parser.add_argument(
+        "--token_lifetime", help="The lifetime of issued tokens, in seconds", type=int, default=300
+    )
+    parser.add_argument(
+        "--n_traces", help="The number of synthetic traces to seed", type=int, default=20
+    )
+    parser.add_argument(
+        "--convert", help="Whether to convert seeded swc morphologies into asc and h5. Valid values: yes, no",
+        type=str, choices=["yes", "no"], default="yes"
+    )
+    parser.add_argument(
+        "--data_dir", help="The directory of the data to seed the server with", type=str, default=DATA_DIRECTORY
+    )
+    parser.add_argument(
+        "--seed", help="The seed of the random error injection", type=int, default=None
+    )
+    return parser
+
+
+def _parse_kind_latency(values: List[str]) -> Dict[str, float]:
+    kind_latency = {}
+    for value in values:
+        kind, seconds = value.split("=", 1)
+        kind_latency[kind] = float(seconds)
+    return kind_latency
+
+
+if __name__ == "__main__":
+    parser = define_arguments(argparse.ArgumentParser())
+    received_args, leftovers = parser.parse_known_args()
+
+    endpoint = f"http://localhost:{received_args.port}/v1"
+    store = seed(
+        MockStore(endpoint), data_dir=received_args.data_dir, n_traces=received_args.n_traces,
+        convert=received_args.convert == "yes"
+    )
+
+    server = MockDeltaServer(
+        port=received_args.port, store=store, latency=received_args.latency,
+        kind_latency=_parse_kind_latency(received_args.kind_latency), error_rate=received_args.error_rate,
+        error_statuses=received_args.error_statuses, retry_after=received_args.retry_after,
+        require_auth=received_args.require_auth == "yes", token_lifetime=received_args.token_lifetime,
+        seed_value=received_args.seed
+    )
+    logger.info(f"Mock Nexus Delta listening at {endpoint}, forge configuration at {server.base_url}/forge-config.yml")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
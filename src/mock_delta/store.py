@@ -0,0 +1,655 @@
+"""
+In-memory state of the local Nexus Delta stand-in: projects, resources with their revisions and tags, files,
+a SPARQL dataset per project, holding the latest revision of each resource in its own named graph as Delta's
+default SPARQL view does, and Elastic Search documents.
+
+Payloads are turned into triples with the single MOCK_CONTEXT, whatever the context they declare: it covers the terms
+and prefixes used by the pipelines' queries, and is also what forge sessions get as their model context.
+"""
+import datetime
+import hashlib
+import json
+import re
+import threading
+import uuid
+from functools import cmp_to_key
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote_plus
+
+from rdflib import BNode, Dataset, Literal, URIRef
+from rdflib.namespace import RDF, XSD
+
+NSG = "https://neuroshapes.org/"
+BMO = "https://bbp.epfl.ch/ontologies/core/bmo/"
+NXV = "https://bluebrain.github.io/nexus/vocabulary/"
+SCHEMA = "http://schema.org/"
+PROV = "http://www.w3.org/ns/prov#"
+RDFS = "http://www.w3.org/2000/01/rdf-schema#"
+SKOS = "http://www.w3.org/2004/02/skos/core#"
+OWL = "http://www.w3.org/2002/07/owl#"
+SH = "http://www.w3.org/ns/shacl#"
+
+NEUROSHAPES_CONTEXT_IRI = "https://neuroshapes.org"
+MODEL_CONTEXT_IRI = "https://bbp.epfl.ch/neurosciencegraph/data/neuroshapes"
+METADATA_CONTEXT_IRI = "https://bluebrain.github.io/nexus/contexts/metadata.json"
+
+UNCONSTRAINED_SCHEMA = "https://bluebrain.github.io/nexus/schemas/unconstrained.json"
+MOCK_USER = "mock-user"
+
+# Strings sorted as dates, like values of date fields in Elastic Search
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]|$)")
+
+MOCK_CONTEXT = {
+    "@vocab": NSG,
+    "@base": "https://bbp.epfl.ch/neurosciencegraph/data/",
+    "nsg": NSG, "bmo": BMO, "nxv": NXV, "schema": SCHEMA, "prov": PROV, "rdfs": RDFS, "skos": SKOS, "owl": OWL, "sh": SH,
+    "xsd": str(XSD), "dcat": "http://www.w3.org/ns/dcat#", "dc": "http://purl.org/dc/elements/1.1/",
+    "NCBITaxon": "http://purl.obolibrary.org/obo/NCBITaxon_", "mba": "http://api.brain-map.org/api/v2/data/Structure/",
+    "id": "@id",
+    "type": "@type",
+    "Class": OWL + "Class",
+    "Ontology": OWL + "Ontology",
+    "DataDownload": SCHEMA + "DataDownload",
+    "Dataset": SCHEMA + "Dataset",
+    "Organization": SCHEMA + "Organization",
+    "Person": SCHEMA + "Person",
+    "ExperimentalTrace": BMO + "ExperimentalTrace",
+    "TraceWebDataContainer": BMO + "TraceWebDataContainer",
+    "SingleCellExperimentalTrace": BMO + "SingleCellExperimentalTrace",
+    "ElectricalStimulus": BMO + "ElectricalStimulus",
+    "AtlasRelease": NSG + "AtlasRelease",
+    "BrainAtlasRelease": NSG + "BrainAtlasRelease",
+    "ParcellationOntology": NSG + "ParcellationOntology",
+    "BrainParcellationDataLayer": NSG + "BrainParcellationDataLayer",
+    "name": SCHEMA + "name",
+    "description": SCHEMA + "description",
+    "label": RDFS + "label",
+    "notation": SKOS + "notation",
+    "prefLabel": SKOS + "prefLabel",
+    "altLabel": SKOS + "altLabel",
+    "subClassOf": {"@id": RDFS + "subClassOf", "@type": "@id"},
+    "isDefinedBy": {"@id": RDFS + "isDefinedBy", "@type": "@id"},
+    "isPartOf": {"@id": SCHEMA + "isPartOf", "@type": "@id"},
+    "hasPart": {"@id": SCHEMA + "hasPart", "@type": "@id"},
+    "distribution": SCHEMA + "distribution",
+    "contentUrl": {"@id": SCHEMA + "contentUrl", "@type": "@id"},
+    "encodingFormat": SCHEMA + "encodingFormat",
+    "contentSize": SCHEMA + "contentSize",
+    "digest": NSG + "digest",
+    "value": SCHEMA + "value",
+    "unitCode": SCHEMA + "unitCode",
+    "atLocation": PROV + "atLocation",
+    "contribution": NSG + "contribution",
+    "agent": {"@id": PROV + "agent", "@type": "@id"},
+    "generation": PROV + "qualifiedGeneration",
+    "givenName": SCHEMA + "givenName",
+    "familyName": SCHEMA + "familyName",
+    "annotation": NSG + "annotation",
+    "hasBody": NSG + "hasBody",
+    "hasTarget": NSG + "hasTarget",
+    "image": SCHEMA + "image",
+    "_constrainedBy": {"@id": NXV + "constrainedBy", "@type": "@id"},
+    "_createdAt": {"@id": NXV + "createdAt", "@type": str(XSD.dateTime)},
+    "_createdBy": {"@id": NXV + "createdBy", "@type": "@id"},
+    "_updatedAt": {"@id": NXV + "updatedAt", "@type": str(XSD.dateTime)},
+    "_updatedBy": {"@id": NXV + "updatedBy", "@type": "@id"},
+    "_deprecated": NXV + "deprecated",
+    "_rev": NXV + "rev",
+    "_project": {"@id": NXV + "project", "@type": "@id"},
+    "_self": {"@id": NXV + "self", "@type": "@id"},
+    "_schemaProject": {"@id": NXV + "schemaProject", "@type": "@id"},
+    "_incoming": {"@id": NXV + "incoming", "@type": "@id"},
+    "_outgoing": {"@id": NXV + "outgoing", "@type": "@id"},
+    "_filename": NXV + "filename",
+    "_mediaType": NXV + "mediaType",
+    "_bytes": NXV + "bytes",
+    "_digest": NXV + "digest",
+    "_algorithm": NXV + "algorithm",
+    "_value": NXV + "value",
+}
+
+METADATA_KEYS = [
+    "_constrainedBy", "_createdAt", "_createdBy", "_deprecated", "_incoming", "_outgoing", "_project", "_rev",
+    "_schemaProject", "_self", "_updatedAt", "_updatedBy"
+]
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _expand(term: str, vocab: bool = True) -> str:
+    """
+    Expands a term, a compact IRI or an IRI with MOCK_CONTEXT
+    """
+    definition = MOCK_CONTEXT.get(term, None)
+    if isinstance(definition, dict):
+        return definition["@id"]
+    if isinstance(definition, str) and not term.startswith("@"):
+        return definition
+    if "://" in term:
+        return term
+    if ":" in term:
+        prefix, suffix = term.split(":", 1)
+        if prefix in MOCK_CONTEXT and isinstance(MOCK_CONTEXT[prefix], str):
+            return MOCK_CONTEXT[prefix] + suffix
+    return (MOCK_CONTEXT["@vocab"] if vocab else MOCK_CONTEXT["@base"]) + term
+
+
+def _is_id_valued(key: str) -> bool:
+    definition = MOCK_CONTEXT.get(key, None)
+    return isinstance(definition, dict) and definition.get("@type", None) == "@id"
+
+
+def _literal(key: str, value: Any) -> Literal:
+    definition = MOCK_CONTEXT.get(key, None)
+    datatype = definition.get("@type", None) if isinstance(definition, dict) else None
+    if datatype is not None and datatype != "@id":
+        return Literal(value, datatype=URIRef(datatype))
+    return Literal(value)
+
+
+def payload_to_triples(payload: Dict) -> List[Tuple]:
+    """
+    The triples of a json payload, expanded with MOCK_CONTEXT
+    """
+    triples = []
+
+    def node(obj: Dict):
+        id_ = obj.get("@id", obj.get("id", None))
+        subject = URIRef(_expand(id_, vocab=False)) if isinstance(id_, str) else BNode()
+
+        for key, value in obj.items():
+            if key in ["@id", "id", "@context"]:
+                continue
+            if key in ["@type", "type"]:
+                for type_ in value if isinstance(value, list) else [value]:
+                    triples.append((subject, RDF.type, URIRef(_expand(type_))))
+                continue
+            predicate = URIRef(_expand(key))
+            for v in value if isinstance(value, list) else [value]:
+                if isinstance(v, dict):
+                    if "@value" in v:
+                        triples.append((subject, predicate, Literal(v["@value"])))
+                    else:
+                        triples.append((subject, predicate, node(v)))
+                elif v is None:
+                    continue
+                elif isinstance(v, str) and _is_id_valued(key):
+                    triples.append((subject, predicate, URIRef(_expand(v, vocab=False))))
+                else:
+                    triples.append((subject, predicate, _literal(key, v)))
+        return subject
+
+    node(payload)
+    return triples
+
+
+class MockResource:
+
+    def __init__(self, id_: str, project: str, schema: str, payload: Dict, is_file: bool = False):
+        self.id = id_
+        self.project = project
+        self.schema = schema
+        self.is_file = is_file
+        self.created_at = _now()
+        # One entry per revision: the payload, whether it is deprecated and when it was written
+        self.revisions: List[Dict] = [{"payload": payload, "deprecated": False, "updated_at": self.created_at}]
+        self.tags: Dict[str, int] = {}
+
+    @property
+    def rev(self) -> int:
+        return len(self.revisions)
+
+    def at(self, rev: Optional[int] = None, tag: Optional[str] = None) -> Optional[Dict]:
+        if tag is not None:
+            rev = self.tags.get(tag, None)
+            if rev is None:
+                return None
+        rev = rev or self.rev
+        return self.revisions[rev - 1] if 1 <= rev <= self.rev else None
+
+
+class MockFile:
+
+    def __init__(
+            self, id_: str, project: str, filename: str, media_type: str,
+            content: Optional[bytes] = None, path: Optional[str] = None
+    ):
+        """
+        :param content: the content of the file, or None to read it from path
+        """
+        self.id = id_
+        self.project = project
+        self.filename = filename
+        self.media_type = media_type
+        self.content = content
+        self.path = path
+        self.created_at = _now()
+
+        hasher, size = hashlib.sha256(), 0
+        for chunk in self.iter_content():
+            hasher.update(chunk)
+            size += len(chunk)
+        self.digest = hasher.hexdigest()
+        self.size = size
+
+    def iter_content(self, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        if self.content is not None:
+            yield self.content
+            return
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+
+class MockStore:
+
+    def __init__(self, endpoint: str):
+        """
+        :param endpoint: the base url of the api, e.g. http://localhost:8080/v1
+        """
+        self.endpoint = endpoint
+        self._lock = threading.RLock()
+        self.projects: Dict[str, Dict] = {}
+        self.resources: Dict[str, Dict[str, MockResource]] = {}
+        self.files: Dict[str, Dict[str, MockFile]] = {}
+        self.graphs: Dict[str, Dataset] = {}
+
+    # Urls
+
+    def project_url(self, project: str) -> str:
+        return f"{self.endpoint}/projects/{project}"
+
+    def resource_url(self, project: str, id_: str) -> str:
+        return f"{self.endpoint}/resources/{project}/_/{quote_plus(id_)}"
+
+    def file_url(self, project: str, id_: str) -> str:
+        return f"{self.endpoint}/files/{project}/{quote_plus(id_)}"
+
+    def new_id(self, project: str) -> str:
+        return f"{self.endpoint.rsplit('/v1', 1)[0]}/data/{project}/{uuid.uuid4()}"
+
+    # Projects
+
+    def create_project(self, project: str):
+        with self._lock:
+            if project in self.projects:
+                return
+            org, label = project.split("/")
+            self.projects[project] = {
+                "@context": [METADATA_CONTEXT_IRI, "https://bluebrain.github.io/nexus/contexts/projects.json"],
+                "@id": self.project_url(project),
+                "@type": "Project",
+                "_label": label,
+                "_organizationLabel": org,
+                "_uuid": str(uuid.uuid5(uuid.NAMESPACE_URL, project)),
+                "apiMappings": [],
+                "base": f"{self.endpoint.rsplit('/v1', 1)[0]}/data/{project}/",
+                "vocab": NSG,
+                "description": f"Mock project {project}",
+                "_rev": 1,
+                "_deprecated": False,
+                "_createdAt": _now(),
+                "_createdBy": MOCK_USER,
+                "_updatedAt": _now(),
+                "_updatedBy": MOCK_USER,
+                "_self": self.project_url(project)
+            }
+            self.resources[project] = {}
+            self.files[project] = {}
+            self.graphs[project] = Dataset(default_union=True)
+
+    # Resources
+
+    def metadata(self, resource: MockResource, rev: Optional[int] = None) -> Dict:
+        revision = resource.at(rev)
+        return {
+            "_constrainedBy": resource.schema,
+            "_createdAt": resource.created_at,
+            "_createdBy": f"{self.endpoint}/realms/mock/users/{MOCK_USER}",
+            "_deprecated": revision["deprecated"],
+            "_incoming": f"{self.resource_url(resource.project, resource.id)}/incoming",
+            "_outgoing": f"{self.resource_url(resource.project, resource.id)}/outgoing",
+            "_project": self.project_url(resource.project),
+            "_rev": rev or resource.rev,
+            "_schemaProject": self.project_url(resource.project),
+            "_self": self.resource_url(resource.project, resource.id),
+            "_updatedAt": revision["updated_at"],
+            "_updatedBy": f"{self.endpoint}/realms/mock/users/{MOCK_USER}"
+        }
+
+    def resource_json(self, resource: MockResource, rev: Optional[int] = None, tag: Optional[str] = None) -> Optional[Dict]:
+        """
+        The payload of a revision of a resource, with its metadata, as Delta returns it
+        """
+        if tag is not None:
+            rev = resource.tags.get(tag, None)
+            if rev is None:
+                return None
+        revision = resource.at(rev)
+        if revision is None:
+            return None
+        payload = {k: v for k, v in revision["payload"].items() if k not in ["@id", "id"]}
+        payload.setdefault("@context", [NEUROSHAPES_CONTEXT_IRI, METADATA_CONTEXT_IRI])
+        return {"@id": resource.id, **payload, **self.metadata(resource, rev)}
+
+    def _index(self, resource: MockResource):
+        dataset = self.graphs[resource.project]
+        dataset.remove_graph(URIRef(resource.id))
+
+        data = self.resource_json(resource)
+        data.pop("@context", None)
+        graph = dataset.graph(URIRef(resource.id))
+        for triple in payload_to_triples(data):
+            graph.add(triple)
+
+    def get(self, project: str, id_: str) -> Optional[MockResource]:
+        return self.resources.get(project, {}).get(id_, None)
+
+    def resolve(self, project: str, id_: str) -> Optional[MockResource]:
+        """
+        Looks for a resource in the project first, then in all other projects, as the resolvers of a project do
+        """
+        resource = self.get(project, id_)
+        if resource is not None:
+            return resource
+        return next(
+            (resources[id_] for resources in self.resources.values() if id_ in resources), None
+        )
+
+    def create(self, project: str, payload: Dict, schema: Optional[str] = None, id_: Optional[str] = None) -> MockResource:
+        with self._lock:
+            self.create_project(project)
+            id_ = id_ or payload.get("@id", payload.get("id", None)) or self.new_id(project)
+            if id_ in self.resources[project]:
+                raise KeyError(id_)
+            resource = MockResource(id_, project, schema or UNCONSTRAINED_SCHEMA, payload)
+            self.resources[project][id_] = resource
+            self._index(resource)
+            return resource
+
+    def update(self, resource: MockResource, payload: Dict, rev: int) -> bool:
+        """
+        :return: False if rev isn't the current revision of the resource
+        """
+        with self._lock:
+            if rev != resource.rev:
+                return False
+            resource.revisions.append({"payload": payload, "deprecated": False, "updated_at": _now()})
+            self._index(resource)
+            return True
+
+    def deprecate(self, resource: MockResource, rev: int) -> bool:
+        with self._lock:
+            if rev != resource.rev:
+                return False
+            last = resource.revisions[-1]
+            resource.revisions.append({"payload": last["payload"], "deprecated": True, "updated_at": _now()})
+            self._index(resource)
+            return True
+
+    def tag(self, resource: MockResource, tag: str, rev: int) -> bool:
+        with self._lock:
+            if not 1 <= rev <= resource.rev:
+                return False
+            resource.tags[tag] = rev
+            last = resource.revisions[-1]
+            resource.revisions.append({"payload": last["payload"], "deprecated": last["deprecated"], "updated_at": _now()})
+            self._index(resource)
+            return True
+
+    # Files
+
+    def add_file(
+            self, project: str, filename: str, media_type: str,
+            content: Optional[bytes] = None, path: Optional[str] = None, id_: Optional[str] = None
+    ) -> MockFile:
+        with self._lock:
+            self.create_project(project)
+            file = MockFile(id_ or self.new_id(project), project, filename, media_type, content=content, path=path)
+            self.files[project][file.id] = file
+            return file
+
+    def get_file(self, project: str, id_: str) -> Optional[MockFile]:
+        file = self.files.get(project, {}).get(id_, None)
+        if file is None and id_.startswith(self.endpoint):  # A file addressed by its url
+            file = next((f for files in self.files.values() for f in files.values()
+                         if self.file_url(f.project, f.id) == id_), None)
+        return file
+
+    def file_json(self, file: MockFile) -> Dict:
+        return {
+            "@context": [METADATA_CONTEXT_IRI, "https://bluebrain.github.io/nexus/contexts/files.json"],
+            "@id": file.id,
+            "@type": "File",
+            "_bytes": file.size,
+            "_digest": {"_algorithm": "SHA-256", "_value": file.digest},
+            "_filename": file.filename,
+            "_location": f"file:///mock/{file.project}/{file.digest}",
+            "_mediaType": file.media_type,
+            "_origin": "Client",
+            "_storage": {"@id": "https://bluebrain.github.io/nexus/vocabulary/diskStorageDefault", "@type": "DiskStorage", "_rev": 1},
+            "_constrainedBy": "https://bluebrain.github.io/nexus/schemas/files.json",
+            "_createdAt": file.created_at,
+            "_createdBy": f"{self.endpoint}/realms/mock/users/{MOCK_USER}",
+            "_deprecated": False,
+            "_project": self.project_url(file.project),
+            "_rev": 1,
+            "_self": self.file_url(file.project, file.id),
+            "_updatedAt": file.created_at,
+            "_updatedBy": f"{self.endpoint}/realms/mock/users/{MOCK_USER}"
+        }
+
+    def distribution(self, file: MockFile, encoding_format: Optional[str] = None) -> Dict:
+        """
+        The distribution pointing to a file, as forge.attach makes it
+        """
+        return {
+            "type": "DataDownload",
+            "name": file.filename,
+            "encodingFormat": encoding_format or file.media_type,
+            "contentUrl": self.file_url(file.project, file.id),
+            "contentSize": {"unitCode": "bytes", "value": file.size},
+            "digest": {"algorithm": "SHA-256", "value": file.digest},
+            "atLocation": {"type": "Location", "store": {"id": "https://bluebrain.github.io/nexus/vocabulary/diskStorageDefault", "type": "DiskStorage", "_rev": 1}}
+        }
+
+    # Search
+
+    def es_documents(self, project: str) -> Iterator[Dict]:
+        """
+        The documents of the default Elastic Search view of a project: the latest revision of each resource,
+        with expanded types and its original payload
+        """
+        for resource in list(self.resources.get(project, {}).values()):
+            data = self.resource_json(resource)
+            data.pop("@context", None)
+            types = data.pop("@type", data.pop("type", []))
+            types = types if isinstance(types, list) else [types]
+            yield {
+                **data,
+                "@type": [_expand(t) for t in types],
+                "_original_source": json.dumps(self.resource_json(resource))
+            }
+
+    def sparql(self, project: str, query: str):
+        with self._lock:
+            return self.graphs[project].query(query)
+
+    def __len__(self):
+        return sum(len(resources) for resources in self.resources.values())
+
+
+def _get_path(document: Any, path: str) -> List:
+    """
+    The values at a dotted path of an Elastic Search document, through lists
+    """
+    values = [document]
+    for key in path.replace(".keyword", "").split("."):
+        next_values = []
+        for value in values:
+            for v in value if isinstance(value, list) else [value]:
+                if isinstance(v, dict) and key in v:
+                    item = v[key]
+                    next_values.extend(item if isinstance(item, list) else [item])
+        values = next_values
+    return values
+
+
+def _matches_value(values: List, expected: Any, field: str) -> bool:
+    if field in ["@type", "type"] and isinstance(expected, str):
+        expected_values = {expected, _expand(expected)}
+        return any(v in expected_values for v in values)
+    return expected in values
+
+
+def es_match(document: Dict, query: Dict) -> bool:
+    """
+    Whether a document matches an Elastic Search query. Supports match_all, bool, term, terms, match, exists,
+    range, ids and wildcard queries
+    """
+    if not query or "match_all" in query:
+        return True
+
+    if "bool" in query:
+        clauses = query["bool"]
+
+        def as_list(c):
+            return c if isinstance(c, list) else [c]
+
+        must = as_list(clauses.get("must", [])) + as_list(clauses.get("filter", []))
+        if not all(es_match(document, q) for q in must):
+            return False
+        if any(es_match(document, q) for q in as_list(clauses.get("must_not", []))):
+            return False
+        should = as_list(clauses.get("should", []))
+        minimum = clauses.get("minimum_should_match", 1 if should and not must else 0)
+        return sum(es_match(document, q) for q in should) >= minimum
+
+    kind, body = next(iter(query.items()))
+    if kind == "ids":
+        return document.get("@id", None) in body["values"]
+    field, condition = next(iter(body.items()))
+    values = _get_path(document, field)
+
+    if kind == "term":
+        expected = condition["value"] if isinstance(condition, dict) else condition
+        return _matches_value(values, expected, field)
+    if kind == "terms":
+        return any(_matches_value(values, expected, field) for expected in condition)
+    if kind in ["match", "match_phrase"]:
+        expected = str(condition["query"] if isinstance(condition, dict) else condition).lower()
+        return any(expected in str(v).lower() for v in values)
+    if kind == "exists":
+        return len(_get_path(document, condition)) > 0
+    if kind == "wildcard":
+        import fnmatch
+        pattern = condition["value"] if isinstance(condition, dict) else condition
+        return any(fnmatch.fnmatch(str(v), pattern) for v in values)
+    if kind == "range":
+        checks = {"gt": lambda a, b: a > b, "gte": lambda a, b: a >= b, "lt": lambda a, b: a < b, "lte": lambda a, b: a <= b}
+        return any(all(checks[op](v, bound) for op, bound in condition.items() if op in checks) for v in values)
+
+    raise ValueError(f"Unsupported Elastic Search query {kind}")
+
+
+def _es_sort_value(value) -> Optional[Tuple[int, Any]]:
+    """
+    Returns a value comparable with other sort values: numbers (and booleans) compare as numbers,
+    dates as epoch milliseconds like Elastic Search returns them, other values as strings, after numbers
+    """
+    if value is None:
+        return None
+    if isinstance(value, (bool, int, float)):
+        return 0, value if not isinstance(value, bool) else int(value)
+    text = str(value)
+    if ISO_DATE.match(text):
+        try:
+            date = datetime.datetime.fromisoformat(text.replace("Z", "+00:00"))
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=datetime.timezone.utc)
+            return 0, int(date.timestamp() * 1000)
+        except ValueError:
+            pass
+    return 1, text
+
+
+def _compare_sort_values(value, other, order: str) -> int:
+    """
+    Compares two sort values in the order of a field, documents missing the field come last in both orders
+    """
+    if value == other:
+        return 0
+    if value is None or other is None:
+        return 1 if value is None else -1
+    c = -1 if value < other else 1
+    return c if order == "asc" else -c
+
+
+def es_search(documents: Iterator[Dict], body: Dict) -> Dict:
+    """
+    Runs an Elastic Search query body (query, sort, search_after, from, size, _source) on documents
+    """
+    hits = [d for d in documents if es_match(d, body.get("query", {}))]
+
+    sort = body.get("sort", [])
+    sort = sort if isinstance(sort, list) else [sort]
+    sort_keys = []
+    for s in sort:
+        field, order = (s, "asc") if isinstance(s, str) else next(iter(s.items()))
+        order = order.get("order", "asc") if isinstance(order, dict) else order
+        sort_keys.append((field, order))
+
+    def sort_value(document: Dict, field: str):
+        values = _get_path(document, field)
+        return _es_sort_value(values[0]) if values else None
+
+    def compare(values: List, other_values: List) -> int:
+        for (_, order), v, o in zip(sort_keys, values, other_values):
+            c = _compare_sort_values(v, o, order)
+            if c != 0:
+                return c
+        return 0
+
+    values = dict((id(d), [sort_value(d, field) for field, _ in sort_keys]) for d in hits)
+    hits.sort(key=cmp_to_key(lambda d, e: compare(values[id(d)], values[id(e)])))
+
+    # As Elastic Search does, the total counts all matches, whatever the page search_after points to
+    total = len(hits)
+
+    if "search_after" in body and sort_keys:
+        after = [_es_sort_value(v) for v in body["search_after"]]
+        hits = [d for d in hits if compare(values[id(d)], after) > 0]
+
+    start = body.get("from", 0)
+    hits = hits[start: start + body.get("size", 10)]
+
+    source = body.get("_source", True)
+
+    def project(document: Dict) -> Dict:
+        if source is True:
+            return document
+        if source is False:
+            return {}
+        fields = source if isinstance(source, list) else source.get("includes", [])
+        return dict((k, v) for k, v in document.items() if k in fields)
+
+    return {
+        "took": 0,
+        "timed_out": False,
+        "hits": {
+            "total": {"value": total, "relation": "eq"},
+            "max_score": None,
+            "hits": [
+                {
+                    "_index": "mock", "_id": d["@id"], "_score": None, "_source": project(d),
+                    **({"sort": [v[1] if v is not None else None for v in values[id(d)]]} if sort_keys else {})
+                }
+                for d in hits
+            ]
+        }
+    }
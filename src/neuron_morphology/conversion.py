@@ -0,0 +1,162 @@
+"""
+Conversion of morphologies between formats (swc, asc, h5) with morph_tool, across a process pool.
+
+A manifest records, for every output file, the digest of the source it was converted from:
+an output whose source hasn't changed since its last conversion is not converted again.
+A failing conversion is recorded and doesn't stop the conversion of the other files.
+Conversions are applied to the manifest as it is on disk when it is saved, so that concurrent writers
+don't overwrite each other's entries.
+"""
+import fcntl
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from morph_tool.converter import convert
+
+from src.helpers import CACHE_DIRECTORY, get_file_digest
+from src.logger import logger
+
+CONVERSION_MANIFEST_FILENAME = "conversion_manifest.json"
+
+
+def _load_manifest(manifest_path: str) -> Dict[str, str]:
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        logger.warning(f"Conversion manifest {manifest_path} is corrupted, all files will be converted")
+        return {}
+
+
+def _save_manifest(done: Dict[str, str], failed: Iterable[str], manifest_path: str):
+    """
+    Records converted outputs and drops failed ones from the manifest as it currently is on disk,
+    writing it to a temporary file of this writer first. Writers hold an exclusive lock on the lock file of the manifest
+    from loading it to replacing it, so that concurrent runs converting into the same manifest don't drop each other's
+    entries
+    """
+    with open(f"{manifest_path}.lock", "a") as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            manifest = _load_manifest(manifest_path)
+            manifest.update(done)
+            for out_path in failed:
+                manifest.pop(out_path, None)
+
+            tmp_path = f"{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(manifest, f, indent=2)
+                os.replace(tmp_path, manifest_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+
+def _convert_one(src_path: str, outputs: List[Tuple[str, Optional[str]]]) -> Tuple[str, Dict[str, str], Dict[str, str]]:
+    """
+    Converts a source file into each output whose recorded source digest differs from the current one
+
+    :param outputs: a list of (output path, digest of the source the output was last converted from)
+    :return: the source path, the outputs that were converted or up-to-date, with the digest
+    of their source, and the outputs whose conversion failed, with the error message
+    """
+    try:
+        digest = get_file_digest(src_path)
+    except OSError as e:
+        return src_path, {}, dict((out, str(e)) for out, _ in outputs)
+
+    done, failed = {}, {}
+    for out_path, previous_digest in outputs:
+        if previous_digest == digest and os.path.isfile(out_path):
+            done[out_path] = digest
+            continue
+        try:
+            convert(src_path, out_path)
+            done[out_path] = digest
+        except Exception as e:
+            failed[out_path] = f"{type(e).__name__}: {e}"
+
+    return src_path, done, failed
+
+
+def convert_morphologies(
+        conversions: Dict[str, List[str]], n_processes: Optional[int] = None, manifest_path: Optional[str] = None,
+        on_converted: Optional[Callable[[List[str]], None]] = None
+) -> Dict[str, str]:
+    """
+    Converts each source morphology into its output paths (the format being given by their extension),
+    skipping outputs that are up-to-date with their source.
+
+    :param conversions: source path -> output paths
+    :param n_processes: the number of conversion processes, defaults to the number of cpus
+    :param manifest_path: where source digests of the outputs are recorded,
+    defaults to CONVERSION_MANIFEST_FILENAME in CACHE_DIRECTORY
+    :param on_converted: called, in this process, with the outputs of each source that were converted or are up-to-date,
+    as soon as the source is done
+    :return: output path -> error message, for every conversion that failed
+    """
+    if manifest_path is None:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        manifest_path = os.path.join(CACHE_DIRECTORY, CONVERSION_MANIFEST_FILENAME)
+
+    manifest = _load_manifest(manifest_path)
+
+    jobs = [
+        (src_path, [(os.path.abspath(out), manifest.get(os.path.abspath(out), None)) for out in outputs])
+        for src_path, outputs in conversions.items()
+    ]
+
+    failures = {}
+    pending_done, pending_failed = {}, set()
+
+    if n_processes == 1 or len(jobs) <= 1:
+        results = (_convert_one(*job) for job in jobs)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_processes)
+        results = executor.map(_convert_one, *zip(*jobs), chunksize=8)
+
+    try:
+        for i, (src_path, done, failed) in enumerate(results):
+            pending_done.update(done)
+            pending_failed.difference_update(done)
+            for out_path, error in failed.items():
+                pending_done.pop(out_path, None)
+                pending_failed.add(out_path)
+                logger.error(f"Failed to convert {src_path} into {out_path}: {error}")
+            failures.update(failed)
+            if on_converted is not None and len(done) > 0:
+                on_converted(list(done.keys()))
+
+            if (i + 1) % 500 == 0:
+                logger.info(f"Converted {i + 1}/{len(jobs)} morphologies")
+                _save_manifest(pending_done, pending_failed, manifest_path)
+                pending_done, pending_failed = {}, set()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if pending_done or pending_failed:
+            _save_manifest(pending_done, pending_failed, manifest_path)
+
+    logger.info(f"Conversion of {len(jobs)} morphologies done, {len(failures)} failed conversions")
+
+    return failures
+
+
+def convert_morphology(src_path: str, out_paths: Union[str, List[str]], manifest_path: Optional[str] = None):
+    """
+    Converts a single morphology into one or several outputs, unless they are up-to-date with their source.
+    The manifest is saved once for all outputs. Raises a ValueError if a conversion fails
+    """
+    out_paths = [out_paths] if isinstance(out_paths, str) else out_paths
+    failures = convert_morphologies({src_path: out_paths}, n_processes=1, manifest_path=manifest_path)
+    if failures:
+        raise ValueError("\n".join(f"{out_path}: {error}" for out_path, error in failures.items()))
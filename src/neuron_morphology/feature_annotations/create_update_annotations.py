@@ -8,7 +8,7 @@ import json
 
 from kgforge.core import Resource, KnowledgeGraphForge
 
-from src.helpers import allocate_by_deployment, DEFAULT_ES_VIEW, DEFAULT_SPARQL_VIEW, Deployment, authenticate_from_parser_arguments
+from src.helpers import allocate_by_deployment, DEFAULT_ES_VIEW, DEFAULT_SPARQL_VIEW, Deployment, authenticate_from_parser_arguments, init_run
 from src.logger import logger
 from src.neuron_morphology.arguments import define_morphology_arguments
 
@@ -251,6 +251,7 @@ if __name__ == '__main__':
     org, project = received_args.bucket.split("/")
     output_dir = received_args.output_dir
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     limit = received_args.limit
@@ -17,7 +17,6 @@ from typing import List, Dict, Tuple, Any, Union
 
 import numpy
 import numpy as np
-import json
 import os
 import nrrd
 import cProfile
@@ -29,6 +28,7 @@ from nptyping.ndarray import NDArray
 from nrrd import NRRDHeader
 
 from src.arguments import default_output_dir
+from src.brain_region_index import BrainRegionIndex
 from src.helpers import write_obj, get_path
 
 from neurom import NeuriteType
@@ -309,24 +309,14 @@ def output_soma_number_of_point_as_annotation_body(nb: int) -> AnnotationBody:
     )
 
 
-def index_brain_region_labels(br_ontology: str) -> Dict[str, str]:
+def index_brain_region_labels(br_ontology: str) -> Dict[int, str]:
     """
   This function is in charge of making a flat index of brain regions
   in a key-value form (dictionary) where the keys are brain region IDs
-  and the values are brain region labels
+  and the values are brain region labels. The index is the one of BrainRegionIndex,
+  persisted next to the ontology file
   """
-    # onto_str = open(br_ontology).read()
-    with open(br_ontology, "r") as f:
-        node_stack = json.loads(f.read())["msg"]
-
-    index = {}
-
-    while len(node_stack):
-        node = node_stack.pop()
-        node_stack = node_stack + node["children"]
-        index[node["id"]] = node["name"]
-
-    return index
+    return BrainRegionIndex.build_or_load(br_ontology).id_to_label()
 
 
 # TODO use the same function as quality metrics: src/get_atlas.py
@@ -1,55 +1,115 @@
 import argparse
-from typing import Dict, Tuple, List, Union, Optional
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Tuple, List, Union, Optional
 
-import cachetools
 import copy
 from datetime import datetime, timedelta
 import glob
 import json
 from kgforge.core import KnowledgeGraphForge, Resource
-from src.helpers import allocate_by_deployment, ASSETS_DIRECTORY, _as_list, authenticate_from_parser_arguments
-from morph_tool.converter import convert
+from src.brain_region_index import BrainRegionIndex, DEFAULT_BRAIN_REGION_ONTOLOGY
+from src.helpers import allocate_by_deployment, ASSETS_DIRECTORY, CACHE_DIRECTORY, _as_list, \
+    authenticate_from_parser_arguments, init_run, get_file_digest
+from src.resolve_cache import get_resolve_cache
+from src.neuron_morphology.conversion import convert_morphologies
 import numpy as np
 import os
 import pandas as pd
 import re
 import shutil
+import tempfile
 import zipfile
 
 from src.logger import logger
+from src.metrics import PARSE, get_run_metrics
 from src.neuron_morphology.arguments import define_morphology_arguments
 from src.neuron_morphology.creation_helpers import get_generation, get_contribution
 
 
 strategy = 'EXACT_CASE_INSENSITIVE_MATCH'
 MORPHOLOGY_EXTENSIONS = ['swc', 'asc', 'h5']
+REGISTRATION_JOURNAL_FILENAME = 'registration_journal_{deployment}_{org}_{project}.jsonl'
 
 
-def extract_zip(zip_file_path: str, dst_dir: str, re_extract: bool):
+def _extracted_root(zip_file_path: str, dst_dir: str) -> str:
+    """
+    The folder the content of the archive is extracted into, named after the archive
+    """
+    filename, _ = os.path.splitext(os.path.basename(zip_file_path))
+    return os.path.join(dst_dir, filename)
+
+
+def _extract_members(zip_ref: zipfile.ZipFile, dst_dir: str, on_extracted: Optional[Callable[[str], None]]):
+    for member in zip_ref.infolist():
+        path = zip_ref.extract(member, dst_dir)
+        if on_extracted is not None and not member.is_dir():
+            on_extracted(path)
+
+
+def _extract_nested_zip(
+        zip_ref: zipfile.ZipFile, member: zipfile.ZipInfo, dst_dir: str, on_extracted: Optional[Callable[[str], None]] = None
+):
+    """
+    Extracts the content of an archive contained in zip_ref into dst_dir, without writing the archive itself to disk.
+    A compressed archive member is spooled to a temporary file first, since reading its own members requires seeking
+    """
+    with zip_ref.open(member) as nested_f:
+        if member.compress_type == zipfile.ZIP_STORED:
+            with zipfile.ZipFile(nested_f) as nested_ref:
+                _extract_members(nested_ref, dst_dir, on_extracted)
+            return
+
+        with tempfile.TemporaryFile() as tmp_f:
+            shutil.copyfileobj(nested_f, tmp_f, length=1 << 20)
+            tmp_f.seek(0)
+            with zipfile.ZipFile(tmp_f) as nested_ref:
+                _extract_members(nested_ref, dst_dir, on_extracted)
+
+
+def extract_zip(zip_file_path: str, dst_dir: str, re_extract: bool, on_extracted: Optional[Callable[[str], None]] = None):
+    """
+    Extracts the archive into dst_dir. The archives (one per mouse id) directly in the folder named after the archive
+    are extracted into that folder, without being written to disk themselves, other members are extracted as they are
+
+    :param on_extracted: called with the path of each file extracted
+    :return: the folder named after the archive, and all the folders in it
+    """
+    zip_files_per_brain = _extracted_root(zip_file_path, dst_dir)
+    filename = os.path.basename(zip_files_per_brain)
 
     if re_extract:
         with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            zip_ref.extractall(dst_dir)
-
-    filename, _ = os.path.splitext(os.path.basename(zip_file_path))
-    zip_files_per_brain = os.path.join(dst_dir, filename)
-    brains = list(glob.iglob(os.path.join(zip_files_per_brain, "*.zip")))
+            members = zip_ref.infolist()
+            brains = [m for m in members if os.path.dirname(m.filename) == filename and m.filename.endswith(".zip")]
 
-    logger.info(f"Extracting {len(brains)} archives (per mouse id)")
+            logger.info(f"Extracting {len(brains)} archives (per mouse id)")
 
-    for f_path in brains:
-        with zipfile.ZipFile(f_path, 'r') as zip_ref:
-            if re_extract:
-                logger.info(f"Extracting archive {f_path}")
-                zip_ref.extractall(zip_files_per_brain)
-                os.remove(f_path)
+            for member in members:
+                if member in brains:
+                    logger.info(f"Extracting archive {member.filename}")
+                    _extract_nested_zip(zip_ref, member, zip_files_per_brain, on_extracted)
+                else:
+                    path = zip_ref.extract(member, dst_dir)
+                    if on_extracted is not None and not member.is_dir():
+                        on_extracted(path)
 
     directories = [x[0] for x in os.walk(zip_files_per_brain)]
     return zip_files_per_brain, directories
 
 
-def convert_swcs(dst_folders: List[str], re_convert: bool) -> Dict:
+def convert_swcs(
+        dst_folders: List[str], re_convert: bool, n_processes: Optional[int] = None,
+        on_converted: Optional[Callable[[List[str]], None]] = None
+) -> Tuple[Dict, Dict]:
+    """
+    Collects the swc files of dst_folders and converts them into the other morphology formats, next to them.
+    Returns the swc files by morphology name, and the error message of every failed conversion by output file
+
+    :param on_converted: called with the outputs of each swc file as soon as it is converted
+    """
     name_to_file = {}
+    conversions = {}
 
     start_format = 'swc'  # the format of the delivery, to convert from
     other_formats = [i for i in MORPHOLOGY_EXTENSIONS if i != start_format]
@@ -64,16 +124,20 @@ def convert_swcs(dst_folders: List[str], re_convert: bool) -> Dict:
 
             name_to_file[basename] = f_path
 
-            for out_format in other_formats:
-                outfile = os.path.join(fol, f"{basename}.{out_format}")
+            outfiles = [os.path.join(fol, f"{basename}.{out_format}") for out_format in other_formats]
+
+            if re_convert:
+                conversions[f_path] = outfiles
+            else:
+                for outfile in outfiles:
+                    if not os.path.isfile(outfile):
+                        logger.error(f"Converting {f_path} into {outfile} needs to happen, but re-convert was set to False")
 
-                if re_convert:
-                    logger.info(f"Converting {f_path} into format {out_format}")
-                    convert(f_path, outfile)
-                elif not os.path.isfile(outfile):
-                    logger.error(f"Converting {f_path} into format {out_format} needs to happen, but re-convert was set to False")
+    with get_run_metrics().stage(PARSE):
+        failures = convert_morphologies(conversions, n_processes=n_processes, on_converted=on_converted) if re_convert else {}
+    get_run_metrics().increment("morphologies_converted", len(conversions) - len(failures) if re_convert else 0)
 
-    return name_to_file
+    return name_to_file, failures
 
 
 def load_excel_file(folder: str) -> pd.DataFrame:
@@ -119,9 +183,17 @@ with open(os.path.join(ASSETS_DIRECTORY, "ordered_columns.json"), "r") as f:
     columns_ordered = json.load(f)
 
 
-@cachetools.cached(cache=cachetools.LRUCache(maxsize=100))
 def cacheresolve(text, forge, scope='ontology', strategy='EXACT_MATCH', target=None):
-    return forge.resolve(text=text, scope=scope, strategy=strategy, target=target)
+    return get_resolve_cache().resolve(forge, text=text, scope=scope, strategy=strategy, target=target)
+
+
+def resolve_brain_region(text: str, forge: KnowledgeGraphForge, brain_region_index: Optional[BrainRegionIndex] = None):
+    """Resolves a brain region against the local index first, then through forge if not found"""
+    if brain_region_index is not None:
+        region = brain_region_index.resolve(text, strategy=strategy)
+        if region is not None:
+            return region
+    return cacheresolve(text=text, forge=forge, scope='ontology', strategy=strategy, target='BrainRegion')
 
 
 def make_dict(
@@ -164,11 +236,14 @@ def _get_strain(row_strain: str, i: int, forge: KnowledgeGraphForge) -> Tuple[Op
         return {"label": resolved_strain.label, "id": resolved_strain.id}, None, True
 
 
-def _get_layer(row_layer, i: int, brain_loc_label: str, forge: KnowledgeGraphForge) -> Tuple[Optional[Union[Dict, List]], Optional[str], bool]:
+def _get_layer(
+        row_layer, i: int, brain_loc_label: str, forge: KnowledgeGraphForge,
+        brain_region_index: Optional[BrainRegionIndex] = None
+) -> Tuple[Optional[Union[Dict, List]], Optional[str], bool]:
     '''Value if it's there, error message if it's there, whether to register or not'''
     def find_layer(row_layer):
         text = f"layer {row_layer}"
-        return cacheresolve(text=text, forge=forge, scope='ontology', strategy=strategy, target='BrainRegion')
+        return resolve_brain_region(text=text, forge=forge, brain_region_index=brain_region_index)
     
     if pd.isna(row_layer):
         return None, None, True
@@ -183,18 +258,24 @@ def _get_layer(row_layer, i: int, brain_loc_label: str, forge: KnowledgeGraphFor
     return {'id':layer.id, 'label':layer.label}, None, True
 
 
-def _get_brain_region(row_br: str, row_layer, i: int, forge: KnowledgeGraphForge) -> Tuple[Optional[Dict], Optional[str], bool]:
-    brain_reg = cacheresolve(text=row_br, forge=forge, scope='ontology', strategy=strategy, target='BrainRegion')
+def _get_brain_region(
+        row_br: str, row_layer, i: int, forge: KnowledgeGraphForge,
+        brain_region_index: Optional[BrainRegionIndex] = None
+) -> Tuple[Optional[Dict], Optional[str], bool]:
+    brain_reg = resolve_brain_region(text=row_br, forge=forge, brain_region_index=brain_region_index)
     if brain_reg is None:
         return None, f"could not resolve brain location = \"{row_br}\" for row {i}", False
     # return {"label": brain_loc.label, "id": brain_loc.id}, None, True
     text = f"{brain_reg.label}, layer {row_layer}"
-    brain_reg_spec = cacheresolve(text=text, forge=forge, scope='ontology', strategy=strategy, target='BrainRegion')
+    brain_reg_spec = resolve_brain_region(text=text, forge=forge, brain_region_index=brain_region_index)
     if brain_reg_spec is None:
         return {'id': brain_reg.id, 'label': brain_reg.label}, None, True
     return {'id': brain_reg_spec.id, 'label': brain_reg_spec.label}, None, True
 
-def do(metadata: pd.DataFrame, name_to_file: Dict, forge: KnowledgeGraphForge) -> Tuple[List[Dict], Dict, Dict]:
+def do(
+        metadata: pd.DataFrame, name_to_file: Dict, forge: KnowledgeGraphForge,
+        brain_region_index: Optional[BrainRegionIndex] = None
+) -> Tuple[List[Dict], Dict, Dict]:
     nrows = []
     incomplete, not_done = {}, {}
 
@@ -226,11 +307,14 @@ def do(metadata: pd.DataFrame, name_to_file: Dict, forge: KnowledgeGraphForge) -
         append_errors(register_strain, err_str_strain, i)
 
         row_layer = row['Layer\n(1,2, 3, etc.)']
-        brain_region, err_str_br, register_br = _get_brain_region(row['Brain Region'], row_layer, i, forge)
+        brain_region, err_str_br, register_br = _get_brain_region(
+            row['Brain Region'], row_layer, i, forge, brain_region_index=brain_region_index
+        )
         append_errors(register_br, err_str_br, i)
 
         layer_value, err_str_layer, register_layer = _get_layer(
-            row_layer, i, brain_region["label"] if brain_region else None, forge=forge
+            row_layer, i, brain_region["label"] if brain_region else None, forge=forge,
+            brain_region_index=brain_region_index
         )
         append_errors(register_layer, err_str_layer, i)
 
@@ -287,6 +371,120 @@ def make_catalog_resource(name: str, description: str, zip_file_path: str, forge
     return datacatalog
 
 
+def _journal_key(nrow: Dict) -> str:
+    swc_path = next((p for p in nrow['distribution'] if p.endswith(".swc")), None)
+    if swc_path is None:
+        raise ValueError(f"Morphology {nrow['name']} has no swc file, it can't be journaled: {nrow['distribution']}")
+    return f"{nrow['name']}:{get_file_digest(swc_path)}"
+
+
+def load_registration_journal(journal_path: str) -> Dict[str, str]:
+    """
+    Returns the ids of the morphologies already registered, by name and swc digest.
+    An incomplete last line, written by an interrupted run, is ignored
+    """
+    journal = {}
+    if not os.path.isfile(journal_path):
+        return journal
+
+    with open(journal_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            journal[entry["key"]] = entry["id"]
+
+    return journal
+
+
+def _register_chunk(
+        nrows: List[Dict], forge: KnowledgeGraphForge, schema_id: str
+) -> Tuple[List[Resource], Optional[Exception]]:
+    """
+    :return: the resources of the chunk, and the error registration raised if it did.
+    Resources registered before the error are synchronized, and can be journaled
+    """
+    loop = asyncio.new_event_loop()  # forge's batch requests need an event loop in this thread
+    asyncio.set_event_loop(loop)
+    try:
+        df = pd.DataFrame([dict((k, v) for k, v in nrow.items() if k != 'distribution') for nrow in nrows])
+        resources = _as_list(forge.from_dataframe(df.reindex(columns=columns_ordered), na=np.nan, nesting="."))
+
+        for resource, nrow in zip(resources, nrows):
+            resource.distribution = [
+                forge.attach(path, content_type=f"application/{os.path.splitext(path)[1][1:]}")
+                for path in nrow['distribution']
+            ]
+
+        try:
+            forge.register(resources, schema_id=schema_id)
+        except Exception as e:
+            return resources, e
+        return resources, None
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def register_checkpointed(
+        nrows: List[Dict], forge: KnowledgeGraphForge, journal_path: str,
+        schema_id: str = "datashapes:neuronmorphology", chunk_size: int = 50, n_workers: int = 4
+) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Registers the morphologies in chunks, recording each registered morphology in a journal
+    as soon as its chunk is done. Morphologies found in the journal (same name and same swc content)
+    are not registered again, so that an interrupted registration can be resumed.
+
+    :param n_workers: the maximum number of chunks being registered at the same time
+    :return: the ids of all registered morphologies, and the names of the ones that failed with the reason
+    """
+    journal = load_registration_journal(journal_path)
+
+    keys = [_journal_key(nrow) for nrow in nrows]
+    pending = [(key, nrow) for key, nrow in zip(keys, nrows) if key not in journal]
+
+    logger.info(f"{len(nrows) - len(pending)} morphologies already registered according to {journal_path}, "
+                f"{len(pending)} to register")
+
+    chunks = [pending[i: i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    failed = {}
+
+    with open(journal_path, "a") as journal_f, ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = dict(
+            (executor.submit(_register_chunk, [nrow for _, nrow in chunk], forge, schema_id), chunk)
+            for chunk in chunks
+        )
+
+        for i, future in enumerate(as_completed(futures)):
+            chunk = futures[future]
+            try:
+                resources, error = future.result()
+            except Exception as e:  # Failed before registration, none of the chunk is registered
+                for _, nrow in chunk:
+                    failed[nrow['name']] = str(e)
+                logger.error(f"Failed to prepare chunk of {len(chunk)} morphologies: {e}")
+                continue
+
+            if error is not None:
+                logger.error(f"Registration of a chunk of {len(chunk)} morphologies failed midway: {error}")
+
+            # Morphologies registered before a failure of their chunk are journaled too, not to be registered twice
+            for (key, nrow), resource in zip(chunk, resources):
+                if getattr(resource, "_synchronized", False):
+                    journal[key] = resource.id
+                    journal_f.write(json.dumps({"key": key, "name": nrow['name'], "id": resource.id}) + "\n")
+                else:
+                    last_action = getattr(resource, "_last_action", None)
+                    failed[nrow['name']] = str(last_action.message) if last_action else str(error or "Not registered")
+
+            journal_f.flush()
+            os.fsync(journal_f.fileno())
+            logger.info(f"Registered {i + 1}/{len(chunks)} chunks")
+
+    return [journal[key] for key in keys if key in journal], failed
+
+
 def to_excel(dst_path: str, dataframe: pd.DataFrame):
     writer = pd.ExcelWriter(dst_path, engine='xlsxwriter')
     dataframe.to_excel(writer, index=False, sheet_name='Sheet1')
@@ -297,39 +495,81 @@ def to_excel(dst_path: str, dataframe: pd.DataFrame):
     writer.close()
 
 
-def zip_output(working_directory: str, dst_root_folder: str, processed_metadata_file_path: str, log_path: str, zip_path: str):
-    logger.info(f"Zipping output into {zip_path}.zip")
-    to_zip_folder = os.path.join(working_directory, 'to_zip')
-    os.makedirs(to_zip_folder, exist_ok=True)
-    shutil.copytree(dst_root_folder, to_zip_folder, dirs_exist_ok=True)
-    shutil.copy(processed_metadata_file_path, to_zip_folder)
-    shutil.copy(log_path, to_zip_folder)
-    shutil.make_archive(zip_path, 'zip', to_zip_folder)
-    shutil.rmtree(to_zip_folder)
+class OutputArchive:
+    """
+    The archive {zip_path}.zip of the output, files being added as soon as they are produced (extracted, converted)
+    rather than in one pass at the end. Files of root_folder are stored relative to it
+    """
+
+    def __init__(self, zip_path: str, root_folder: str):
+        self.path = f"{zip_path}.zip"
+        self.root_folder = root_folder
+        self._added = set()
+        logger.info(f"Zipping output into {self.path}")
+        self._zip_ref = zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    def add(self, file_path: str, arcname: Optional[str] = None):
+        """
+        Adds a file, once. Files outside root_folder are only added if given an arcname
+        """
+        if arcname is None:
+            arcname = os.path.relpath(file_path, self.root_folder)
+            if arcname.startswith(os.pardir):
+                return
+        if arcname in self._added:
+            return
+        self._zip_ref.write(file_path, arcname=arcname)
+        self._added.add(arcname)
+
+    def add_many(self, file_paths: List[str]):
+        for file_path in file_paths:
+            self.add(file_path)
+
+    def add_tree(self):
+        """
+        Adds the files of root_folder that weren't added as they were produced, e.g. produced by an earlier run
+        """
+        for folder, _, files in os.walk(self.root_folder):
+            for file in sorted(files):
+                self.add(os.path.join(folder, file))
+
+    def close(self):
+        self._zip_ref.close()
 
 
 if __name__ == "__main__":
     parser = define_morphology_arguments(argparse.ArgumentParser())
+    parser.add_argument(
+        "--journal_path", help="Path of the registration journal. It must outlive the output directory for an "
+                               "interrupted registration to be resumed, defaults to a journal per deployment and "
+                               "bucket in the cache directory",
+        type=str, default=None
+    )
     received_args, leftovers = parser.parse_known_args()
     working_directory = os.path.join(os.getcwd(), received_args.output_dir)
     os.makedirs(working_directory, exist_ok=True)
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     original_zip_file = os.path.join(ASSETS_DIRECTORY, "2nd_delivery_SEU_01162024.zip")
 
     local_test = False
+    dst_directory = os.path.join(os.getcwd(), "output") if local_test else working_directory
+
+    # Extracted and converted files are archived as they are produced
+    archive = OutputArchive(os.path.join(working_directory, "morphologies"), _extracted_root(original_zip_file, dst_directory))
 
     if local_test:
-        dst_directory = os.path.join(os.getcwd(), "output")
         dst_root_folder, dst_folders = extract_zip(zip_file_path=original_zip_file, dst_dir=dst_directory, re_extract=False)
         logger.info("Converting swc files into other extensions")
-        name_to_file = convert_swcs(dst_folders, re_convert=False)
+        name_to_file, conversion_failures = convert_swcs(dst_folders, re_convert=False)
     else:
-        dst_directory = working_directory
-        dst_root_folder, dst_folders = extract_zip(zip_file_path=original_zip_file, dst_dir=working_directory, re_extract=True)
+        dst_root_folder, dst_folders = extract_zip(
+            zip_file_path=original_zip_file, dst_dir=working_directory, re_extract=True, on_extracted=archive.add
+        )
         logger.info("Converting swc files into other extensions")
-        name_to_file = convert_swcs(dst_folders, re_convert=True)
+        name_to_file, conversion_failures = convert_swcs(dst_folders, re_convert=True, on_converted=archive.add_many)
 
     print(f'Working on {len(name_to_file)} morphologies')
     metadata = load_excel_file(dst_root_folder)
@@ -348,12 +588,18 @@ if __name__ == "__main__":
 
     excel_file = 'processed_metadata.xlsx'  # the final filepath for processed metadata
 
-    nrows, incomplete, not_done = do(metadata, name_to_file, forge_instance)
+    brain_region_index = BrainRegionIndex.build_or_load(DEFAULT_BRAIN_REGION_ONTOLOGY)
+
+    forge_datamodels = allocate_by_deployment("neurosciencegraph", "datamodels", token=auth_token, deployment=deployment)
+    for target in ["BrainRegion", "Strain"]:
+        get_resolve_cache().warm_up(forge_datamodels, target)
+
+    nrows, incomplete, not_done = do(metadata, name_to_file, forge_instance, brain_region_index=brain_region_index)
 
     log_path = os.path.join(working_directory, 'log.json')
 
     with open(log_path, 'w') as f:
-        json.dump({'not registered': not_done, 'incomplete': incomplete}, f, indent=2)
+        json.dump({'not registered': not_done, 'incomplete': incomplete, 'conversion failed': conversion_failures}, f, indent=2)
 
     logger.info(f'Written log of incomplete data and not registered morphologies in {log_path}')
 
@@ -364,16 +610,21 @@ if __name__ == "__main__":
 
     to_excel(processed_metadata_file_path, df)
 
-    zip_path = os.path.join(working_directory, "morphologies")
-    zip_output(working_directory, dst_root_folder, processed_metadata_file_path, log_path, zip_path=zip_path)
+    archive.add_tree()
+    for file_path in [processed_metadata_file_path, log_path]:
+        archive.add(file_path, arcname=os.path.basename(file_path))
+    archive.close()
 
-    # resources = forge_instance.from_dataframe(df, na=np.nan, nesting=".")
-    # forge.register(resources, "datashapes:neuronmorphology")
-    # ids = [res.id for res in resources]
-    # timestamp = datetime.today().strftime('%Y%m%d_%Hh%M')
-    # logname = f'registered_resources_ids_{timestamp}.json'
-    # with open(logname, 'w') as f:
-    #     json.dump(ids, f, indent=2)
+    if received_args.really_update == "yes":
+        journal_path = received_args.journal_path or os.path.join(
+            CACHE_DIRECTORY, REGISTRATION_JOURNAL_FILENAME.format(deployment=deployment.name.lower(), org="bbp-external", project="seu")
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+        ids, registration_failures = register_checkpointed(nrows, forge_instance, journal_path=journal_path)
+        timestamp = datetime.today().strftime('%Y%m%d_%Hh%M')
+        logname = os.path.join(working_directory, f'registered_resources_ids_{timestamp}.json')
+        with open(logname, 'w') as f:
+            json.dump({'registered': ids, 'failed': registration_failures}, f, indent=2)
 
     # After processing, with processed excel file
     # datacatalog.description = 'processed_morphologies'
@@ -1,45 +1,36 @@
-import os
+from typing import Dict, List, Optional
 
 from kgforge.core import KnowledgeGraphForge, Resource
-from kgforge.core.wrappings import FilterOperator, Filter
 
+from src.concurrency import get_concurrency_controller
+from src.listing import iter_records
 from src.logger import logger
+from src.schemas.query_data import get_resources_by_ids_or_retrieve
 
 
 def filter_by_tag(all_resources: list, tag: str, forge: KnowledgeGraphForge):
-    tagged_resources = []
-    for count, res in enumerate(all_resources):
+    # Tagged revisions are not indexed, they can only be retrieved one by one, a few at a time
+    def retrieve_tagged(count, res):
         logger.info(f"Retrieving Resource at tag '{tag}': {count +1} of {len(all_resources)}")
-        retrieved_res = forge.retrieve(id=res.get_identifier(), version=tag)
-        if retrieved_res is not None:
-            tagged_resources.append(retrieved_res)
-    return tagged_resources
+        return forge.retrieve(id=res.get_identifier(), version=tag)
 
-def get_neuron_morphologies(forge: KnowledgeGraphForge, reconstructed=True, curated="yes", limit=10000, debug=False, tag=None):
+    retrieved = get_concurrency_controller().starmap(retrieve_tagged, enumerate(all_resources))
 
-    org, project = forge._store.bucket.split("/")[-2:]
-    bucket = f"{org}/{project}"
-    logger.info(
-        f"Querying for morphologies in {bucket}, "
-        f"Curated: {curated}, Reconstructed: {str(reconstructed)}, limit: {limit}"
-    )
+    return [retrieved_res for retrieved_res in retrieved if retrieved_res is not None]
 
-    type_ = "ReconstructedNeuronMorphology" if reconstructed else "NeuronMorphology"
-    filters = [Filter(operator=FilterOperator.EQUAL, path=["type"], value=type_)]
-
-    if curated in ["yes", "no"]:
-        filters.append(
-            Filter(
-                operator=FilterOperator.EQUAL if curated == "yes" else FilterOperator.NOT_EQUAL,
-                path=["annotation", "hasBody", "label"], value="Curated"
-             )
-        )
-    elif curated == "both":
-        pass
-    else:
-        raise Exception(f"Unknown curated flag when retrieving neuron morphologies {curated}")
 
-    ress = forge.search(*filters, limit=limit, debug=debug)
+def get_neuron_morphologies(
+        forge: KnowledgeGraphForge, reconstructed=True, curated="yes", limit: Optional[int] = None, debug=False, tag=None
+) -> List[Resource]:
+    """
+    Returns the morphologies of the bucket of forge as full Resources, for callers that need more than
+    the records of list_neuron_morphologies. The morphologies are listed with keyset pagination, then fetched
+    by id from Elastic Search, so that there is no limit by default
+    """
+    bucket = forge._store.bucket
+    records = list_neuron_morphologies(forge, reconstructed=reconstructed, curated=curated, limit=limit, debug=debug)
+
+    ress = get_resources_by_ids_or_retrieve(forge, [record["id"] for record in records])
     logger.info(f"Found {len(ress)} morphologies in {bucket}")
     if tag:
         ress = filter_by_tag(ress, tag, forge)
@@ -48,3 +39,25 @@ def get_neuron_morphologies(forge: KnowledgeGraphForge, reconstructed=True, cura
     return ress
 
 
+def list_neuron_morphologies(
+        forge: KnowledgeGraphForge, reconstructed=True, curated="yes", limit: Optional[int] = None, debug=False
+) -> List[Dict]:
+    """
+    Lists the morphologies of the bucket of forge like get_neuron_morphologies, as plain records holding only
+    their id, revision, name, distribution, brain region and species (see src.listing), with no limit by default
+    """
+    bucket = forge._store.bucket
+    type_ = "ReconstructedNeuronMorphology" if reconstructed else "NeuronMorphology"
+
+    if curated == "yes":
+        curated_q = "?id annotation/hasBody/label \"Curated\" ."
+    elif curated == "no":
+        curated_q = "FILTER NOT EXISTS { ?id annotation/hasBody/label \"Curated\" }"
+    elif curated == "both":
+        curated_q = None
+    else:
+        raise Exception(f"Unknown curated flag when retrieving neuron morphologies {curated}")
+
+    records = list(iter_records(forge, type_, extra_q=curated_q, limit=limit, debug=debug))
+    logger.info(f"Listed {len(records)} morphologies in {bucket}, Curated: {curated}, Reconstructed: {str(reconstructed)}")
+    return records
@@ -0,0 +1,164 @@
+"""
+Extraction of the soma center of a morphology without loading the whole morphology.
+
+Only the soma samples are read: type 1 lines of an swc file, the soma section of an h5 file,
+or the (CellBody) block of an asc file. The center is the average of the soma points, computed
+in single precision like morphio does, so that it matches morphio.Morphology(path).soma.center.
+When the soma samples are ambiguous (no soma, several somata, a soma attached to a neurite,
+a bifurcating soma that isn't a 3-point soma...), the morphology is fully loaded with morphio.
+"""
+import re
+from collections import defaultdict
+from typing import List, Optional
+
+import numpy as np
+import morphio
+
+from src.helpers import get_filename_and_ext_from_filepath
+
+H5_SOMA_TYPE = 1
+
+
+class AmbiguousSoma(Exception):
+    ...
+
+
+def _swc_soma_points(swc_path: str) -> np.ndarray:
+    points, parents, sample_ids = [], [], []
+
+    with open(swc_path, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0]
+            parts = line.split(None, 2)
+            if len(parts) < 3:
+                continue
+            if parts[1] not in ("1", "1.0"):
+                continue
+
+            values = parts[2].split()
+            if len(values) < 5:
+                raise AmbiguousSoma(f"Malformed soma sample {parts[0]}")
+
+            sample_ids.append(int(float(parts[0])))
+            points.append([float(v) for v in values[:3]])
+            parents.append(int(float(values[4])))
+
+    if len(points) == 0:
+        raise AmbiguousSoma("No soma sample")
+
+    soma_ids = set(sample_ids)
+    roots = [i for i, p in zip(sample_ids, parents) if p == -1]
+    if len(roots) != 1:
+        raise AmbiguousSoma(f"{len(roots)} soma roots")
+
+    children = defaultdict(list)
+    for sample_id, parent in zip(sample_ids, parents):
+        if parent == -1:
+            continue
+        if parent not in soma_ids:
+            raise AmbiguousSoma(f"Soma sample {sample_id} has a non-soma parent {parent}")
+        children[parent].append(sample_id)
+
+    bifurcating = [k for k, v in children.items() if len(v) > 1]
+    if bifurcating:
+        # The only valid bifurcating configuration is the NeuroMorpho 3-point soma
+        is_three_point = len(sample_ids) == 3 and bifurcating == roots and len(children[roots[0]]) == 2
+        if not is_three_point:
+            raise AmbiguousSoma(f"Bifurcating soma at samples {bifurcating}")
+
+    return np.array(points, dtype=np.float32)
+
+
+def _h5_soma_points(h5_path: str) -> np.ndarray:
+    try:
+        import h5py
+    except ImportError as e:
+        raise AmbiguousSoma("h5py is not available") from e
+
+    with h5py.File(h5_path, "r") as h5_file:
+        group = h5_file["neuron1"] if "neuron1" in h5_file else h5_file  # h5 v2 nests the data
+        structure = group["structure"][:]
+        soma_sections = [i for i, row in enumerate(structure) if int(row[1]) == H5_SOMA_TYPE]
+        if len(soma_sections) != 1 or soma_sections[0] != 0:
+            raise AmbiguousSoma(f"{len(soma_sections)} soma sections")
+
+        end = int(structure[1][0]) if len(structure) > 1 else None
+        points = group["points"][int(structure[0][0]):end, :3]
+
+    if len(points) == 0:
+        raise AmbiguousSoma("No soma sample")
+
+    return np.asarray(points, dtype=np.float32)
+
+
+ASC_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+ASC_POINT = re.compile(rf"\(\s*({ASC_NUMBER})\s+({ASC_NUMBER})\s+({ASC_NUMBER})")
+
+
+def _asc_soma_points(asc_path: str) -> np.ndarray:
+    with open(asc_path, "r") as f:
+        content = "\n".join(line.split(";", 1)[0] for line in f)
+
+    markers = [m.end() for m in re.finditer(r"\(\s*CellBody\s*\)", content)]
+    if len(markers) != 1:
+        raise AmbiguousSoma(f"{len(markers)} CellBody blocks")
+
+    points = []
+    depth = 0
+    i = markers[0]
+    while i < len(content):
+        c = content[i]
+        if c == "(":
+            if depth == 0:
+                match = ASC_POINT.match(content, i)
+                if match:
+                    points.append([float(v) for v in match.groups()])
+            depth += 1
+        elif c == ")":
+            if depth == 0:  # End of the CellBody block
+                break
+            depth -= 1
+        i += 1
+
+    if len(points) == 0:
+        raise AmbiguousSoma("No soma sample")
+
+    return np.array(points, dtype=np.float32)
+
+
+SOMA_POINT_READERS = {
+    ".swc": _swc_soma_points,
+    ".h5": _h5_soma_points,
+    ".asc": _asc_soma_points
+}
+
+
+def read_soma_points(morph_path: str) -> Optional[np.ndarray]:
+    """
+    Returns the soma points of the morphology, or None if they can't be read unambiguously
+    without loading the whole morphology
+    """
+    _, ext = get_filename_and_ext_from_filepath(morph_path)
+    reader = SOMA_POINT_READERS.get(ext.lower(), None)
+    if reader is None:
+        return None
+    try:
+        return reader(morph_path)
+    except (AmbiguousSoma, ValueError, IndexError, KeyError):
+        return None
+
+
+def get_soma_center_fast(morph_path: str) -> List[float]:
+    """
+    Returns the soma center of the morphology, reading only the soma samples when possible,
+    falling back on loading the whole morphology with morphio
+    """
+    points = read_soma_points(morph_path)
+
+    if points is None:
+        morph = morphio.Morphology(morph_path)
+        return [float(i) for i in morph.soma.center]
+
+    # Sequential single precision sum, as in morphio's center of gravity
+    center = points.sum(axis=0, dtype=np.float32) / np.float32(len(points))
+    return [float(i) for i in center]
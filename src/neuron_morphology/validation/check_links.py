@@ -1,60 +1,93 @@
 import argparse
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 from kgforge.core import KnowledgeGraphForge, Resource
-import cachetools
 import os
 import pandas as pd
 
-from src.helpers import allocate_by_deployment, _as_list, _download_from, _format_boolean, authenticate_from_parser_arguments
+from src.helpers import allocate_by_deployment, _as_list, _download_from, _format_boolean, authenticate_from_parser_arguments, init_run
 from src.logger import logger
+from src.metadata_cache import get_metadata_cache
 from src.neuron_morphology.arguments import define_morphology_arguments
 from src.neuron_morphology.query_data import get_neuron_morphologies
 
 
-@cachetools.cached(cache=cachetools.LRUCache(maxsize=100))
-def cacheretrieve(id_, forge):
-    return forge.retrieve(id_, cross_bucket=True)
+def collect_links(resource_json: Dict, path: str = "") -> List[Tuple[str, str, Optional[str]]]:
+    """
+    Walks the json of a resource and returns all linked entities as (path of the id, id, label if any).
+    Paths are the column names of forge.as_dataframe (ex: brainLocation.brainRegion.id). Entities in a list of
+    several elements, which forge.as_dataframe doesn't flatten, get the index of their element as a suffix of the
+    list's path (ex: contribution[1].agent.id), entities in a list of a single element get the path of the list
+    """
+    links = []
+
+    if isinstance(resource_json, list):
+        for i, el in enumerate(resource_json):
+            links.extend(collect_links(el, f"{path}[{i}]" if len(resource_json) > 1 else path))
+
+    elif isinstance(resource_json, dict):
+        if path and "id" in resource_json and isinstance(resource_json["id"], str):
+            links.append((f"{path}.id", resource_json["id"], resource_json.get("label", None)))
+
+        for k, v in resource_json.items():
+            if isinstance(v, (dict, list)):
+                links.extend(collect_links(v, f"{path}.{k}" if path else k))
+
+    return links
+
+
+def retrieve_links(ids: List[str], forge: KnowledgeGraphForge) -> Dict[str, Optional[Resource]]:
+    """
+    Retrieves all distinct ids in a single concurrent pass through the metadata cache (MetadataCache.retrieve_many),
+    ids that can't be retrieved map to None
+    """
+    ids = list(dict.fromkeys(ids))
+    logger.info(f"Retrieving {len(ids)} distinct linked entities")
+    results = get_metadata_cache().retrieve_many(ids, forge, cross_bucket=True)
+    return dict(zip(ids, results))
 
 
 def check(resources: List[Resource], forge: KnowledgeGraphForge, sparse=True):
-    rows = []
+    """
+    Checks that the entities linked by each resource can be retrieved, and that their label is the one of the link.
+    The report has a row per resource, with columns "<path> can be retrieved", "Value of <path> that couldn't be
+    retrieved" and "<path> label is the same", paths being the ones of collect_links. Links in lists of several
+    elements, like contributions, weren't checked when links were found through forge.as_dataframe, their columns
+    are the ones whose path holds an index, ex: "contribution[1].agent.id can be retrieved"
+    """
+    links_per_resource = [collect_links(forge.as_json(resource)) for resource in resources]
 
-    for resource in resources:
-        row = {}
+    link_resources = retrieve_links([id_ for links in links_per_resource for _, id_, _ in links], forge)
 
-        r_df = forge.as_dataframe(resource)
-        columns_with_id = [i for i in r_df.columns if "id" in i and i != "id"]
-        columns_with_id_rm_and_label = [i for i in columns_with_id if i.replace(".id", ".label") in r_df.columns]
+    rows = []
 
-        for k in columns_with_id:
-            id_ = r_df[k].values[0]
+    for resource, links in zip(resources, links_per_resource):
+        row = {}
 
-            logger.info(f"Retrieving link {k} for resource of id {id_}")
-            link_resource = cacheretrieve(id_, forge)
+        for k, id_, label in links:
+            link_resource = link_resources[id_]
 
             not_none = link_resource is not None
             row[f"{k} can be retrieved"] = not_none
             if not not_none:
                 row[f"Value of {k} that couldn't be retrieved"] = id_
-
-            if not not_none:
                 logger.warning(f"For morphology {resource.get_identifier()}, couldn't retrieve {k} {id_}")
-            else:
-                if k in columns_with_id_rm_and_label:
-                    k_label = k.replace(".id", ".label")
-                    if "label" in link_resource.__dict__:
-                        same = link_resource.label == r_df[k_label].values[0]
-                    else:
-                        logger.warning(
-                            f"Morphology {resource.get_identifier()} has an id paired with a label,"
-                            f" when the original resource doesn't have a label, see field {k_label}"
-                        )
-                        same = False
-                    row[f"{k} label is the same"] = same
-
-                    if not same:
-                        logger.warning(f"For morphology {resource.get_identifier()}, {k_label} is inaccurate")
+                continue
+
+            if label is not None:
+                k_label = k.replace(".id", ".label")
+                if "label" in link_resource.__dict__:
+                    same = link_resource.label == label
+                else:
+                    logger.warning(
+                        f"Morphology {resource.get_identifier()} has an id paired with a label,"
+                        f" when the original resource doesn't have a label, see field {k_label}"
+                    )
+                    same = False
+                row[f"{k} label is the same"] = same
+
+                if not same:
+                    logger.warning(f"For morphology {resource.get_identifier()}, {k_label} is inaccurate")
 
         row = {
             "id": resource.get_identifier(),
@@ -115,6 +148,7 @@ if __name__ == "__main__":
     org, project = received_args.bucket.split("/")
     output_dir = received_args.output_dir
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     forge_bucket = allocate_by_deployment(org, project, deployment=deployment, token=auth_token)
@@ -11,7 +11,7 @@ from kgforge.core import KnowledgeGraphForge, Resource
 from src.logger import logger
 from src.helpers import CustomEx
 from kgforge.core.commons.actions import LazyAction
-from morph_tool.converter import convert
+from src.neuron_morphology.conversion import convert_morphology
 import pandas as pd
 import os
 
@@ -104,11 +104,14 @@ def check_swc_on_resource(resource: Resource, swc_download_folder: str, forge: K
         logger.info(
             "Re-assignment successful, asc and h5 files will have to be reconverted and the resource will need to be updated"
         )
-        with open(swcfpath, 'w') as f:
+        # Written next to the file then moved over it, the downloaded file is never modified in place
+        tmp_swcfpath = f"{swcfpath}.{os.getpid()}.tmp"
+        with open(tmp_swcfpath, 'w') as f:
             for comment in comments:
                 f.write(comment)
 
-        df.reindex(columns=SWC_EXPECTED_COLUMNS_SAVE).to_csv(swcfpath, sep=' ', mode='a')
+        df.reindex(columns=SWC_EXPECTED_COLUMNS_SAVE).to_csv(tmp_swcfpath, sep=' ', mode='a')
+        os.replace(tmp_swcfpath, swcfpath)
         new_distributions.append(forge.attach(swcfpath, content_type='application/swc'))
         reconvert = dict((k, True) for k in derived_formats)
         update = True
@@ -127,10 +130,16 @@ def check_swc_on_resource(resource: Resource, swc_download_folder: str, forge: K
                     f"the .{initial_format} file will be converted and the resource will be updated"
                 )
 
-        if reconvert[frmt]:  # NB. Not else!!
-            logger.info(f"Converting {resource.name} to {frmt}")
-            outfile = f'{resource.name}.{frmt}'  # TODO specify where it is created
-            convert(swcfpath, outfile)
+    # Converted together, so that the conversion manifest is saved once for all formats
+    to_convert = [frmt for frmt in derived_formats if reconvert[frmt]]
+    if len(to_convert) > 0:
+        logger.info(f"Converting {resource.name} to {', '.join(to_convert)}")
+        outfiles = [f'{resource.name}.{frmt}' for frmt in to_convert]  # TODO specify where it is created
+        try:
+            convert_morphology(swcfpath, outfiles)
+        except ValueError as e:
+            raise CustomEx(f"Failed to convert {resource.name} to {', '.join(to_convert)}: {e}") from e
+        for frmt, outfile in zip(to_convert, outfiles):
             new_distributions.append(forge.attach(outfile, content_type=f'application/{frmt}'))
 
     if len(distributions_per_format['obj']) == 1:
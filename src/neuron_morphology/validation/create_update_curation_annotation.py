@@ -7,7 +7,7 @@ import os
 import pandas as pd
 
 from src.curation_annotations import create_update_curated_annotation, CurationStatus
-from src.helpers import allocate_by_deployment, authenticate_from_parser_arguments
+from src.helpers import allocate_by_deployment, authenticate_from_parser_arguments, init_run
 from src.logger import logger
 from src.neuron_morphology.arguments import define_morphology_arguments
 from src.neuron_morphology.query_data import get_neuron_morphologies
@@ -92,6 +92,7 @@ if __name__ == "__main__":
     org, project = received_args.bucket.split("/")
     output_dir = received_args.output_dir
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     working_directory = os.path.join(os.getcwd(), output_dir)
@@ -8,12 +8,14 @@ from kgforge.specializations.mappings import DictionaryMapping
 from kgforge.specializations.mappers import DictionaryMapper
 from voxcell import RegionMap, VoxelData
 
+from src.brain_region_index import BrainRegionIndex
 from src.logger import logger
+from src.metrics import COMPUTE, get_run_metrics
 from src.helpers import (
     ASSETS_DIRECTORY, _format_boolean,
     allocate_by_deployment,
     allocate_with_default_views, Deployment,
-    authenticate_from_parser_arguments,
+    authenticate_from_parser_arguments, init_run,
     get_ext_path
 )
 from src.neuron_morphology.arguments import define_morphology_arguments
@@ -159,7 +161,8 @@ def save_batch_quality_measurement_annotation_report_on_resources(
         voxel_d: VoxelData,
         external_metadata: Optional[pd.DataFrame],
         with_br_check: bool = True,
-        with_asc_check: bool = True
+        with_asc_check: bool = True,
+        br_index: Optional[BrainRegionIndex] = None
 ) -> Tuple[List[Tuple[Resource, str, Dict]], List[Tuple[Resource, str, Exception]]]:
 
     n_resources = len(resources)
@@ -167,7 +170,8 @@ def save_batch_quality_measurement_annotation_report_on_resources(
     if with_br_check:
         brain_region_comp, sort_column = create_brain_region_comparison(
             search_results=resources, morphology_dir=swc_download_folder, forge=forge_datamodels, forge_morphology=forge,
-            brain_region_map=br_map, voxel_data=voxel_d, float_coordinates_check=False, ext_metadata=external_metadata
+            brain_region_map=br_map, voxel_data=voxel_d, float_coordinates_check=False, ext_metadata=external_metadata,
+            brain_region_index=br_index
         )
         brain_region_comp_dict = dict(
             (i["morphology_id"], i) for i in brain_region_comp
@@ -229,6 +233,7 @@ if __name__ == "__main__":
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     org, project = received_args.bucket.split("/")
@@ -293,7 +298,7 @@ if __name__ == "__main__":
 
         report_name = report_name.replace(".tsv", v_string)
 
-        br_map, voxel_d, add_voxel_d = get_atlas(
+        br_map, voxel_d, add_voxel_d, br_index = get_atlas(
             working_dir=working_directory,
             deployment=deployment, token=auth_token,
             tag=ATLAS_TAG, add_annot=list(ADDITIONAL_ANNOTATION_VOLUME.values())[0]
@@ -304,24 +309,29 @@ if __name__ == "__main__":
             if org == "bbp-external" and project == "seu" else None
     else:
         br_map = None
+        br_index = None
         used_voxel_data = None
         external_metadata_seu = None
 
-    reports, errors = save_batch_quality_measurement_annotation_report_on_resources(
-        resources=resources,
-        swc_download_folder=swc_download_folder,
-        asc_download_folder=asc_download_folder,
-        report_dir_path=report_dir_path,
-        forge=forge,
-        forge_datamodels=forge_datamodels,
-        report_name=report_name,
-        individual_reports=False,
-        br_map=br_map,
-        voxel_d=used_voxel_data,
-        external_metadata=external_metadata_seu,
-        with_asc_check=with_asc_check,
-        with_br_check=with_br_check,
-    )
+    with get_run_metrics().stage(COMPUTE):
+        reports, errors = save_batch_quality_measurement_annotation_report_on_resources(
+            resources=resources,
+            swc_download_folder=swc_download_folder,
+            asc_download_folder=asc_download_folder,
+            report_dir_path=report_dir_path,
+            forge=forge,
+            forge_datamodels=forge_datamodels,
+            report_name=report_name,
+            individual_reports=False,
+            br_map=br_map,
+            voxel_d=used_voxel_data,
+            external_metadata=external_metadata_seu,
+            with_asc_check=with_asc_check,
+            with_br_check=with_br_check,
+            br_index=br_index
+        )
+    get_run_metrics().increment("morphologies_measured", len(reports))
+    get_run_metrics().increment("morphologies_failed", len(errors))
 
     # for resource in resources:
     #     path = Path(get_swc_path(resource, swc_download_folder, forge))
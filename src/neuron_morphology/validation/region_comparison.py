@@ -1,22 +1,26 @@
 import copy
 import argparse
 import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from typing import List, Dict, Optional, Tuple
 
 from kgforge.core import KnowledgeGraphForge, Resource
 from voxcell import RegionMap, VoxelData
 from voxcell.nexus.voxelbrain import Atlas
-import cachetools
-import morphio
 import os
 import pandas as pd
 import math
 
+from src.brain_region_index import BrainRegionIndex, BRAIN_REGION_INDEX_FILENAME
 from src.get_atlas import _get_atlas_dir_ready
-from src.helpers import ASSETS_DIRECTORY, allocate_by_deployment, _as_list, _download_from, _format_boolean, Deployment, authenticate_from_parser_arguments
+from src.helpers import ASSETS_DIRECTORY, allocate_by_deployment, _as_list, _download_from, _format_boolean, Deployment, authenticate_from_parser_arguments, init_run
 from src.logger import logger
+from src.metrics import COMPUTE, PARSE, get_run_metrics
+from src.metadata_cache import get_metadata_cache
 from src.neuron_morphology.arguments import define_morphology_arguments
-from src.neuron_morphology.query_data import get_neuron_morphologies
+from src.neuron_morphology.query_data import list_neuron_morphologies
+from src.neuron_morphology.soma_extraction import get_soma_center_fast
+from src.resolve_cache import get_resolve_cache
 
 # From /gpfs/bbp.cscs.ch/data/project/proj162/Experimental_Data/Reconstructed_morphologies/Categorized/Neurons/Mouse/
 BRAIN_AREAS = ["Cerebellum", "Isocortex", "Hippocampal region", "Olfactory areas",
@@ -57,8 +61,15 @@ def get_neigh_col_name(coord_type):
 
 
 def get_soma_center(morph_path: str) -> Optional[List]:
-    morph = morphio.Morphology(morph_path)
-    return [float(i) for i in morph.soma.center]
+    return get_soma_center_fast(morph_path)
+
+
+def _get_soma_center_catch(morph_path: str) -> Tuple[Optional[List], Optional[str]]:
+    # Top-level so that it can be sent to worker processes
+    try:
+        return get_soma_center(morph_path), None
+    except Exception as e:
+        return None, str(e)
 
 
 def get_value(coordinate):
@@ -78,13 +89,13 @@ def get_morphology_coordinates(morphology: Resource, forge: KnowledgeGraphForge)
     return None
 
 
-def get_region(position, brain_region_map: RegionMap, voxel_data: VoxelData, region_attribute=REGION_ATTRIBUTE, with_neighbours=False) -> Tuple[str, List]:
+def get_region_ids(position, voxel_data: VoxelData, with_neighbours=False) -> Tuple[int, List[int]]:
 
     soma_x, soma_y, soma_z = voxel_data.positions_to_indices(position)
     region_id = int(voxel_data.raw[soma_x, soma_y, soma_z])
 
     if not with_neighbours:
-        return brain_region_map.get(region_id, region_attribute), []
+        return region_id, []
 
     neigh_ids = set()
 
@@ -101,6 +112,13 @@ def get_region(position, brain_region_map: RegionMap, voxel_data: VoxelData, reg
         raise Exception(f"region_id {region_id} not found in neigh_ids: {neigh_ids}")
     neigh_ids.remove(region_id)
 
+    return region_id, sorted(neigh_ids)
+
+
+def get_region(position, brain_region_map: RegionMap, voxel_data: VoxelData, region_attribute=REGION_ATTRIBUTE, with_neighbours=False) -> Tuple[str, List]:
+
+    region_id, neigh_ids = get_region_ids(position, voxel_data, with_neighbours=with_neighbours)
+
     return brain_region_map.get(region_id, region_attribute), \
         [brain_region_map.get(neigh_id, region_attribute) for neigh_id in neigh_ids]
 
@@ -116,19 +134,86 @@ def is_descendant_of_region_map(a, b, reg_map):
     return b in a_ancestors
 
 
+def are_siblings_region_map(a, b, reg_map):
+    a_ancestors = reg_map.get(a, "id", with_ascendants=True)
+    b_ancestors = reg_map.get(b, "id", with_ascendants=True)
+    a_parent = a_ancestors[1] if len(a_ancestors) > 1 else None
+    b_parent = b_ancestors[1] if len(b_ancestors) > 1 else None
+    return a_parent == b_parent
+
+
+def region_int_to_id(region_int: int) -> str:
+    return f"http://api.brain-map.org/api/v2/data/Structure/{region_int}"
+
+
 def are_siblings(a, b, forge):
     # print("\nId a:", a)
-    a_res = forge.retrieve(a)
+    a_res = get_metadata_cache().retrieve(a, forge, cross_bucket=False)
     # print("\nResource a:\n", a_res)
     # print("\nId b:", b)
-    b_res = forge.retrieve(b)
+    b_res = get_metadata_cache().retrieve(b, forge, cross_bucket=False)
     # print("\nResource b:\n", b_res)
     return a_res.isPartOf == b_res.isPartOf
 
 
-@cachetools.cached(cache=cachetools.LRUCache(maxsize=100))
 def cacheresolve(text, forge, scope='ontology', target='BrainRegion', strategy='EXACT_MATCH'):
-    return forge.resolve(text=text, scope=scope, target=target, strategy=strategy)
+    return get_resolve_cache().resolve(forge, text=text, scope=scope, target=target, strategy=strategy)
+
+
+def resolve_region(text, forge, brain_region_index: Optional[BrainRegionIndex] = None, strategy='EXACT_MATCH'):
+    """
+    Resolves a brain region label or notation against the local index first, and only resolves it
+    through forge if it isn't found there
+    """
+    if brain_region_index is not None:
+        region = brain_region_index.resolve(text, strategy=strategy)
+        if region is not None:
+            return region
+    return cacheresolve(text, forge, strategy=strategy)
+
+
+def index_external_metadata(ext_metadata: Optional[pd.DataFrame]) -> Optional[Dict[str, pd.DataFrame]]:
+    """
+    Groups the external metadata rows by morphology name once, so that each morphology's
+    rows can be looked up without scanning the whole table
+    """
+    if ext_metadata is None:
+        return None
+    return dict(tuple(ext_metadata.groupby("Cell Name (Cell ID)", sort=False)))
+
+
+def download_morphologies(
+        search_results: List[Resource], forge_morphology: KnowledgeGraphForge, morphology_dir: str,
+        n_download_workers: int = 8
+) -> List[str]:
+    """
+    Downloads the swc file of each morphology concurrently.
+    The returned paths are in the same order as search_results
+    """
+    logger.info(f"Downloading {len(search_results)} morphologies with {n_download_workers} workers")
+
+    def download(n_morph: Tuple[int, Resource]) -> str:
+        n, morph = n_morph
+        return _download_from(
+            forge_morphology, link=morph, label=f"morphology {n}",
+            format_of_interest='application/swc', download_dir=morphology_dir, rename=None
+        )
+
+    with ThreadPoolExecutor(max_workers=n_download_workers) as executor:
+        return list(executor.map(download, enumerate(search_results)))
+
+
+def get_soma_centers(
+        morph_paths: List[str], n_processes: Optional[int] = None
+) -> List[Tuple[Optional[List], Optional[str]]]:
+    """
+    Computes the soma center of each morphology in a pool of processes.
+    Returns, for each path and in the same order, the soma center or the error message raised
+    """
+    logger.info(f"Extracting soma centers of {len(morph_paths)} morphologies")
+
+    with get_run_metrics().stage(PARSE), ProcessPoolExecutor(max_workers=n_processes) as executor:
+        return list(executor.map(_get_soma_center_catch, morph_paths, chunksize=16))
 
 
 def add_external_info(row, ext_info):
@@ -165,16 +250,28 @@ def create_brain_region_comparison(
         ext_metadata: Optional[pd.DataFrame],
         sparse: bool = True,
         float_coordinates_check=False,
-        log=False
+        log=False,
+        n_download_workers: int = 8,
+        n_processes: Optional[int] = None,
+        brain_region_index: Optional[BrainRegionIndex] = None,
+        soma_centers: Optional[List[Tuple[Optional[List], Optional[str]]]] = None
 ) -> Tuple[List[Dict], str]:
+    """
+    Compares, for each morphology, the declared brain region with the region where the soma lands
+    in the parcellation volume. Downloads are done concurrently, soma centers are extracted in a pool
+    of processes, and region relationships are checked against brain_region_map.
+    Declared regions are resolved with brain_region_index when provided, with forge otherwise.
+    Rows are returned in the same order as search_results.
+
+    :param soma_centers: the output of get_soma_centers for the morphologies of search_results, so that comparisons
+    in several volumes download and parse the morphologies once. Computed if not provided
+    """
     logger.disabled = not log
 
-    descend_or_ancest_forge = lambda a, b: (
-            is_descendant_of_forge(a, b, forge)
-            or is_descendant_of_forge(b, a, forge)
+    descend_or_ancest_reg_map = lambda a, b: (
+            is_descendant_of_region_map(a, b, brain_region_map)
+            or is_descendant_of_region_map(b, a, brain_region_map)
     )
-    #descend_or_ancest_reg_map = lambda a, b: (is_descendant_of_region_map(a, b, brain_region_map)
-    #    or is_descendant_of_region_map(b, a, brain_region_map))
 
     default_region = "declared"
     neigh_col_label = "neighbours"
@@ -217,9 +314,17 @@ def create_brain_region_comparison(
             brain_area, REGION_ATTRIBUTE, ignore_case=False, with_descendants=True
         )
 
+    if soma_centers is None:
+        swc_paths = download_morphologies(
+            search_results, forge_morphology=forge_morphology, morphology_dir=morphology_dir,
+            n_download_workers=n_download_workers
+        )
+        soma_centers = get_soma_centers(swc_paths, n_processes=n_processes)
+    ext_metadata_index = index_external_metadata(ext_metadata)
+
     tot_morphs = len(search_results)
     rows = []
-    for n, morph in enumerate(search_results):
+    for n, (morph, (swc_coordinates, soma_error)) in enumerate(zip(search_results, soma_centers)):
         morphology_name = morph.name
         logger.info("------------------------------------")
         logger.info(f"Morphology {n + 1} of {tot_morphs}: {morphology_name}")
@@ -228,11 +333,6 @@ def create_brain_region_comparison(
         row['morphology_id'] = morph.get_identifier()
         row['morphology_name'] = morphology_name
 
-        swc_path = _download_from(
-            forge_morphology, link=morph, label=f"morphology {n}",
-            format_of_interest='application/swc', download_dir=morphology_dir, rename=None
-        )
-
         declared = _as_list(morph.brainLocation.brainRegion)  # could be a list
         declared_id = declared[0].id
 
@@ -246,14 +346,11 @@ def create_brain_region_comparison(
         declared_acronym = brain_region_map.get(declared_int, "acronym")
         row[REGION_ACRONYM_COLUMN] = declared_acronym
 
-        if ext_metadata is not None:
-            add_external_info(row, ext_metadata.loc[ext_metadata["Cell Name (Cell ID)"] == morphology_name])
+        if ext_metadata_index is not None:
+            add_external_info(row, ext_metadata_index.get(morphology_name, ext_metadata.iloc[0:0]))
 
-        try:
-            swc_coordinates = get_soma_center(swc_path)
-        except Exception as e:
-            logger.error(f"Error raised when loading swc with morphio: {e}")
-            swc_coordinates = None
+        if soma_error is not None:
+            logger.error(f"Error raised when loading swc with morphio: {soma_error}")
 
         metadata_coordinates_orig = get_morphology_coordinates(morph, forge)
         metadata_coordinates = [float(coord) for coord in metadata_coordinates_orig]
@@ -264,15 +361,18 @@ def create_brain_region_comparison(
             coord_neigh_label = f"{coord_type}_{neigh_col_label}"
             neigh_agr, neigh_rel = None, None
             try:
-                observed_label, neighbour_labels = get_region(coordinates, brain_region_map, voxel_data, "acronym", with_neighbours=True) \
-                    if coordinates is not None \
-                    else (None, None)
+                if coordinates is not None:
+                    observed_int, neighbour_ints = get_region_ids(coordinates, voxel_data, with_neighbours=True)
+                    observed_label = brain_region_map.get(observed_int, "acronym")
+                    neighbour_labels = [brain_region_map.get(neigh_int, "acronym") for neigh_int in neighbour_ints]
+                else:
+                    observed_int, neighbour_ints, observed_label, neighbour_labels = None, None, None, None
 
             except Exception as exc:
                 logger.error(
                     f"Exception raised when retrieving brain region where "
                     f"{morphology_name} is using {coord_type} coordinates: '{str(exc)}'")
-                observed_label, neighbour_labels = None, None
+                observed_int, neighbour_ints, observed_label, neighbour_labels = None, None, None, None
 
             row[f"observed_region_{coord_type}"] = observed_label
             if observed_label is None:
@@ -280,8 +380,7 @@ def create_brain_region_comparison(
                     f"Couldn't figure out the brain region where {morphology_name} is located"
                     f" inside the parcellation volume using {coord_type} coordinates")
                 return
-            observed_res = cacheresolve(observed_label, forge)
-            observed_id = observed_res.id
+            observed_id = region_int_to_id(observed_int)
 
             def check_agreement(obs_id, ref_id):
                 # Match observed region with declared region
@@ -289,18 +388,19 @@ def create_brain_region_comparison(
                 sibling_regions = False
                 if ref_id == obs_id:
                     regions_match = True
+                ref_int = int(ref_id.split("/")[-1])
+                obs_int = int(obs_id.split("/")[-1])
+
                 if regions_match:
                     agr = True
                 else:
-                    agr = descend_or_ancest_forge(ref_id, obs_id)
+                    agr = descend_or_ancest_reg_map(ref_int, obs_int)
                 if not agr:
                     if ("barrel field" in declared_label) or ("layer 2/3" in declared_label):
-                        sibling_regions = are_siblings(obs_id, ref_id, forge)
+                        sibling_regions = are_siblings_region_map(obs_int, ref_int, brain_region_map)
                         agr = sibling_regions
 
                 # Add relationship
-                ref_int = int(ref_id.split("/")[-1])
-                obs_int = int(obs_id.split("/")[-1])
                 obs_ancestors = brain_region_map.get(obs_int, "id", with_ascendants=True)
 
                 if agr:
@@ -323,9 +423,7 @@ def create_brain_region_comparison(
                     common_ancestors: List[str] = [anc for anc in obs_ancestors if anc in ref_ancestors]
                     if not common_ancestors:
                         raise Exception("No common ancestor!")
-                    first_common_ancestor = forge.retrieve(
-                        "http://api.brain-map.org/api/v2/data/Structure/" + str(common_ancestors[0])
-                        ).notation
+                    first_common_ancestor = brain_region_map.get(common_ancestors[0], "acronym")
                     rel_string = f'first common ancestor: {first_common_ancestor}'
 
                 return agr, rel_string
@@ -341,7 +439,7 @@ def create_brain_region_comparison(
                     continue
 
                 agreement_column = get_agreement_col_name(AGREEMENT_CRITERIA, coord_type, ref)
-                seu_res = cacheresolve(seu_region, forge)
+                seu_res = resolve_region(seu_region, forge, brain_region_index)
                 if not seu_res:
                     row[agreement_column] = "region not resolved"
                     continue
@@ -358,11 +456,8 @@ def create_brain_region_comparison(
                 log_fc(msg)
 
                 if ref == default_region:
-                    for neigh_label in neighbour_labels:
-                        neigh_res = cacheresolve(neigh_label, forge)
-                        if not neigh_res:
-                            continue
-                        neigh_agr, neigh_rel = check_agreement(neigh_res.id, seu_id)
+                    for neigh_int, neigh_label in zip(neighbour_ints, neighbour_labels):
+                        neigh_agr, neigh_rel = check_agreement(region_int_to_id(neigh_int), seu_id)
                         neigh_rel = f"{neigh_label} {neigh_rel}"
                         if neigh_agr:
                             # one agreement is enough
@@ -399,7 +494,9 @@ def create_brain_region_comparison(
     return rows, def_sort_column
 
 
-def get_atlas(working_dir: str, deployment: Deployment, token: str, tag: str = None, add_annot: str = None) -> Tuple[RegionMap, VoxelData, Optional[VoxelData]]:
+def get_atlas(
+        working_dir: str, deployment: Deployment, token: str, tag: str = None, add_annot: str = None
+) -> Tuple[RegionMap, VoxelData, Optional[VoxelData], BrainRegionIndex]:
     logger.info(f"Downloading atlas at tag {tag}")
 
     atlas_dir = os.path.join(working_dir, "atlas")
@@ -410,10 +507,14 @@ def get_atlas(working_dir: str, deployment: Deployment, token: str, tag: str = N
     atlas = Atlas.open(atlas_dir)
     brain_region_map: RegionMap = atlas.load_region_map()
     voxel_data: VoxelData = atlas.load_data('brain_regions')
+    brain_region_index = BrainRegionIndex.build_or_load(
+        ontology_path=os.path.join(atlas_dir, "hierarchy.json"),
+        index_path=os.path.join(working_dir, BRAIN_REGION_INDEX_FILENAME)
+    )
     shutil.rmtree(atlas_dir)
 
     add_voxel_data: VoxelData = atlas.load_data(add_annot) if add_annot else None
-    return brain_region_map, voxel_data, add_voxel_data
+    return brain_region_map, voxel_data, add_voxel_data, brain_region_index
 
 
 if __name__ == "__main__":
@@ -424,6 +525,7 @@ if __name__ == "__main__":
     org, project = received_args.bucket.split("/")
     output_dir = received_args.output_dir
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     query_limit = received_args.limit
@@ -435,7 +537,7 @@ if __name__ == "__main__":
 
     logger.info(f"Working directory {working_directory}")
 
-    br_map, voxel_d, add_voxel_d = get_atlas(
+    br_map, voxel_d, add_voxel_d, br_index = get_atlas(
         working_dir=working_directory,
         deployment=deployment, token=auth_token,
         tag=ATLAS_TAG, add_annot=list(ADDITIONAL_ANNOTATION_VOLUME.values())[0]
@@ -450,7 +552,11 @@ if __name__ == "__main__":
 
     forge_datamodels = allocate_by_deployment("neurosciencegraph", "datamodels", deployment=deployment, token=auth_token)
 
-    resources = get_neuron_morphologies(forge=forge_bucket, curated=received_args.curated, limit=query_limit)
+    # Only the id, name, brain location and distribution of morphologies are needed, listed as plain records
+    resources = [
+        forge_bucket.from_json(record)
+        for record in list_neuron_morphologies(forge=forge_bucket, curated=received_args.curated, limit=query_limit)
+    ]
 
     #resources = [
     #    forge_bucket.retrieve("https://bbp.epfl.ch/neurosciencegraph/data/neuronmorphologies/ed3bfb7b-bf43-4e92-abed-e2ca1170c654"),
@@ -466,14 +572,21 @@ if __name__ == "__main__":
 
     external_metadata = pd.read_excel(SEU_METADATA_FILEPATH, skiprows=1, na_values=' ') if org == "bbp-external" and project == "seu" else None
 
+    # Morphologies are downloaded and parsed once, for the comparisons in all atlas versions
+    morphology_soma_centers = get_soma_centers(
+        download_morphologies(resources, forge_morphology=forge_bucket, morphology_dir=morphologies_dir)
+    )
+
     for version, annotation in result_version.items():
         logger.info(f"Performing comparison in atlas {version}")
-        comparison, sort_column = create_brain_region_comparison(
-            search_results=resources, morphology_dir=morphologies_dir, forge=forge_datamodels,
-            forge_morphology=forge_bucket,
-            brain_region_map=br_map, voxel_data=annotation, ext_metadata=external_metadata,
-            float_coordinates_check=False
-        )
+        with get_run_metrics().stage(COMPUTE):
+            comparison, sort_column = create_brain_region_comparison(
+                search_results=resources, morphology_dir=morphologies_dir, forge=forge_datamodels,
+                forge_morphology=forge_bucket,
+                brain_region_map=br_map, voxel_data=annotation, ext_metadata=external_metadata,
+                float_coordinates_check=False, brain_region_index=br_index, soma_centers=morphology_soma_centers
+            )
+        get_run_metrics().increment("morphologies_compared", len(comparison))
 
         df = pd.DataFrame(comparison)
         #df[SEU_METADATA_COLUMNS[0]] = df[SEU_METADATA_COLUMNS[0]].astype('Int64')
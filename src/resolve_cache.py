@@ -0,0 +1,259 @@
+"""
+Disk-backed cache of forge.resolve results, shared across runs and processes.
+
+Entries are stored per Delta endpoint, resolver bucket and resolver target (BrainRegion, Species, Strain, agents...).
+Each target of an endpoint can be tied to a snapshot version (e.g. the revision of the ontology it comes from):
+when the version changes, the entries of that target are dropped. Unresolved texts are cached for RESOLVE_MISS_TTL
+only, since the resource they should resolve to may be registered in the meantime. A whole vocabulary can be
+bulk-loaded with warm_up, so that resolving its labels requires no further call to Nexus.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, List, Set, Tuple
+
+from kgforge.core import KnowledgeGraphForge, Resource
+
+from src.helpers import CACHE_DIRECTORY
+from src.logger import logger
+
+RESOLVE_CACHE_FILENAME = "resolve_cache.sqlite"
+RESOLVE_MISS_TTL = 24 * 3600
+
+CASE_INSENSITIVE_STRATEGY = "EXACT_CASE_INSENSITIVE_MATCH"
+EXACT_STRATEGIES = ["EXACT_MATCH", CASE_INSENSITIVE_STRATEGY]
+
+# Ontology resources (in neurosciencegraph/datamodels) whose revision versions the entries of a target
+TARGET_TO_ONTOLOGY = {
+    "BrainRegion": "http://bbp.epfl.ch/neurosciencegraph/ontologies/core/brainregion",
+    "Species": "http://bbp.epfl.ch/neurosciencegraph/ontologies/speciestaxonomy",
+    "Strain": "http://bbp.epfl.ch/neurosciencegraph/ontologies/speciestaxonomy"
+}
+
+# Classes whose subclasses make up the vocabulary of a target
+TARGET_TO_CLASS = {
+    "BrainRegion": "https://neuroshapes.org/BrainRegion",
+    "Species": "https://neuroshapes.org/Species",
+    "Strain": "https://neuroshapes.org/Strain"
+}
+
+VOCABULARY_QUERY = """
+    SELECT ?id ?label ?notation ?prefLabel ?altLabel WHERE {
+        ?id <http://www.w3.org/2000/01/rdf-schema#subClassOf>* <%s> ;
+            <http://www.w3.org/2000/01/rdf-schema#label> ?label .
+        OPTIONAL { ?id <http://www.w3.org/2004/02/skos/core#notation> ?notation }
+        OPTIONAL { ?id <http://www.w3.org/2004/02/skos/core#prefLabel> ?prefLabel }
+        OPTIONAL { ?id <http://www.w3.org/2004/02/skos/core#altLabel> ?altLabel }
+    }
+"""
+
+
+def _resolver_bucket(forge: KnowledgeGraphForge, scope: str, target: Optional[str]) -> str:
+    """
+    Returns the bucket(s) the resolvers of this scope resolve the target from, empty if they can't be found
+    """
+    buckets = set()
+    for resolver in getattr(forge, "_resolvers", {}).get(scope, {}).values():
+        targets = getattr(resolver, "targets", None) or {}
+        if target is None:
+            buckets.update(str(b) for b in targets.values())
+        elif target in targets:
+            buckets.add(str(targets[target]))
+    return ",".join(sorted(buckets))
+
+
+class ResolveCache:
+
+    def __init__(self, path: Optional[str] = None, miss_ttl: float = RESOLVE_MISS_TTL):
+        """
+        :param path: the sqlite file of the cache, defaults to RESOLVE_CACHE_FILENAME in CACHE_DIRECTORY
+        :param miss_ttl: the number of seconds after which an unresolved text is resolved again
+        """
+        self.miss_ttl = miss_ttl
+        if path is None:
+            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+            path = os.path.join(CACHE_DIRECTORY, RESOLVE_CACHE_FILENAME)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            columns = [c[1] for c in self._connection.execute("PRAGMA table_info(resolved)").fetchall()]
+            if len(columns) > 0 and "endpoint" not in columns:
+                logger.info(f"Resolve cache {path} doesn't key entries by endpoint, dropping its entries")
+                self._connection.execute("DROP TABLE resolved")
+                self._connection.execute("DROP TABLE IF EXISTS versions")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS resolved ("
+                "endpoint TEXT, bucket TEXT, target TEXT, scope TEXT, strategy TEXT, text TEXT, value TEXT, "
+                "cached_at REAL, PRIMARY KEY (endpoint, bucket, target, scope, strategy, text))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS versions (endpoint TEXT, target TEXT, version TEXT, "
+                "PRIMARY KEY (endpoint, target))"
+            )
+
+    @staticmethod
+    def _key(forge: KnowledgeGraphForge, text: str, scope: str, target: Optional[str], strategy: str):
+        text = str(text).strip()
+        if strategy == CASE_INSENSITIVE_STRATEGY:
+            text = text.lower()
+        return forge._store.endpoint, _resolver_bucket(forge, scope, target), target or "", scope, strategy, text
+
+    def get_version(self, endpoint: str, target: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version FROM versions WHERE endpoint = ? AND target = ?", (endpoint, target)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_version(self, endpoint: str, target: str, version: str):
+        """
+        Ties the entries of a target of an endpoint to a snapshot version. If the version differs from the one
+        the entries were cached with, they are invalidated
+        """
+        current = self.get_version(endpoint, target)
+        if current == version:
+            return
+        if current is not None:
+            logger.info(
+                f"Resolve cache: {target} of {endpoint} changed from version {current} to {version}, invalidating"
+            )
+        self.invalidate(target, endpoint)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO versions (endpoint, target, version) VALUES (?, ?, ?)",
+                (endpoint, target, version)
+            )
+
+    def invalidate(self, target: Optional[str] = None, endpoint: Optional[str] = None):
+        """
+        Drops the entries of a target, or all entries if no target is provided,
+        of an endpoint, or of all endpoints if no endpoint is provided
+        """
+        conditions = [(c, v) for c, v in [("target = ?", target), ("endpoint = ?", endpoint)] if v is not None]
+        where = f" WHERE {' AND '.join(c for c, _ in conditions)}" if len(conditions) > 0 else ""
+        values = tuple(v for _, v in conditions)
+        with self._lock, self._connection:
+            self._connection.execute(f"DELETE FROM resolved{where}", values)
+            self._connection.execute(f"DELETE FROM versions{where}", values)
+
+    def _get(self, key) -> Optional[Tuple]:
+        """
+        Returns the cached value of a key, unless it is an unresolved text cached more than miss_ttl seconds ago
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, cached_at FROM resolved WHERE endpoint = ? AND bucket = ? AND target = ? "
+                "AND scope = ? AND strategy = ? AND text = ?", key
+            ).fetchone()
+        if row is not None and row[0] is None and time.time() - row[1] > self.miss_ttl:
+            return None
+        return row
+
+    def _put_many(self, rows: List[Tuple]):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO resolved (endpoint, bucket, target, scope, strategy, text, value, cached_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(*key, value, now) for key, value in rows]
+            )
+
+    def _delete_many(self, keys: List[Tuple]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM resolved WHERE endpoint = ? AND bucket = ? AND target = ? AND scope = ? AND strategy = ? "
+                "AND text = ?",
+                keys
+            )
+
+    def resolve(
+            self, forge: KnowledgeGraphForge, text: str, scope: str = "ontology",
+            target: Optional[str] = None, strategy: str = "EXACT_MATCH"
+    ) -> Optional[Resource]:
+        """
+        Same as forge.resolve, but only calls forge when the text has never been resolved
+        for this endpoint, resolver bucket, target, scope and strategy.
+        Unresolved texts are cached too, for miss_ttl seconds.
+        """
+        key = self._key(forge, text, scope, target, strategy)
+        row = self._get(key)
+
+        if row is None:
+            resolved = forge.resolve(text=text, scope=scope, target=target, strategy=strategy)
+            value = json.dumps(forge.as_json(resolved)) if resolved is not None else None
+            self._put_many([(key, value)])
+            return resolved
+
+        return forge.from_json(json.loads(row[0])) if row[0] is not None else None
+
+    def warm_up(
+            self, forge_datamodels: KnowledgeGraphForge, target: str,
+            scope: str = "ontology", limit: int = 100000
+    ) -> int:
+        """
+        Bulk-loads the vocabulary of a target (all subclasses of its class), so that any exact match
+        on a label, notation, preferred or alternative label is answered from the cache.
+        The target's version is set to the revision of its ontology.
+        A text shared by several terms (for a strategy) isn't loaded, resolving it goes through forge,
+        instead of being answered with an arbitrary one of the terms.
+
+        :param forge_datamodels: a forge instance tied to neurosciencegraph/datamodels
+        :return: the number of terms loaded
+        """
+        ontology_id = TARGET_TO_ONTOLOGY.get(target, None)
+        if ontology_id is not None:
+            ontology = forge_datamodels.retrieve(ontology_id, cross_bucket=True)
+            if ontology is not None:
+                self.set_version(forge_datamodels._store.endpoint, target, str(ontology._store_metadata._rev))
+
+        results = forge_datamodels.as_json(
+            forge_datamodels.sparql(VOCABULARY_QUERY % TARGET_TO_CLASS[target], limit=limit)
+        )
+
+        terms: Dict[str, Dict] = {}
+        texts: Dict[str, List[str]] = {}
+        for el in results:
+            id_ = el["id"]
+            if id_ not in terms:
+                terms[id_] = {"id": id_, "type": "Class", "label": el["label"]}
+                texts[id_] = [el["label"]]
+            if el.get("notation", None):
+                terms[id_]["notation"] = el["notation"]
+            texts[id_].extend(el[k] for k in ["notation", "prefLabel", "altLabel"] if el.get(k, None))
+
+        values_by_key: Dict[Tuple, Set[str]] = {}
+        for id_, term in terms.items():
+            value = json.dumps(term)
+            for text in set(texts[id_]):
+                for strategy in EXACT_STRATEGIES:
+                    values_by_key.setdefault(self._key(forge_datamodels, text, scope, target, strategy), set()).add(value)
+
+        rows = [(key, next(iter(values))) for key, values in values_by_key.items() if len(values) == 1]
+        ambiguous = [key for key, values in values_by_key.items() if len(values) > 1]
+
+        self._put_many(rows)
+        # Entries that an earlier warm up may have set to one of the terms
+        self._delete_many(ambiguous)
+        logger.info(
+            f"Resolve cache: loaded {len(terms)} terms of {target}, "
+            f"{len(ambiguous)} texts shared by several terms are left to forge"
+        )
+        return len(terms)
+
+
+_resolve_cache: Optional[ResolveCache] = None
+
+
+def get_resolve_cache() -> ResolveCache:
+    """
+    Returns the resolve cache of this process, located in CACHE_DIRECTORY
+    """
+    global _resolve_cache
+    if _resolve_cache is None:
+        _resolve_cache = ResolveCache()
+    return _resolve_cache
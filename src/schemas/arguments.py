@@ -14,8 +14,10 @@ def define_schemas_arguments(parser: argparse.ArgumentParser):
     parser = define_arguments(parser)
 
     parser.add_argument(
-        "--forge_validation", help="Whether to use forge.validate, or delta trial validation",
-        type=str, choices=["yes", "no", "both"], default="yes"
+        "--forge_validation",
+        help="Whether to use forge.validate (yes), delta trial validation (no), both, "
+             "or local validation against cached schemas (local)",
+        type=str, choices=["yes", "no", "both", "local"], default="yes"
     )
 
     parser.add_argument(
@@ -28,4 +30,9 @@ def define_schemas_arguments(parser: argparse.ArgumentParser):
         type=str, default="./bmo_changed_schemas.json"
     )
 
+    parser.add_argument(
+        "--n_workers", help="Number of resources validated concurrently",
+        type=int, default=8
+    )
+
     return parser
@@ -0,0 +1,59 @@
+"""
+Compares the time taken to turn Elastic Search hits into Resources, with the per-resource context resolution
+of kgforge's _from_jsonld_one, with the shared resolved context, and as plain dictionaries.
+"""
+import argparse
+import json
+import time
+
+from src.arguments import define_arguments
+from src.helpers import DEFAULT_ES_VIEW, allocate_by_deployment, authenticate_from_parser_arguments, init_run
+from src.logger import logger
+from src.schemas.query_data import iter_delta_es_hits, _hit_to_resource, _hit_to_json
+
+
+if __name__ == "__main__":
+    parser = define_arguments(argparse.ArgumentParser())
+
+    parser.add_argument(
+        "--type", help="The type of the resources to convert", type=str,
+        default="https://neuroshapes.org/ReconstructedNeuronMorphology"
+    )
+
+    received_args, leftovers = parser.parse_known_args()
+    org, project = received_args.bucket.split("/")
+
+    init_run(received_args)
+    deployment, auth_token = authenticate_from_parser_arguments(received_args)
+    forge = allocate_by_deployment(org, project, deployment=deployment, token=auth_token)
+
+    es_query = {"query": {"bool": {"must": [
+        {"term": {"@type": received_args.type}},
+        {"term": {"_deprecated": False}}
+    ]}}}
+
+    start = time.perf_counter()
+    hits = list(iter_delta_es_hits(forge, es_query, DEFAULT_ES_VIEW, limit=received_args.limit))
+    logger.info(f"Fetched {len(hits)} hits in {time.perf_counter() - start:.2f}s")
+
+    data_context = forge.get_model_context()
+    timings, converted = {}, {}
+
+    for label, convert in [
+        ("from_jsonld_one", lambda hit: _hit_to_resource(data_context, hit, fast=False)),
+        ("shared_context", lambda hit: _hit_to_resource(data_context, hit, fast=True)),
+        ("dict", _hit_to_json)
+    ]:
+        start = time.perf_counter()
+        converted[label] = [convert(hit) for hit in hits]
+        timings[label] = time.perf_counter() - start
+        logger.info(f"{label}: {timings[label]:.2f}s")
+
+    mismatches = [
+        hit["_id"] for hit, slow, fast in zip(hits, converted["from_jsonld_one"], converted["shared_context"])
+        if json.dumps(forge.as_json(slow), sort_keys=True) != json.dumps(forge.as_json(fast), sort_keys=True)
+    ]
+    if mismatches:
+        logger.warning(f"{len(mismatches)} resources differ between conversions, e.g. {mismatches[:5]}")
+    else:
+        logger.info("Conversions with and without the shared context give the same resources")
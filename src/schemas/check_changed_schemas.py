@@ -4,12 +4,14 @@ Given a filepath where the list of updated schemas, check if resources constrain
 import os
 import json
 import argparse
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 from kgforge.core import KnowledgeGraphForge
-from src.helpers import allocate_by_deployment, Deployment, authenticate_from_parser_arguments
+from src.helpers import allocate_by_deployment, Deployment, authenticate_from_parser_arguments, init_run
 from src.schemas.arguments import define_schemas_arguments
-from src.schemas.schema_validation import _check_schema
+from src.schemas.query_data import get_resources_by_ids_es
+from src.schemas.schema_validation import check_schema
+from src.schemas.validation_store import ValidationResultStore, get_schema_revisions
 
 
 CONSTRAINED_QUERY = """
@@ -29,20 +31,25 @@ def check_changed_schemas_in_project(
     schema_to_type_mapping: Dict,
     deployment: Deployment,
     use_forge: bool = True,
-    limit: int = 20000
+    limit: int = 20000,
+    result_store: Optional[ValidationResultStore] = None
 ) -> Dict:
 
     results = {}
+    schema_revisions = get_schema_revisions(forge, schema_list) if result_store is not None else None
+
     for schema_id in schema_list:
         print(f"Querying for resources constrained by {schema_id}")
-        rows = []
-        failed = []
         query = CONSTRAINED_QUERY.format(schema_id)
         resources = forge.sparql(query, limit=limit)
 
         print(f"Found {len(resources)} resources constrained by {schema_id}")
-        for ires in resources:
-            resource = forge.retrieve(ires.id)
+        ids = [ires.id for ires in resources]
+        retrieved = []
+        for id_, resource in zip(ids, get_resources_by_ids_es(forge, ids)):
+
+            if not resource:  # Not indexed (yet), retrieve it directly
+                resource = forge.retrieve(id_)
 
             if not resource:
                 bucket = forge._store.bucket
@@ -50,16 +57,17 @@ def check_changed_schemas_in_project(
 
                 forge = allocate_by_deployment(org, proj, token=forge._store.token, deployment=deployment)
 
-                resource = forge.retrieve(ires.id)
+                resource = forge.retrieve(id_)
 
             if resource:
-                row = {
-                    "id": resource.get_identifier(),
-                    "name": resource.name if hasattr(resource, 'name') else None,
-                }
-                type_ = schema_to_type_mapping[schema_id]
-                row, failed = _check_schema(forge, resource, schema_id, type_, row, failed, use_forge)
-                rows.append(row)
+                if not hasattr(resource, 'name'):
+                    resource.name = None
+                retrieved.append(resource)
+
+        _, failed = check_schema(
+            retrieved, forge, schema_to_type_mapping_value=schema_to_type_mapping, use_forge=use_forge,
+            result_store=result_store, schema_revisions=schema_revisions
+        )
 
         results[schema_id] = {'failed': failed}
 
@@ -72,6 +80,7 @@ if __name__ == "__main__":
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     org, project = received_args.bucket.split("/")
@@ -91,7 +100,8 @@ if __name__ == "__main__":
     mapping_source = forge_atlas.retrieve("https://bbp.epfl.ch/nexus/v1/resources/neurosciencegraph/datamodels/_/schema_to_type_mapping", cross_bucket=True)
     schema_to_type_mapping = forge_atlas.as_json(mapping_source.value)
 
-    results = check_changed_schemas_in_project(forge_bucket, schema_list, schema_to_type_mapping, use_forge=forge_validation, deployment=deployment)
+    results = check_changed_schemas_in_project(forge_bucket, schema_list, schema_to_type_mapping, use_forge=forge_validation, deployment=deployment,
+                                               result_store=ValidationResultStore())
     
     if results:
         with open(os.path.join(output_directory, f"schema_validation_{org}_{project}.json"), "w") as f:
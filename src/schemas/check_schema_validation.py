@@ -3,15 +3,17 @@ import os
 import json
 import argparse
 import pandas as pd
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional
 
 from kgforge.core import KnowledgeGraphForge, Resource
-from src.helpers import allocate_by_deployment, authenticate_from_parser_arguments
+from src.helpers import allocate_by_deployment, authenticate_from_parser_arguments, init_run
 from src.logger import logger
 from src.schemas.arguments import define_schemas_arguments
 from src.schemas.query_data import get_resources_by_type_es, get_resources_by_type_search
 from src.schemas.getters import TypeGetter
 from src.schemas.schema_validation import check_schema
+from src.schemas.local_validation import LocalShaclValidator, DeltaSchemaSource
+from src.schemas.validation_store import ValidationResultStore, get_schema_revisions
 
 
 def run_validation(
@@ -19,16 +21,23 @@ def run_validation(
     forge: KnowledgeGraphForge,
     schema_to_type_mapping: dict,
     working_directory: str,
-    use_forge: bool
+    use_forge: bool,
+    n_workers: int = 8,
+    result_store: Optional[ValidationResultStore] = None,
+    schema_revisions: Optional[Dict[str, int]] = None,
+    token_provider: Optional[Callable[[], str]] = None,
+    local_validator: Optional[LocalShaclValidator] = None
 ):
 
     rows, failed = check_schema(
         resources, forge, schema_to_type_mapping_value=schema_to_type_mapping,
-        use_forge=use_forge
+        use_forge=use_forge, n_workers=n_workers,
+        result_store=result_store, schema_revisions=schema_revisions, token_provider=token_provider,
+        local_validator=local_validator
     )
     df = pd.DataFrame(rows)
 
-    validation_type = "forge" if use_forge else "delta"
+    validation_type = "local" if local_validator is not None else ("forge" if use_forge else "delta")
     df.to_csv(os.path.join(working_directory, f"check_schema_{validation_type}.csv"))
     with open(os.path.join(working_directory, f"errors_schema_validation_{validation_type}.json"), "w") as f:
         json.dump(failed, f, indent=4)
@@ -42,12 +51,14 @@ if __name__ == "__main__":
     output_dir = received_args.output_dir
     forge_validation = received_args.forge_validation
     use_elastic = received_args.elastic
+    n_workers = received_args.n_workers
 
     if use_elastic:
         search_method = get_resources_by_type_es
     else:
         search_method = get_resources_by_type_search
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     forge_bucket = allocate_by_deployment(org, project, deployment=deployment, token=auth_token)
@@ -57,6 +68,16 @@ if __name__ == "__main__":
     schema_to_type_mapping = forge_atlas.as_json(mapping_source.value)
     type_getter = TypeGetter(token=auth_token, deployment=deployment).get_types_delta
 
+    result_store = ValidationResultStore()
+    schema_revisions = get_schema_revisions(forge_bucket, list(schema_to_type_mapping.keys()))
+
+    def token_provider():
+        return authenticate_from_parser_arguments(received_args)[1]
+
+    local_validator = LocalShaclValidator(
+        DeltaSchemaSource(endpoint=deployment.value, token=auth_token), schema_revisions=schema_revisions
+    ) if forge_validation == "local" else None
+
     all_types, _ = type_getter(org, project)
 
     errors = []
@@ -100,12 +121,26 @@ if __name__ == "__main__":
 
             logger.info(f"Current type {type_name}")
 
-            if forge_validation == "both":
-                run_validation(resources, forge_bucket, schema_to_type_mapping, working_directory, True)
-                run_validation(resources, forge_bucket, schema_to_type_mapping, working_directory, False)
+            if forge_validation == "local":
+                run_validation(
+                    resources, forge_bucket, schema_to_type_mapping, working_directory, False,
+                    n_workers, result_store, schema_revisions, token_provider, local_validator
+                )
+            elif forge_validation == "both":
+                run_validation(
+                    resources, forge_bucket, schema_to_type_mapping, working_directory, True,
+                    n_workers, result_store, schema_revisions, token_provider
+                )
+                run_validation(
+                    resources, forge_bucket, schema_to_type_mapping, working_directory, False,
+                    n_workers, result_store, schema_revisions, token_provider
+                )
             else:
                 use_forge = True if forge_validation == "yes" else False
-                run_validation(resources, forge_bucket, schema_to_type_mapping, working_directory, use_forge)
+                run_validation(
+                    resources, forge_bucket, schema_to_type_mapping, working_directory, use_forge,
+                    n_workers, result_store, schema_revisions, token_provider
+                )
 
     if errors:
         with open(os.path.join(output_directory, "errors_searching.json"), "w") as f:
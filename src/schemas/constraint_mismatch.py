@@ -6,28 +6,27 @@ Created on Tue Sep  3 15:39:31 2024
 @author: ricardi
 """
 import argparse
-from kgforge.core import KnowledgeGraphForge
+from kgforge.core import KnowledgeGraphForge, Resource
 import json
 import os
 import pandas as pd
-from typing import Optional, List
+from typing import Iterator, Optional, List
 
 from src.arguments import define_arguments
 
-from src.helpers import allocate_by_deployment, authenticate_from_parser_arguments
+from src.forge_extension import iter_sparql_keyset
+from src.helpers import allocate_by_deployment, authenticate_from_parser_arguments, init_run
 
 
-def search(forge: KnowledgeGraphForge, type_: str, start: int = 0, amount: int = 200):
+def search(forge: KnowledgeGraphForge, type_: str, page_size: int = 200) -> Iterator[Resource]:
     bucket = forge._store.bucket
     exp_type = forge._model.context().expand(type_)
-    query = f"""SELECT ?id ?_constrainedBy WHERE {{ Graph ?g {{?id rdf:type <{exp_type}>;
+    where = f"""Graph ?g {{?id rdf:type <{exp_type}>;
         <https://bluebrain.github.io/nexus/vocabulary/constrainedBy> ?_constrainedBy;
         <https://bluebrain.github.io/nexus/vocabulary/deprecated> 'false'^^xsd:boolean;
         <https://bluebrain.github.io/nexus/vocabulary/project> <https://bbp.epfl.ch/nexus/v1/projects/{bucket}>. 
-        }}}}
-      ORDER BY ?id 
-      OFFSET {start} LIMIT {amount}""" 
-    return forge.sparql(query, debug=False)
+        }}"""
+    return iter_sparql_keyset(forge, select="?_constrainedBy", where=where, page_size=page_size)
 
 
 def find_mismatches(
@@ -38,15 +37,9 @@ def find_mismatches(
 
     if issues is None:
         issues = []
-    cnt = 0
-    while True:
-        resources = search(forge, type_, start=cnt*chunk_size, amount=chunk_size)
-        if not resources:
-            break
-        for resource in resources:
-            if resource._constrainedBy != schema_id:
-                issues.append({'id': resource.id, 'type': type_, 'schema': resource._constrainedBy})
-        cnt += 1
+    for resource in search(forge, type_, page_size=chunk_size):
+        if resource._constrainedBy != schema_id:
+            issues.append({'id': resource.id, 'type': type_, 'schema': resource._constrainedBy})
     return issues
 
 
@@ -90,6 +83,7 @@ if __name__ == '__main__':
     output_directory = os.path.join(os.getcwd(), output_dir)
     os.makedirs(output_directory, exist_ok=True)
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     forge_bucket = allocate_by_deployment(org, project, deployment=deployment, token=auth_token)
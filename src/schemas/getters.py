@@ -8,7 +8,7 @@ import xlsxwriter
 
 from typing import Callable, Dict, Set, Tuple, List
 
-from src.helpers import allocate_by_deployment, _delta_get, Deployment
+from src.helpers import allocate_by_deployment, _delta_get, Deployment, warm_up_forge_sessions
 from src.schemas.schema_validation import UNCONSTRAINED_SCHEMA
 
 
@@ -230,6 +230,8 @@ def compare_sparql_and_delta_and_get_sparql(org_project_list, type_getter: TypeG
         write_into_file=False, dir_path=dir_path
     )
 
+    warm_up_forge_sessions(org_project_list, deployment=type_getter.deployment, token=type_getter.token)
+
     types_sparql, types_sparql_flattened = get_org_project_to_types(
         org_project_list=org_project_list, getter=type_getter.get_types_sparql,
         write_into_file=False, dir_path=dir_path
@@ -4,7 +4,7 @@ import argparse
 import pandas as pd
 
 from kgforge.core import KnowledgeGraphForge
-from src.helpers import authenticate_from_parser_arguments
+from src.helpers import authenticate_from_parser_arguments, init_run
 from src.logger import logger
 from src.arguments import define_arguments
 from src.schemas.getters import TypeGetter
@@ -18,6 +18,7 @@ if __name__ == "__main__":
     org, project = received_args.bucket.split("/")
     output_dir = received_args.output_dir
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     working_directory = os.path.join(os.getcwd(), output_dir)
@@ -0,0 +1,253 @@
+"""
+Offline SHACL validation of resources against Nexus schemas.
+
+The shapes of a schema and of all the schemas it imports (its import closure) are fetched once, merged into a single
+shapes graph and persisted in CACHE_DIRECTORY. Resources are then validated in-process with pyshacl,
+in batches of resources that share no node.
+
+Schemas are obtained from a schema source: DeltaSchemaSource fetches them from Delta,
+DirectorySchemaSource reads them from local files (turtle, n-triples or expanded json-ld), which allows validating
+without network access.
+
+`python -m src.schemas.local_validation` checks the validator against the fixtures of LOCAL_VALIDATION_FIXTURES.
+"""
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import quote_plus
+
+from kgforge.core import KnowledgeGraphForge, Resource
+from pyshacl import validate as shacl_validate
+from rdflib import BNode, Graph, URIRef
+from rdflib.namespace import OWL, RDF, SH
+
+from src.delta_client import get_delta_client
+from src.helpers import CACHE_DIRECTORY, _make_header, get_path
+from src.logger import logger
+from src.metrics import VALIDATE, get_run_metrics
+
+NXV_SCHEMA = URIRef("https://bluebrain.github.io/nexus/vocabulary/Schema")
+SHACL_CACHE_DIRNAME = "shacl"
+LOCAL_VALIDATION_FIXTURES = get_path("./data/test_data/local_validation")
+SCHEMA_FILE_FORMATS = {".ttl": "turtle", ".nt": "nt", ".jsonld": "json-ld", ".json": "json-ld"}
+
+
+class DeltaSchemaSource:
+
+    def __init__(self, endpoint: str, token: str, bucket: str = "neurosciencegraph/datamodels"):
+        self.endpoint = endpoint
+        self.token = token
+        self.bucket = bucket
+
+    def get(self, schema_id: str) -> Graph:
+        url = f"{self.endpoint}/schemas/{self.bucket}/{quote_plus(schema_id)}"
+        response = get_delta_client().get(url, headers={**_make_header(self.token), "Accept": "application/n-triples"})
+        response.raise_for_status()
+        return Graph().parse(data=response.text, format="nt")
+
+
+class DirectorySchemaSource:
+
+    def __init__(self, directory: str):
+        """
+        Loads every schema file of the directory. A schema is identified as a subject of type nxv:Schema,
+        or as a subject importing other schemas
+        """
+        self.graphs: Dict[str, Graph] = {}
+
+        for path in sorted(glob.glob(os.path.join(directory, "*"))):
+            file_format = SCHEMA_FILE_FORMATS.get(os.path.splitext(path)[1], None)
+            if file_format is None:
+                continue
+            graph = Graph().parse(path, format=file_format)
+            schema_ids = set(graph.subjects(RDF.type, NXV_SCHEMA)) | set(graph.subjects(OWL.imports, None))
+            for schema_id in schema_ids:
+                self.graphs[str(schema_id)] = graph
+
+    def get(self, schema_id: str) -> Graph:
+        if schema_id not in self.graphs:
+            raise KeyError(f"Schema {schema_id} not found in local schemas")
+        return self.graphs[schema_id]
+
+
+class LocalShaclValidator:
+
+    def __init__(self, source, cache_dir: Optional[str] = None, schema_revisions: Optional[Dict[str, int]] = None):
+        """
+        :param source: a DeltaSchemaSource or a DirectorySchemaSource
+        :param cache_dir: where shapes graphs of import closures are persisted,
+        defaults to SHACL_CACHE_DIRNAME in CACHE_DIRECTORY
+        :param schema_revisions: current revision of schemas, a persisted closure
+        built for another revision of its schema is fetched again
+        """
+        self.source = source
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(CACHE_DIRECTORY, SHACL_CACHE_DIRNAME)
+        self.schema_revisions = schema_revisions or {}
+        self._closures: Dict[str, Graph] = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_paths(self, schema_id: str) -> Tuple[str, str]:
+        name = hashlib.sha256(schema_id.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.nt"), os.path.join(self.cache_dir, f"{name}.json")
+
+    def _fetch_closure(self, schema_id: str) -> Graph:
+        closure = Graph()
+        to_visit, visited = [schema_id], set()
+
+        while to_visit:
+            current = to_visit.pop()
+            if current in visited:
+                continue
+            visited.add(current)
+            graph = self.source.get(current)
+            closure += graph
+            to_visit.extend(str(i) for i in graph.objects(URIRef(current), OWL.imports))
+
+        logger.info(f"Fetched the import closure of {schema_id}: {len(visited)} schemas, {len(closure)} triples")
+        return closure
+
+    def closure(self, schema_id: str) -> Graph:
+        """
+        Returns the shapes graph of the schema and all the schemas it imports, transitively
+        """
+        if schema_id in self._closures:
+            return self._closures[schema_id]
+
+        graph_path, info_path = self._cache_paths(schema_id)
+        revision = self.schema_revisions.get(schema_id, None)
+
+        closure = None
+        if os.path.isfile(graph_path) and os.path.isfile(info_path):
+            with open(info_path, "r") as f:
+                info = json.load(f)
+            if revision is None or info.get("revision", None) == revision:
+                closure = Graph().parse(graph_path, format="nt")
+
+        if closure is None:
+            closure = self._fetch_closure(schema_id)
+            tmp_path = f"{graph_path}.{os.getpid()}.tmp"
+            closure.serialize(destination=tmp_path, format="nt", encoding="utf-8")
+            os.replace(tmp_path, graph_path)
+            with open(info_path, "w") as f:
+                json.dump({"schema": schema_id, "revision": revision}, f)
+
+        self._closures[schema_id] = closure
+        return closure
+
+    def validate_many(self, schema_id: str, resource_graphs: List[Graph]) -> List[Tuple[bool, Optional[str]]]:
+        """
+        Validates resources, each provided as its own graph, against a schema.
+        Resources that share no node are validated together in a single pyshacl run, so that a node described by
+        several resources (ex: a brain region with its label) is only ever validated with the description of one resource,
+        and every violation belongs to exactly one resource of its run
+
+        :return: for each resource, whether it conforms and the messages of its violations if it doesn't
+        """
+        shacl_graph = self.closure(schema_id)
+        violations: Dict[int, List[str]] = {}
+
+        with get_run_metrics().stage(VALIDATE):
+            for batch in _disjoint_batches(resource_graphs):
+                data_graph = Graph()
+                owner = {}
+                for i in batch:
+                    data_graph += resource_graphs[i]
+                    for node in _nodes(resource_graphs[i]):
+                        owner[node] = i
+
+                _, results_graph, _ = shacl_validate(
+                    data_graph, shacl_graph=shacl_graph, inference="none", abort_on_first=False
+                )
+
+                for result in results_graph.subjects(RDF.type, SH.ValidationResult):
+                    if results_graph.value(result, SH.resultSeverity) != SH.Violation:
+                        continue
+                    focus_node = results_graph.value(result, SH.focusNode)
+                    path = results_graph.value(result, SH.resultPath)
+                    message = results_graph.value(result, SH.resultMessage)
+                    violations.setdefault(owner.get(focus_node, -1), []).append(
+                        f"{focus_node} {path if path is not None else ''}: {message}"
+                    )
+
+        if -1 in violations:
+            logger.warning(f"{len(violations[-1])} violations couldn't be attributed to a resource")
+
+        return [
+            (i not in violations, "\n".join(violations[i]) if i in violations else None)
+            for i in range(len(resource_graphs))
+        ]
+
+    def validate(self, schema_id: str, resource_graph: Graph) -> Tuple[bool, Optional[str]]:
+        return self.validate_many(schema_id, [resource_graph])[0]
+
+
+def _nodes(graph: Graph) -> Set:
+    """
+    Returns the subjects of a graph and the nodes it points to
+    """
+    return set(graph.subjects()) | set(o for o in graph.objects() if isinstance(o, (URIRef, BNode)))
+
+
+def _disjoint_batches(resource_graphs: List[Graph]) -> List[List[int]]:
+    """
+    Groups the indices of resource graphs so that graphs of a group share no node
+    """
+    batches: List[Tuple[List[int], Set]] = []
+    for i, graph in enumerate(resource_graphs):
+        nodes = _nodes(graph)
+        batch = next((b for b in batches if b[1].isdisjoint(nodes)), None)
+        if batch is None:
+            batches.append(([i], nodes))
+        else:
+            batch[0].append(i)
+            batch[1].update(nodes)
+    return [indices for indices, _ in batches]
+
+
+def resource_graph(resource: Resource, forge: KnowledgeGraphForge) -> Graph:
+    """
+    Returns the graph of a resource, from its expanded json-ld so that no remote context needs to be fetched
+    """
+    return Graph().parse(data=json.dumps(forge.as_jsonld(resource, form="expanded")), format="json-ld")
+
+
+def check_fixtures(fixtures_dir: str = LOCAL_VALIDATION_FIXTURES) -> bool:
+    """
+    Validates the fixture resources against the fixture schemas, without network access, both in a batch and one by one,
+    and compares the outcomes with the expected ones
+
+    :param fixtures_dir: a directory holding schemas/, resources/ (expanded json-ld) and expected.json
+    :return: whether all outcomes are the expected ones
+    """
+    with open(os.path.join(fixtures_dir, "expected.json"), "r") as f:
+        expected = json.load(f)
+
+    names = sorted(expected["conforms"].keys())
+    graphs = [
+        Graph().parse(os.path.join(fixtures_dir, "resources", name), format="json-ld")
+        for name in names
+    ]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        validator = LocalShaclValidator(DirectorySchemaSource(os.path.join(fixtures_dir, "schemas")), cache_dir=cache_dir)
+        batch = validator.validate_many(expected["schema"], graphs)
+        single = [validator.validate(expected["schema"], graph) for graph in graphs]
+
+    ok = True
+    for name, (batch_conforms, message), (single_conforms, _) in zip(names, batch, single):
+        if batch_conforms != expected["conforms"][name] or single_conforms != expected["conforms"][name]:
+            logger.error(
+                f"{name}: expected conforms={expected['conforms'][name]}, got {batch_conforms} in a batch "
+                f"and {single_conforms} alone. {message or ''}"
+            )
+            ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    if not check_fixtures():
+        raise SystemExit(1)
+    logger.info("Local validation fixtures validated as expected")
@@ -1,16 +1,18 @@
 import json
-from typing import List, Dict
+from typing import Iterator, List, Dict, Optional, Tuple, Union
 from urllib.parse import quote_plus
 
 from kgforge.core import KnowledgeGraphForge, Resource
-from kgforge.core.conversions.rdf import _from_jsonld_one
+from kgforge.core.conversions.rdf import _from_jsonld_one, _remove_ld_keys
 from kgforge.core.commons.context import Context
 
 from src.logger import logger
 from src.helpers import (DEFAULT_ES_VIEW,
                          ES_SIZE_LIMIT,
+                         ES_IDS_CHUNK_SIZE,
                          DELTA_METADATA_KEYS,
-                         _post_delta
+                         _post_delta,
+                         iter_es_hits
 )
 
 
@@ -25,31 +27,41 @@ def _forge_elastic(forge, es_query, view, debug=False, limit=2000, offset=0):
 
 
 def _payload_to_resource(data_context: Context, payload: dict,
-                         store_metadata: dict = None, metadata_terms: List[str] = DELTA_METADATA_KEYS):
+                         store_metadata: dict = None, metadata_terms: List[str] = DELTA_METADATA_KEYS,
+                         fast: bool = True):
+    """
+    Turns the payload of a resource, as indexed, into a Resource, with its Delta metadata as store metadata.
+
+    :param fast: whether to convert with the already resolved data_context. Otherwise, as kgforge's
+    _from_jsonld_one does, the context document is copied into the payload and resolved again for every resource,
+    which costs more than the query itself on large result sets. Only kept to benchmark against
+    """
     metadata = {}
     data = {}
     for k, v in payload.items():
         if k in metadata_terms:
             metadata[k] = v
-        else:
+        elif k != "@context" or not fast:
             data[k] = v
     # Complement store metadata
     if store_metadata:
         for k, v in store_metadata.items():
             if k in metadata_terms:
                 metadata[k] = v
-    data['@context'] = data_context.document["@context"]
-    resource = _from_jsonld_one(data)
+    if fast:
+        resource = _remove_ld_keys(data, data_context)
+    else:
+        data['@context'] = data_context.document["@context"]
+        resource = _from_jsonld_one(data)
     resource.context = "https://bbp.neuroshapes.org"
     resource._store_metadata = Resource.from_json(metadata)
     return resource
 
 
-def _delta_es(forge: KnowledgeGraphForge, es_query: dict, view: str, limit: int, offset: int = 0) -> List[Resource]:
+def _delta_es_hits(forge: KnowledgeGraphForge, es_query: dict, view: str, limit: int, offset: int = 0) -> Tuple[List[Dict], Optional[str]]:
     endpoint = forge._store.endpoint
     bucket = forge._store.bucket
     token = forge._store.token
-    data_context = forge.get_model_context()
 
     url = f"{endpoint}/views/{bucket}/{quote_plus(view)}/_search"
     es_query['size'] = limit
@@ -57,24 +69,132 @@ def _delta_es(forge: KnowledgeGraphForge, es_query: dict, view: str, limit: int,
 
     response_json, error = _post_delta(es_query, token, url)
 
-    results = response_json['hits']['hits']
-    
+    return response_json['hits']['hits'], error
+
+
+def _hit_to_json(hit: Dict) -> Dict:
+    resource_json = hit['_source']
+    if '_original_source' in resource_json:
+        return {
+            **json.loads(resource_json['_original_source']),
+            **dict((k, v) for k, v in resource_json.items() if k in DELTA_METADATA_KEYS)
+        }
+    return resource_json
+
+
+def _hit_to_resource(data_context: Context, hit: Dict, fast: bool = True) -> Resource:
+    resource_json = hit['_source']
+    if '_original_source' in resource_json:
+        return _payload_to_resource(data_context,
+                                    json.loads(resource_json['_original_source']),
+                                    store_metadata=resource_json, fast=fast)
+    return _payload_to_resource(data_context, resource_json, fast=fast)
+
+
+def _delta_es(forge: KnowledgeGraphForge, es_query: dict, view: str, limit: int, offset: int = 0) -> List[Resource]:
+    data_context = forge.get_model_context()
+
+    results, error = _delta_es_hits(forge, es_query, view, limit=limit, offset=offset)
+
+    resources = [_hit_to_resource(data_context, r) for r in results]
+    return resources, error
+
+
+def get_resources_by_ids_es(
+        forge: KnowledgeGraphForge, ids: List[str], view: str = DEFAULT_ES_VIEW,
+        as_resource: bool = True, chunk_size: int = ES_IDS_CHUNK_SIZE
+) -> List[Optional[Union[Resource, Dict]]]:
+    """
+    Fetches resources of the project of forge by id, chunk_size ids per Elastic Search request.
+    Equivalent of forge.retrieve on each id, except that only latest revisions can be obtained.
+
+    :param as_resource: whether to return forge Resources, or the source of the resources as dictionaries
+    (with their Delta metadata)
+    :return: the resources, in the order of the ids provided, None for ids that weren't found
+    """
+    distinct_ids = list(dict.fromkeys(ids))
+    data_context = forge.get_model_context() if as_resource else None
+    found = {}
+
+    for i in range(0, len(distinct_ids), chunk_size):
+        chunk = distinct_ids[i: i + chunk_size]
+        es_query = {"query": {"bool": {"filter": [{"terms": {"@id": chunk}}]}}}
+        hits, error = _delta_es_hits(forge, es_query, view, limit=len(chunk))
+
+        if error:
+            logger.error(f"Error fetching resources by id: {error}")
+
+        for hit in hits:
+            id_ = hit['_source']['@id']  # Always expanded in the index
+            if as_resource:
+                resource = _hit_to_resource(data_context, hit)
+                resource._synchronized = True  # As if retrieved, nothing changed since it was fetched
+                found[id_] = resource
+            else:
+                found[id_] = _hit_to_json(hit)
+
+    missing = len([id_ for id_ in distinct_ids if id_ not in found])
+    if missing > 0:
+        logger.warning(f"{missing} of {len(distinct_ids)} ids could not be found in view {view}")
+
+    return [found.get(id_, None) for id_ in ids]
+
+
+def get_resources_by_ids_or_retrieve(
+        forge: KnowledgeGraphForge, ids: List[str], view: str = DEFAULT_ES_VIEW
+) -> List[Resource]:
+    """
+    Same as get_resources_by_ids_es, but ids not found in the view (not indexed yet) are retrieved with forge.
+    Ids that can't be retrieved either are reported and left out
+
+    :return: the resources found, in the order of the ids provided
+    """
     resources = []
-    for r in results:
-        resource_json = r['_source']
-        if '_original_source' in resource_json:
-            resource = _payload_to_resource(data_context,
-                                            json.loads(resource_json['_original_source']),
-                                            store_metadata=resource_json)
+    dropped = []
+    for id_, resource in zip(ids, get_resources_by_ids_es(forge, ids, view=view)):
+        if resource is None:  # Not indexed (yet), retrieve it directly
+            resource = forge.retrieve(id_)
+        if resource is None:
+            dropped.append(id_)
         else:
-            resource = _payload_to_resource(data_context, resource_json)
-        resources.append(resource)
-    return resources, error
+            resources.append(resource)
+
+    if len(dropped) > 0:
+        logger.error(f"{len(dropped)} of {len(ids)} ids could not be retrieved and are left out: {dropped}")
+
+    return resources
+
+
+def iter_delta_es_hits(
+        forge: KnowledgeGraphForge, es_query: dict, view: str = DEFAULT_ES_VIEW,
+        limit: Optional[int] = None, page_size: int = ES_SIZE_LIMIT, point_in_time: bool = True
+) -> Iterator[Dict]:
+    """
+    Streams the hits of an Elastic Search query against a view of the project of forge, with search_after,
+    so that any number of results can be listed while holding a single page in memory
+    """
+    url = f"{forge._store.endpoint}/views/{forge._store.bucket}/{quote_plus(view)}/_search"
+    return iter_es_hits(
+        url, forge._store.token, es_query, page_size=page_size, limit=limit, point_in_time=point_in_time
+    )
+
+
+def iter_resources_es(
+        forge: KnowledgeGraphForge, es_query: dict, view: str = DEFAULT_ES_VIEW,
+        limit: Optional[int] = None, page_size: int = ES_SIZE_LIMIT, as_resource: bool = True
+) -> Iterator[Union[Resource, Dict]]:
+    """
+    :param as_resource: whether to yield forge Resources, or the source of the resources as dictionaries
+    (with their Delta metadata), which requires no conversion at all
+    """
+    data_context = forge.get_model_context() if as_resource else None
+    for hit in iter_delta_es_hits(forge, es_query, view, limit=limit, page_size=page_size):
+        yield _hit_to_resource(data_context, hit) if as_resource else _hit_to_json(hit)
 
 
 def get_resources_by_type_es(forge: KnowledgeGraphForge,
                              type_: str,
-                             limit: int = 10000,
+                             limit: Optional[int] = 10000,
                              view: str = DEFAULT_ES_VIEW) -> List[Resource]:
 
     logger.info(f"Retrieving resources of type {type_} from project")
@@ -97,31 +217,16 @@ def get_resources_by_type_es(forge: KnowledgeGraphForge,
             }
         }
     }
+
+    error = None
     resources = []
-    size = ES_SIZE_LIMIT
-    if limit > size:
-        start = 0
-        count = 0
-        upper = limit - count
-        while count < limit:
-            size = ES_SIZE_LIMIT if ES_SIZE_LIMIT < upper else upper
-            results, error = _delta_es(forge, es_query, view, limit=size, offset=start)
-            # results, error = _forge_elastic(forge, es_query, view, limit=size, offset=start)
-            if results:
-                resources += results
-                count = len(resources)
-                start = count
-                upper = limit - count
-            else:
-                logger.info(f"Failed to get more resources. Submited query:\n {json.dumps(es_query, indent=2)}"
-                            f"This is the start:{start}, count: {count}, and the limit: {limit}")
-                break
-        # loop until limit is reached
-    else:
-        results, error = _delta_es(forge, es_query, view, limit=limit)
-        if results:
-            resources += results
-        
+    try:
+        resources.extend(iter_resources_es(forge, es_query, view, limit=limit))
+    except Exception as exc:
+        error = str(exc)
+        logger.info(f"Failed to get more resources after {len(resources)}: {error}. "
+                    f"Submitted query:\n {json.dumps(es_query, indent=2)}")
+
     logger.info(f"Found {len(resources)} resources")
 
     return resources, error
@@ -1,33 +1,70 @@
 
-from typing import List, Dict, Tuple
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, List, Dict, Tuple, Optional
 
 from kgforge.core import KnowledgeGraphForge, Resource
-from src.helpers import run_trial_request
+from src.helpers import allocate_by_deployment, Deployment
+from src.logger import logger
+from src.schemas.local_validation import LocalShaclValidator, resource_graph
+from src.schemas.trial_client import DeltaTrialClient
+from src.schemas.validation_store import ValidationResultStore
 
 UNCONSTRAINED_SCHEMA = "https://bluebrain.github.io/nexus/schemas/unconstrained.json"
 
 
-def _check_schema(
-    forge: KnowledgeGraphForge,
-    resource: Resource,
-    schema_id: str,
-    type_: str,
-    row: dict,
-    failed: List,
-    use_forge: bool
-) -> Tuple[Dict, list]:
-    if use_forge:
-        return _validate_schema_forge(resource, forge, type_, row, failed)
-    else:
-        return _validate_schema_delta(resource, forge, schema_id, row, failed)
+class ValidationProgress:
+    """
+    Aggregates validation outcomes as they come, logging the counts regularly
+    """
+
+    def __init__(self, total: int, log_every: int = 100):
+        self.total = total
+        self.log_every = log_every
+        self.done = 0
+        self.conforming = 0
+        self.failing = 0
+        self.errors = 0
+
+    def update(self, row: Dict):
+        self.done += 1
+        if "Exception" in row:
+            self.errors += 1
+        elif row.get("Passes Validation", None) is True:
+            self.conforming += 1
+        else:
+            self.failing += 1
+
+        if self.done % self.log_every == 0 or self.done == self.total:
+            logger.info(
+                f"Validated {self.done}/{self.total}: {self.conforming} conforming, "
+                f"{self.failing} failing, {self.errors} errors"
+            )
 
 
 def check_schema(resources: List[Resource], forge: KnowledgeGraphForge, schema_to_type_mapping_value: Dict,
-                 use_forge: bool = True):
+                 use_forge: bool = True, n_workers: int = 8,
+                 result_store: Optional[ValidationResultStore] = None, schema_revisions: Optional[Dict[str, int]] = None,
+                 token_provider: Optional[Callable[[], str]] = None,
+                 local_validator: Optional[LocalShaclValidator] = None):
+    """
+    Validates constrained resources against their schema, grouped by schema and type.
+    Delta trial validations are run with n_workers concurrent requests, forge validations across n_workers processes.
+    token_provider, returning a fresh token, is used if the token expires during Delta trial validations.
+    If a local validator is provided, resources are validated in-process with it instead, in batches.
+
+    If a result store and the current revision of schemas are provided, resources whose revision and schema revision
+    haven't changed since their last validation are not validated again, and resources that conformed at their last
+    validation but don't anymore are flagged as regressions. Results are stored per Delta endpoint of the forge
+    """
+    mode = "local" if local_validator is not None else ("forge" if use_forge else "delta")
+    endpoint = forge._store.endpoint
     rows = []
-    failed = []
+    groups = defaultdict(list)
+    cached = {}
+    store_keys = {}
 
-    for resource in resources:
+    for i, resource in enumerate(resources):
 
         row = {
             "id": resource.get_identifier(),
@@ -40,15 +77,149 @@ def check_schema(resources: List[Resource], forge: KnowledgeGraphForge, schema_t
 
         if has_schema:
             type_ = schema_to_type_mapping_value[schema]
-            row, failed = _check_schema(forge, resource, schema, type_, row, failed, use_forge)
+
+            resource_rev = getattr(resource._store_metadata, "_rev", None)
+            schema_rev = schema_revisions.get(schema, None) if schema_revisions else None
+
+            if result_store is not None and resource_rev is not None and schema_rev is not None:
+                store_keys[i] = (row["id"], resource_rev, schema, schema_rev)
+                result = result_store.get(endpoint, row["id"], resource_rev, schema, schema_rev, mode)
+                if result is not None:
+                    cached[i] = result
+                    rows.append(row)
+                    continue
+
+            groups[(schema, type_)].append(i)
         else:
             row["Passes Validation"] = "-"
 
         rows.append(row)
 
+    progress = ValidationProgress(total=len(cached) + sum(len(idx) for idx in groups.values()))
+    failed_per_index = {}
+
+    def collect(i: int, row_update: Dict, failed_update: List):
+        rows[i].update(row_update)
+        failed_per_index[i] = [{**rows[i], **f} for f in failed_update]
+        progress.update(rows[i])
+
+    def collect_and_store(i: int, row_update: Dict, failed_update: List):
+        if i in store_keys and "Exception" not in row_update:
+            resource_id, resource_rev, schema, schema_rev = store_keys[i]
+            last = result_store.last_result(endpoint, resource_id, schema, mode)
+            if last is not None and last[2] and row_update.get("Passes Validation", None) is not True:
+                logger.warning(
+                    f"Regression: {resource_id} conformed to {schema} at resource revision {last[0]} "
+                    f"and schema revision {last[1]}, it doesn't at {resource_rev} and {schema_rev}"
+                )
+                row_update = {**row_update, "Regression": True}
+                failed_update = [{**f, "Regression": True} for f in failed_update]
+            # Stored with its regression flag, so that a reused result is still reported as a regression
+            result_store.put(endpoint, resource_id, resource_rev, schema, schema_rev, mode, row_update, failed_update)
+        collect(i, row_update, failed_update)
+
+    if len(cached) > 0:
+        logger.info(f"{len(cached)} resources unchanged since their last validation, reusing their result")
+    for i, (row_update, failed_update) in cached.items():
+        collect(i, row_update, failed_update)
+
+    if local_validator is not None:
+        _check_schema_local(resources, forge, groups, local_validator, collect_and_store)
+    elif use_forge:
+        _check_schema_forge_processes(resources, forge, groups, n_workers, collect_and_store)
+    else:
+        _check_schema_delta_async(resources, forge, groups, n_workers, collect_and_store, token_provider)
+
+    failed = [f for i in sorted(failed_per_index.keys()) for f in failed_per_index[i]]
+
     return rows, failed
 
 
+def _check_schema_delta_async(
+        resources: List[Resource], forge: KnowledgeGraphForge, groups: Dict, n_workers: int, collect,
+        token_provider: Optional[Callable[[], str]] = None
+):
+    store = forge._store
+    client = DeltaTrialClient(
+        endpoint=store.endpoint, bucket=store.bucket, token=store.token,
+        max_concurrency=n_workers, token_provider=token_provider
+    )
+
+    indices = [i for (_, _), idx in groups.items() for i in idx]
+    schemas = dict((i, schema) for (schema, _), idx in groups.items() for i in idx)
+    bodies = [{"schema": schemas[i], "resource": forge.as_jsonld(resources[i])} for i in indices]
+
+    def callback(j: int, response_json: Optional[Dict], exc: Optional[Exception]):
+        collect(indices[j], *_delta_trial_outcome(response_json, exc, {}, []))
+
+    client.validate_many(bodies, callback=callback)
+
+
+def _check_schema_local(
+        resources: List[Resource], forge: KnowledgeGraphForge, groups: Dict, local_validator: LocalShaclValidator, collect,
+        chunk_size: int = 100
+):
+    for (schema, _), indices in groups.items():
+        for j in range(0, len(indices), chunk_size):
+            chunk = indices[j: j + chunk_size]
+            try:
+                outcomes = local_validator.validate_many(schema, [resource_graph(resources[i], forge) for i in chunk])
+            except Exception as exc:
+                for i in chunk:
+                    collect(i, {"Exception": str(exc)}, [{"exception": str(exc)}])
+                continue
+
+            for i, (conforms, report) in zip(chunk, outcomes):
+                row_update = {"Passes Validation": conforms}
+                collect(i, row_update, [] if conforms else [{**row_update, "report": report}])
+
+
+_worker_forge = None
+
+
+def _init_forge_worker(endpoint: str, bucket: str, token: str):
+    global _worker_forge
+    org, project = bucket.split("/")
+    _worker_forge = allocate_by_deployment(org, project, deployment=Deployment(endpoint), token=token)
+
+
+def _validate_chunk_forge(type_: str, resources_json: List[Dict]) -> List[Tuple[Dict, list]]:
+    return [
+        _validate_schema_forge(_worker_forge.from_json(resource_json), _worker_forge, type_, {}, [])
+        for resource_json in resources_json
+    ]
+
+
+def _check_schema_forge_processes(
+        resources: List[Resource], forge: KnowledgeGraphForge, groups: Dict, n_workers: int, collect,
+        chunk_size: int = 50
+):
+    if n_workers == 1:
+        for (_, type_), indices in groups.items():
+            for i in indices:
+                collect(i, *_validate_schema_forge(resources[i], forge, type_, {}, []))
+        return
+
+    store = forge._store
+
+    # Chunks of a same type, so that each worker loads the shapes of a type once per chunk at most
+    chunks = [
+        (type_, indices[j: j + chunk_size])
+        for (_, type_), indices in groups.items() for j in range(0, len(indices), chunk_size)
+    ]
+
+    with ProcessPoolExecutor(
+            max_workers=n_workers, initializer=_init_forge_worker, initargs=(store.endpoint, store.bucket, store.token)
+    ) as executor:
+        futures = dict(
+            (executor.submit(_validate_chunk_forge, type_, [forge.as_json(resources[i]) for i in chunk]), chunk)
+            for type_, chunk in chunks
+        )
+        for future in as_completed(futures):
+            for i, result in zip(futures[future], future.result()):
+                collect(i, *result)
+
+
 def _validate_schema_forge(resource: Resource, forge: KnowledgeGraphForge, type_: str, row: Dict, failed: list) -> Tuple[Dict, list]:
     try:
         forge.validate(resource, type_=type_, inference=None)
@@ -65,32 +236,22 @@ def _validate_schema_forge(resource: Resource, forge: KnowledgeGraphForge, type_
     return row, failed
 
 
-def _validate_schema_delta(resource: Resource, forge: KnowledgeGraphForge, schema: str, row: Dict, failed: list):
-
-    query_body = {
-        "schema": schema,
-        "resource": forge.as_jsonld(resource)
-    }
-
-    try:
-        response_json, _ = run_trial_request(
-            body=query_body,
-            endpoint=forge._store.endpoint,
-            bucket=forge._store.bucket,
-            token=forge._store.token
-        )
+def _delta_trial_outcome(response_json: Optional[Dict], exc: Optional[Exception], row: Dict, failed: list):
+    if exc is None:
+        try:
+            if 'result' in response_json:
+                conforms = True
+                report = None
+            elif 'error' in response_json:
+                conforms = False
+                report = response_json['error']['details']['result']
+            else:
+                conforms = "?"
+                report = "?"
+        except Exception as e:
+            exc = e
 
-        if 'result' in response_json:
-            conforms = True
-            report = None
-        elif 'error' in response_json:
-            conforms = False
-            report = response_json['error']['details']['result']
-        else:
-            conforms = "?"
-            report = "?"
-
-    except Exception as exc:
+    if exc is not None:
         failed.append({**row, "exception": str(exc)})
         row["Exception"] = str(exc)
     else:
@@ -0,0 +1,129 @@
+"""
+Asynchronous client of Delta's trial endpoint, validating many resources against their schema
+over a pool of kept-alive connections.
+
+Requests failing with a 429 or a 5xx status, or with a connection error, are retried with an exponential backoff.
+A request failing with a 401 gets the token refreshed through the provided token provider, and is retried.
+"""
+import asyncio
+from typing import Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from src.concurrency import get_concurrency_controller
+from src.helpers import _make_header
+from src.instrumentation import get_request_stats, _call_site, _url_kind
+from src.logger import logger
+from src.metrics import VALIDATE, get_run_metrics
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DeltaTrialClient:
+
+    def __init__(
+            self, endpoint: str, bucket: str, token: str, max_concurrency: int = 16, max_retries: int = 5,
+            backoff: float = 0.5, timeout: float = 300, token_provider: Optional[Callable[[], str]] = None
+    ):
+        """
+        :param max_concurrency: the maximum number of requests in flight, and of open connections. Within it,
+        the number of requests in flight follows the concurrency controller of the process
+        :param backoff: the delay before the first retry, doubled at each following retry
+        :param token_provider: a function returning a fresh token, called when the token has expired
+        """
+        self.url = f"{endpoint}/trial/resources/{bucket}"
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.token_provider = token_provider
+        self._token_lock: Optional[asyncio.Lock] = None
+
+    async def _refresh_token(self, expired_token: str):
+        async with self._token_lock:
+            if self.token != expired_token:  # Already refreshed by another request
+                return
+            logger.info("Token expired, refreshing it")
+            self.token = await asyncio.get_running_loop().run_in_executor(None, self.token_provider)
+
+    def _retry_delay(self, attempt: int, response: Optional[aiohttp.ClientResponse] = None) -> float:
+        retry_after = response.headers.get("Retry-After", None) if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * (2 ** attempt)
+
+    async def _post(self, session: aiohttp.ClientSession, body: Dict) -> Tuple[Dict, Optional[str]]:
+        refreshed = False
+        attempt = 0
+
+        while True:
+            token = self.token
+            try:
+                # Only the exchange itself holds a slot, not the back-off or the token refresh
+                async with get_concurrency_controller().slot_async(_url_kind("POST", self.url)) as outcome:
+                    async with session.post(self.url, json=body, headers=_make_header(token)) as response:
+                        outcome.status = response.status
+                        response_json = await response.json(content_type=None) if response.ok else None
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status == 401 and self.token_provider is not None and not refreshed:
+                await self._refresh_token(token)
+                refreshed = True
+                continue
+
+            if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                await asyncio.sleep(self._retry_delay(attempt, response))
+                attempt += 1
+                continue
+
+            response.raise_for_status()
+            return response_json, None
+
+    async def _validate_many(
+            self, bodies: List[Dict], callback: Optional[Callable[[int, Optional[Dict], Optional[Exception]], None]],
+            call_site: str
+    ) -> List[Tuple[Optional[Dict], Optional[Exception]]]:
+
+        self._token_lock = asyncio.Lock()
+        results: List[Tuple[Optional[Dict], Optional[Exception]]] = [(None, None)] * len(bodies)
+        queue = iter(range(len(bodies)))
+
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            async def worker():
+                for i in queue:  # The iterator is shared, each index is taken by a single worker
+                    try:
+                        with get_request_stats().timed_request("POST", self.url, call_site=call_site):
+                            response_json, _ = await self._post(session, bodies[i])
+                        results[i] = (response_json, None)
+                    except Exception as exc:
+                        results[i] = (None, exc)
+                    if callback is not None:
+                        callback(i, *results[i])
+
+            await asyncio.gather(*(worker() for _ in range(min(self.max_concurrency, len(bodies)))))
+
+        return results
+
+    def validate_many(
+            self, bodies: List[Dict], callback: Optional[Callable[[int, Optional[Dict], Optional[Exception]], None]] = None
+    ) -> List[Tuple[Optional[Dict], Optional[Exception]]]:
+        """
+        Posts each body ({"schema": ..., "resource": ...}) to the trial endpoint.
+
+        :param callback: called with the index of a body, the response json and the exception, as soon as it is done
+        :return: for each body, the response json or the exception that made it fail
+        """
+        if len(bodies) == 0:
+            return []
+        with get_run_metrics().stage(VALIDATE):
+            return asyncio.run(self._validate_many(bodies, callback, _call_site()))
@@ -6,7 +6,7 @@ import pandas as pd
 from typing import List, Dict
 
 from kgforge.core import KnowledgeGraphForge, Resource
-from src.helpers import DEFAULT_ES_VIEW, allocate_by_deployment, authenticate_from_parser_arguments
+from src.helpers import DEFAULT_ES_VIEW, allocate_by_deployment, authenticate_from_parser_arguments, init_run
 from src.logger import logger
 from src.arguments import define_arguments
 from src.schemas.query_data import (
@@ -27,6 +27,7 @@ if __name__ == "__main__":
     org, project = bucket.split("/")
     output_dir = received_args.output_dir
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     forge_bucket = allocate_by_deployment(org, project, deployment=deployment, token=auth_token)
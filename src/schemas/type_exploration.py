@@ -3,7 +3,7 @@ import os
 
 from typing import Tuple, List
 
-from src.helpers import Deployment, authenticate_from_parser_arguments
+from src.helpers import Deployment, authenticate_from_parser_arguments, init_run
 from src.get_projects import _get_obp_projects
 from src.logger import logger
 from src.arguments import define_arguments
@@ -72,6 +72,7 @@ if __name__ == "__main__":
     org, project = received_args.bucket.split("/")
     output_dir = received_args.output_dir
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     working_directory = os.path.join(os.getcwd(), output_dir)
@@ -0,0 +1,115 @@
+"""
+Persistent store of schema validation results, keyed by Delta endpoint, resource revision and schema revision.
+
+A resource needs to be validated again only if it, or the schema it is constrained by, changed since its last
+validation. The last known result of each resource is kept, so that a resource that conformed and doesn't
+anymore is reported as a regression. Validations that raised are not stored, so that they are attempted again.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from kgforge.core import KnowledgeGraphForge, Resource
+
+from src.forge_extension import _retrieve_many
+from src.helpers import CACHE_DIRECTORY
+from src.logger import logger
+
+VALIDATION_STORE_FILENAME = "validation_results.sqlite"
+
+
+def get_schema_revisions(forge: KnowledgeGraphForge, schema_ids: List[str]) -> Dict[str, int]:
+    """
+    Retrieves the current revision of each schema, schemas that can't be retrieved are left out
+    """
+    schema_ids = list(dict.fromkeys(schema_ids))
+    results = _retrieve_many(schema_ids, forge, cross_bucket=True) if len(schema_ids) > 0 else []
+
+    revisions = {}
+    for schema_id, result in zip(schema_ids, results):
+        if isinstance(result, Resource):
+            revisions[schema_id] = result._store_metadata._rev
+        else:
+            logger.warning(f"Could not retrieve the revision of schema {schema_id}")
+    return revisions
+
+
+class ValidationResultStore:
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+            path = os.path.join(CACHE_DIRECTORY, VALIDATION_STORE_FILENAME)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            columns = [c[1] for c in self._connection.execute("PRAGMA table_info(results)").fetchall()]
+            if len(columns) > 0 and "endpoint" not in columns:
+                logger.info(f"Validation store {path} doesn't key results by endpoint, dropping its results")
+                self._connection.execute("DROP TABLE results")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "endpoint TEXT, resource_id TEXT, schema_id TEXT, mode TEXT, resource_rev INTEGER, schema_rev INTEGER, "
+                "conforms INTEGER, result TEXT, validated_at REAL, "
+                "PRIMARY KEY (endpoint, resource_id, schema_id, mode))"
+            )
+
+    def last_result(
+            self, endpoint: str, resource_id: str, schema_id: str, mode: str
+    ) -> Optional[Tuple[int, int, bool, Tuple[Dict, List]]]:
+        """
+        Returns the last known result of a resource of this Delta endpoint against a schema:
+        resource revision, schema revision, whether it conformed, and the (row, failed) pair of the validation
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT resource_rev, schema_rev, conforms, result FROM results "
+                "WHERE endpoint = ? AND resource_id = ? AND schema_id = ? AND mode = ?",
+                (endpoint, resource_id, schema_id, mode)
+            ).fetchone()
+
+        if row is None:
+            return None
+        resource_rev, schema_rev, conforms, result = row
+        row_update, failed_update = json.loads(result)
+        return resource_rev, schema_rev, bool(conforms), (row_update, failed_update)
+
+    def get(
+            self, endpoint: str, resource_id: str, resource_rev: int, schema_id: str, schema_rev: int, mode: str
+    ) -> Optional[Tuple[Dict, List]]:
+        """
+        Returns the (row, failed) pair of the validation of this revision of the resource
+        against this revision of the schema, if it was recorded
+        """
+        last = self.last_result(endpoint, resource_id, schema_id, mode)
+        if last is None or last[0] != resource_rev or last[1] != schema_rev:
+            return None
+        return last[3]
+
+    def put(
+            self, endpoint: str, resource_id: str, resource_rev: int, schema_id: str, schema_rev: int, mode: str,
+            row_update: Dict, failed_update: List
+    ):
+        """
+        Records the (row, failed) pair of a validation, including its regression flag if it has one.
+        Validations that raised are not recorded
+        """
+        if "Exception" in row_update:
+            return
+        conforms = row_update.get("Passes Validation", None) is True
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results "
+                "(endpoint, resource_id, schema_id, mode, resource_rev, schema_rev, conforms, result, validated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    endpoint, resource_id, schema_id, mode, resource_rev, schema_rev, int(conforms),
+                    json.dumps([row_update, failed_update], default=str), time.time()
+                )
+            )
@@ -4,11 +4,11 @@ import json
 from collections import defaultdict
 from typing import List, Optional, Tuple, Dict
 from urllib.parse import quote_plus
-import requests
 
 from src.arguments import define_arguments
+from src.delta_client import get_delta_client
 from src.logger import logger
-from src.helpers import Deployment, DEFAULT_SPARQL_VIEW, authenticate_from_parser_arguments
+from src.helpers import Deployment, DEFAULT_SPARQL_VIEW, authenticate_from_parser_arguments, init_run, iter_es_hits
 from src.get_projects import _get_obp_projects
 
 from enum import Enum
@@ -81,9 +81,9 @@ def _make_es_query(
     # that was applied during the construct query and that led to the data present in the ES view being targeted
     # (so already including the extra logic/filtering of the extra_query)
 
+    # Results are streamed with search_after (see iter_es_hits), only the fields needed for the comparison are fetched
     q = {
-        "size": 10000,
-        "from": 0,
+        "_source": ["@id", "_self"],
         "query": {
             "bool": {
                 "must": [
@@ -126,21 +126,12 @@ def compare(
         return default_header if content_type is None else {**default_header, "Content-Type": content_type}
 
     def _es_view(endpoint_value):
-
-        response_es = requests.post(
-            url=endpoint_value,
-            headers=make_header("application/json"),
-            data=json.dumps(
-                _make_es_query(
-                    brain_regions=brain_regions, type_=type_.value,
-                    curated_flag=is_curated
-                )
-            )
+        return iter_es_hits(
+            endpoint_value, token,
+            _make_es_query(brain_regions=brain_regions, type_=type_.value, curated_flag=is_curated),
+            point_in_time=True
         )
 
-        response_es.raise_for_status()
-        return response_es.json()
-
     def _sp_view(endpoint_value):
         extra_sp_q = TYPE_TO_EXTRA_FILTER[type_]
 
@@ -149,7 +140,7 @@ def compare(
                 extra_q=extra_sp_q, curated_flag=is_curated
             )
 
-        response_sparql = requests.post(
+        response_sparql = get_delta_client().post(
             url=endpoint_value,
             headers=make_header("application/sparql-query"),
             data=el_q
@@ -187,18 +178,20 @@ def compare(
     #     logger.warning(f"Duplicate values found in default sparql index of {org}/{project} {set_sp_default_count} vs {sp_default_count}")
     #     logger.warning(f"Duplicates: {duplicates}")
 
-    composite_response = _es_view(f"{endpoint}/views/{org}/{project}/{composite_view_id}/projections/{projection_id}/_search")
+    es_composite_count = sum(
+        1 for _ in _es_view(f"{endpoint}/views/{org}/{project}/{composite_view_id}/projections/{projection_id}/_search")
+    )
 
     sparql_intermediate_response = _sp_view(f"{endpoint}/views/{org}/{project}/{composite_view_id}/sparql")
 
-    search_idx_response = _es_view(f'{endpoint}/search/query/suite/sbo')
-
-    es_composite_count = composite_response["hits"]["total"]["value"]
-
     sparql_intermediate_count = len({i["id"]['value'] for i in sparql_intermediate_response['results']['bindings']})
 
-    search_idx_filtered_proj = [i for i in search_idx_response["hits"]["hits"] if f"{org}/{project}" in i["_source"]["_self"]]
-    search_idx_count = search_idx_response["hits"]["total"]["value"]
+    search_idx_count = 0
+    search_idx_filtered_proj = []
+    for hit in _es_view(f'{endpoint}/search/query/suite/sbo'):
+        search_idx_count += 1
+        if f"{org}/{project}" in hit["_source"]["_self"]:
+            search_idx_filtered_proj.append(hit["_source"]["@id"])
 
     search_idx_len = len(search_idx_filtered_proj)
 
@@ -212,7 +205,7 @@ def compare(
 
     logger.warning(f"Mismatch in {org}/{project}")
 
-    es_stuff = set(i["_source"]["@id"] for i in search_idx_filtered_proj)
+    es_stuff = set(search_idx_filtered_proj)
 
     logger.warning(
         f"ES set of va {len(es_stuff)} SP {set_sp_default_count} Intersection {len(set_sp_default_ids.intersection(es_stuff))}"
@@ -222,7 +215,7 @@ def compare(
     logger.warning(set_sp_default_ids.difference(es_stuff))
 
     if show_indexing_err_on_mismatch:
-        indexing_failures_search_project = requests.get(
+        indexing_failures_search_project = get_delta_client().get(
             f"{endpoint}/views/{org}/{project}/search/failures",
             headers=make_header()
         )
@@ -231,7 +224,7 @@ def compare(
         logger.warning(f"Number of indexing failures from composite view: {indexing_failures_search_project.json()['_total']}")
 
         url_stats = f"{endpoint}/views/{org}/{project}/{composite_view_id}/projections/{projection_id}/statistics"
-        response_stats = requests.get(url_stats, headers=make_header())
+        response_stats = get_delta_client().get(url_stats, headers=make_header())
         response_stats.raise_for_status()
 
         logger.warning(
@@ -262,6 +255,7 @@ if __name__ == "__main__":
 
     type_v = OBPType[received_args.data_type]
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     compare_for_all_projects(
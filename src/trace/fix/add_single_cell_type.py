@@ -11,14 +11,18 @@ from multiprocessing import Pool
 from typing import Dict, Tuple, Optional, List
 from kgforge.core import Resource, KnowledgeGraphForge
 
-from src.helpers import _as_list, allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import (
+    _as_list, allocate_with_default_views, authenticate_from_parser_arguments, init_run,
+    warm_up_forge_sessions, DEFAULT_ES_VIEW, DEFAULT_SPARQL_VIEW
+)
 
 from src.logger import logger
 
 from src.trace.fix.check_nwb_stimulus_match import _stimulus_type_extraction
+from src.schemas.query_data import get_resources_by_ids_or_retrieve
 from src.trace.query.query import query_traces
 from src.trace.validation.validation import (
-    has_distribution, distribution_extension_from_name, retrieve_wrapper
+    has_distribution, distribution_extension_from_name
 )
 from src.forge_extension import download_file
 from src.trace.arguments import trace_command_line_args
@@ -95,6 +99,7 @@ if __name__ == "__main__":
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     write_directory = received_args.output_dir
@@ -116,6 +121,10 @@ if __name__ == "__main__":
         ("public", "hippocampus"),
     ]
 
+    warm_up_forge_sessions(
+        projects_to_query, deployment, auth_token, es_view=DEFAULT_ES_VIEW, sparql_view=DEFAULT_SPARQL_VIEW
+    )
+
     for org, project in projects_to_query:
 
         forge_instance = allocate_with_default_views(org, project, deployment=deployment, token=auth_token)
@@ -126,7 +135,7 @@ if __name__ == "__main__":
            FILTER NOT EXISTS { ?id a %s } .
         """ % NEW_TYPE)
 
-        traces = Pool().starmap(retrieve_wrapper, [(t_id, forge_instance, 'Retrieve', False) for t_id in trace_ids])
+        traces = get_resources_by_ids_or_retrieve(forge_instance, trace_ids)
 
         traces = [t for t in traces if not t._store_metadata._deprecated]
 
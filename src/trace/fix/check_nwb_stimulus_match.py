@@ -13,16 +13,18 @@ import h5py
 from kgforge.core import Resource, KnowledgeGraphForge
 
 from src.helpers import (
-    _as_list, allocate_with_default_views, authenticate_from_parser_arguments
+    _as_list, allocate_with_default_views, authenticate_from_parser_arguments, init_run,
+    warm_up_forge_sessions, DEFAULT_ES_VIEW, DEFAULT_SPARQL_VIEW
 )
 from src.logger import logger
 from src.forge_extension import download_file
 
 from src.trace.fix.check_image_stimulus_match import check_image_stimulus
 
+from src.schemas.query_data import get_resources_by_ids_or_retrieve
 from src.trace.query.query import query_traces
 from src.trace.validation import (
-    distribution_extension_from_name, has_distribution, retrieve_wrapper
+    distribution_extension_from_name, has_distribution
 )
 from src.trace.arguments import trace_command_line_args
 from src.trace.stimulus_type_ontology_querying import stimulus_type_ontology
@@ -95,6 +97,7 @@ if __name__ == "__main__":
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     projects_to_query = [
@@ -116,13 +119,17 @@ if __name__ == "__main__":
 
     errors = {}
 
+    warm_up_forge_sessions(
+        projects_to_query, deployment, auth_token, es_view=DEFAULT_ES_VIEW, sparql_view=DEFAULT_SPARQL_VIEW
+    )
+
     for org, project in projects_to_query:
 
         forge_instance = allocate_with_default_views(org, project, deployment=deployment, token=auth_token)
 
         trace_ids = query_traces(forge_instance, raise_if_empty=True)
 
-        traces = Pool().starmap(retrieve_wrapper, [(t_id, forge_instance, 'Retrieve', False) for t_id in trace_ids])
+        traces = get_resources_by_ids_or_retrieve(forge_instance, trace_ids)
 
         traces = [t for t in traces if not t._store_metadata._deprecated]
 
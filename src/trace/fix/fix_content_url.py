@@ -4,17 +4,21 @@ Queries for all ExperimentalTrace-s that have a distribution with a content url
 If it is a file id instead of its self, attempts to build a self out of it and to make a GET call from it.
 If it is successful, the value that was built is used to fix the faulty value.
 """
-from multiprocessing import Pool
 from typing import Optional, List, Tuple, Dict, Union, Any
 from kgforge.core import Resource, KnowledgeGraphForge
 
+from src.concurrency import get_concurrency_controller
 from src.logger import logger
 
-from src.helpers import _as_list, allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import (
+    _as_list, allocate_with_default_views, authenticate_from_parser_arguments, init_run,
+    warm_up_forge_sessions, DEFAULT_ES_VIEW, DEFAULT_SPARQL_VIEW
+)
 # from src.get_projects import _get_all_projects
 
 from src.forge_extension import _retrieve_file_metadata
 
+from src.schemas.query_data import get_resources_by_ids_or_retrieve
 from src.trace.query.query import query_traces
 from src.trace.arguments import trace_command_line_args
 
@@ -57,9 +61,10 @@ def make_get_file_endpoint(content_url: Any, resource: Resource, forge: Knowledg
     )
 
 
-def fix_content_url(id_: str, forge: KnowledgeGraphForge) -> None:
+def fix_content_url(resource: Union[str, Resource], forge: KnowledgeGraphForge) -> None:
 
-    resource = forge.retrieve(id_)
+    if isinstance(resource, str):
+        resource = forge.retrieve(resource)
 
     if isinstance(resource.distribution, Resource):
         v = make_get_file_endpoint(resource.distribution.contentUrl, resource, forge)
@@ -81,6 +86,7 @@ if __name__ == "__main__":
     parser = trace_command_line_args()
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     # projects_to_query = _get_all_projects(token, deployment)
@@ -94,6 +100,10 @@ if __name__ == "__main__":
         # ("public", "hippocampus"),
     ]
 
+    warm_up_forge_sessions(
+        projects_to_query, deployment, auth_token, es_view=DEFAULT_ES_VIEW, sparql_view=DEFAULT_SPARQL_VIEW
+    )
+
     for org, project in projects_to_query:
 
         forge_instance = allocate_with_default_views(org, project, deployment=deployment, token=auth_token)
@@ -107,4 +117,6 @@ if __name__ == "__main__":
 
         logger.info(f"Found {len(trace_ids)} ExperimentalTrace in {org}/{project}")
 
-        res = Pool().starmap(fix_content_url, [(t_id, forge_instance) for t_id in trace_ids])
+        traces = get_resources_by_ids_or_retrieve(forge_instance, trace_ids)
+
+        res = get_concurrency_controller().starmap(fix_content_url, [(trace, forge_instance) for trace in traces])
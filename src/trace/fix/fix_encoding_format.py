@@ -9,27 +9,35 @@ If the wrong encoding format in the distribution doesn't match with a file encod
  updates the distribution encoding format.
 
 """
-from multiprocessing import Pool
+from typing import Union
+
 from kgforge.core import Resource, KnowledgeGraphForge
 from contextlib import redirect_stdout
 import io
 
 
+from src.concurrency import get_concurrency_controller
 from src.logger import logger
 
-from src.helpers import _as_list, allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import (
+    _as_list, allocate_with_default_views, authenticate_from_parser_arguments, init_run,
+    warm_up_forge_sessions, DEFAULT_ES_VIEW, DEFAULT_SPARQL_VIEW
+)
 
 from src.forge_extension import _retrieve_file_metadata, _exists
 
+from src.schemas.query_data import get_resources_by_ids_or_retrieve
 from src.trace.query.query import query_traces
 
 from src.trace.arguments import trace_command_line_args
 
 
-def fix_encoding_format(id_: str, forge: KnowledgeGraphForge) -> Resource:
+def fix_encoding_format(resource: Union[str, Resource], forge: KnowledgeGraphForge) -> Resource:
 
     new_encoding_format = "application/nwb"
-    resource = forge.retrieve(id_)
+    if isinstance(resource, str):
+        resource = forge.retrieve(resource)
+    id_ = resource.get_identifier()
 
     dist_list = _as_list(resource.distribution)
     idx = next((idx for idx, d in enumerate(dist_list) if d.name.split(".")[-1] == "nwb"), None)
@@ -76,6 +84,7 @@ if __name__ == "__main__":
     parser = trace_command_line_args(with_really_update=True)
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     projects_to_query = [
@@ -87,6 +96,10 @@ if __name__ == "__main__":
         # ("public", "hippocampus"),
     ]
 
+    warm_up_forge_sessions(
+        projects_to_query, deployment, auth_token, es_view=DEFAULT_ES_VIEW, sparql_view=DEFAULT_SPARQL_VIEW
+    )
+
     for org, project in projects_to_query:
 
         forge_instance = allocate_with_default_views(org, project, deployment=deployment, token=auth_token)
@@ -95,7 +108,9 @@ if __name__ == "__main__":
 
         logger.info(f"Found {len(trace_ids)} ExperimentalTrace in {org}/{project}")
 
-        res = Pool().starmap(fix_encoding_format, [(t_id, forge_instance) for t_id in trace_ids])
+        traces = get_resources_by_ids_or_retrieve(forge_instance, trace_ids)
+
+        res = get_concurrency_controller().starmap(fix_encoding_format, [(trace, forge_instance) for trace in traces])
 
         to_update = [i for i in res if not res._synchronized]
 
@@ -30,7 +30,10 @@ from kgforge.core import Resource, KnowledgeGraphForge
 
 from src.logger import logger
 
-from src.helpers import _as_list, allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import (
+    _as_list, allocate_with_default_views, authenticate_from_parser_arguments, init_run,
+    warm_up_forge_sessions, DEFAULT_ES_VIEW, DEFAULT_SPARQL_VIEW
+)
 
 from src.trace.query.query import query_traces, batch, query_trace_web_data_container
 from src.trace.arguments import trace_command_line_args
@@ -163,6 +166,7 @@ if __name__ == "__main__":
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     really_update = received_args.really_update == "yes"
@@ -178,6 +182,10 @@ if __name__ == "__main__":
         # but also it's got this weird .smr extension
     ]
 
+    warm_up_forge_sessions(
+        projects_to_query, deployment, auth_token, es_view=DEFAULT_ES_VIEW, sparql_view=DEFAULT_SPARQL_VIEW
+    )
+
     for org, project in projects_to_query:
         forge = allocate_with_default_views(org, project, deployment=deployment, token=auth_token)
 
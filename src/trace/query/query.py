@@ -5,6 +5,8 @@ from typing import Optional, List, Union, Dict
 
 from kgforge.core import KnowledgeGraphForge, Resource
 
+from src.forge_extension import iter_sparql_keyset
+from src.listing import iter_records
 from src.logger import logger
 from src.trace.types_and_schemas import EXPERIMENTAL_TRACE_TYPE
 
@@ -25,32 +27,18 @@ def query_traces(
         raise_if_empty: Optional[bool] = False
 ) -> List[Union[str, Dict]]:
 
-    batch_size = 10000 if limit is None else min(limit, 10000)
-    offset = 0
-    last_count = batch_size if limit is None else 0
-
-    trace_ids = []
-
-    while (last_count == batch_size and limit is None) or (limit is not None and last_count < limit):
-        size = min(batch_size, limit - last_count) if limit else batch_size
-
-        q = """
-           SELECT ?id %s WHERE {
+    traces = iter_sparql_keyset(
+        forge,
+        select=other_fields or "",
+        where="""
                ?id a <%s> .
                ?id _deprecated false .
                %s
-           }
-            ORDER BY ASC(?id)
-            LIMIT %s OFFSET %s 
-       """ % (other_fields or '', type_, extra_q or '', size, offset)
+        """ % (type_, extra_q or ""),
+        limit=limit, debug=debug
+    )
 
-        traces = forge.sparql(q, debug=debug)
-
-        ret_val = [t.id for t in traces] if other_fields is None else forge.as_json(traces)
-        trace_ids.extend(ret_val)
-
-        last_count = len(traces)
-        offset = len(trace_ids)
+    trace_ids = [t.id if other_fields is None else forge.as_json(t) for t in traces]
 
     if raise_if_empty and len(trace_ids) == 0:
         org, project = forge._store.bucket.split("/")[-2:]
@@ -59,31 +47,32 @@ def query_traces(
     return trace_ids
 
 
-def query_trace_web_data_container(forge: KnowledgeGraphForge, limit: Optional[int] = None) -> List[Resource]:
-    batch_size = 10000 if limit is None else min(limit, 10000)
-    offset = 0
-    last_count = batch_size if limit is None else 0
-
-    trace_web_data_container_ids = []
+def list_traces(
+        forge: KnowledgeGraphForge,
+        limit: Optional[int] = None,
+        extra_q: Optional[str] = None,
+        type_: Optional[str] = EXPERIMENTAL_TRACE_TYPE,
+        debug: Optional[bool] = False
+) -> List[Dict]:
+    """
+    Same selection as query_traces, returning plain records holding only the id, revision, name, distribution,
+    brain region and species of the traces (see src.listing)
+    """
+    return list(iter_records(forge, f"<{type_}>", extra_q=extra_q, limit=limit, debug=debug))
 
-    while (last_count == batch_size and limit is None) or (limit is not None and last_count < limit):
-        size = min(batch_size, limit - last_count) if limit else batch_size
 
-        q = """
-           SELECT ?id ?isPartOf ?schema WHERE {
+def query_trace_web_data_container(forge: KnowledgeGraphForge, limit: Optional[int] = None) -> List[Resource]:
+    trace_web_data_container_ids = list(iter_sparql_keyset(
+        forge,
+        select="?isPartOf ?schema",
+        where="""
                ?id a TraceWebDataContainer .
                ?id _deprecated false .
                ?id _constrainedBy ?schema . 
                OPTIONAL { ?id isPartOf ?isPartOf }
-           }
-            ORDER BY ASC(?id)
-           LIMIT %s OFFSET %s
-       """ % (size, offset)
-
-        trace_web_data_container = forge.sparql(q)
-        trace_web_data_container_ids.extend(trace_web_data_container)
-        last_count = len(trace_web_data_container)
-        offset = len(trace_web_data_container_ids)
+        """,
+        limit=limit
+    ))
 
     without = [
         el.id for i, el in enumerate(trace_web_data_container_ids)
@@ -10,7 +10,7 @@ import os
 from typing import List
 
 from src.logger import logger
-from src.helpers import _as_list, Deployment, allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import _as_list, Deployment, allocate_with_default_views, authenticate_from_parser_arguments, init_run
 
 from src.trace.query.query import query_traces
 from src.trace.arguments import trace_command_line_args
@@ -61,6 +61,7 @@ if __name__ == "__main__":
 
     curated_str, e_type_str = received_args.curated, received_args.e_type
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     org, proj = received_args.bucket.split("/")
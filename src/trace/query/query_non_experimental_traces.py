@@ -1,7 +1,10 @@
 """
 Queries for all Trace-s in a bucket that are not ExperimentalTrace-s
 """
-from src.helpers import allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import (
+    allocate_with_default_views, authenticate_from_parser_arguments, init_run,
+    warm_up_forge_sessions, DEFAULT_ES_VIEW, DEFAULT_SPARQL_VIEW
+)
 
 from src.logger import logger
 from src.get_projects import _get_all_projects
@@ -16,10 +19,15 @@ if __name__ == "__main__":
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     projects_to_query = _get_all_projects(token=auth_token, deployment=deployment)
 
+    warm_up_forge_sessions(
+        projects_to_query, deployment, auth_token, es_view=DEFAULT_ES_VIEW, sparql_view=DEFAULT_SPARQL_VIEW
+    )
+
     for org, project in projects_to_query:
 
         forge_instance = allocate_with_default_views(org, project, deployment=deployment, token=auth_token)
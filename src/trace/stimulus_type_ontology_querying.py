@@ -9,7 +9,7 @@ from typing import Tuple, Dict
 from urllib.parse import quote_plus
 import requests
 
-from src.helpers import DEFAULT_SPARQL_VIEW, authenticate_from_parser_arguments
+from src.helpers import DEFAULT_SPARQL_VIEW, authenticate_from_parser_arguments, init_run
 from src.trace.arguments import trace_command_line_args
 
 
@@ -53,6 +53,7 @@ if __name__ == "__main__":
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     b = stimulus_type_ontology(deployment_str=deployment.value, token=auth_token)
@@ -16,10 +16,10 @@ from kgforge.core import KnowledgeGraphForge
 from api.utils.trace_img import get_conversion, select_element, select_protocol, select_response, get_unit, get_rate
 from api.models.enums import MetaType
 
-from src.helpers import allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import _as_list, allocate_with_default_views, authenticate_from_parser_arguments, init_run
 from src.logger import logger
 from src.trace.arguments import trace_command_line_args
-from src.trace.query.query import query_traces
+from src.trace.query.query import list_traces
 
 
 def mimic_thumbnail_api_logic(h5_handle: h5py.File) -> np.array:
@@ -67,15 +67,21 @@ def check_all_traces_in_bucket_can_be_thumbnail_ed(forge: KnowledgeGraphForge) -
     token = forge._store.token
 
     extra_q = """
-        ?id distribution ?d .
-        ?d name ?dist_name .
-        ?d contentUrl ?contentUrl .
-        FILTER(contains(?dist_name, '.nwb'))
+        FILTER EXISTS {
+            ?id distribution ?nwb_d .
+            ?nwb_d name ?nwb_name .
+            FILTER(contains(?nwb_name, '.nwb'))
+        }
     """
 
-    other_fields = "?contentUrl"
-
-    res = query_traces(other_fields=other_fields, extra_q=extra_q, forge=forge, raise_if_empty=True)
+    res = [
+        {"id": record["id"], "contentUrl": distribution["contentUrl"]}
+        for record in list_traces(forge, extra_q=extra_q)
+        for distribution in _as_list(record.get("distribution", []))
+        if ".nwb" in distribution.get("name", "")
+    ]
+    if len(res) == 0:
+        raise Exception(f"No traces found in {forge._store.bucket}")
 
     logger.info(f"Found {len(res)} ExperimentalTrace in {org}/{project} with .nwb encoding format")
 
@@ -109,6 +115,7 @@ if __name__ == "__main__":
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     org, project = received_args.bucket.split("/")
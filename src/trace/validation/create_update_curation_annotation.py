@@ -6,15 +6,15 @@ Outputs all failed checks in a .json
 """
 
 import json
-from multiprocessing import Pool
 from typing import Tuple, List
 import os
 
 from kgforge.core import KnowledgeGraphForge, Resource
 
 from src.curation_annotations import CurationStatus, create_update_curated_annotation, bool_to_curation_status
-from src.helpers import allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import allocate_with_default_views, authenticate_from_parser_arguments, init_run
 
+from src.concurrency import get_concurrency_controller
 from src.logger import logger
 
 from src.trace.query.query import query_traces
@@ -72,6 +72,7 @@ if __name__ == "__main__":
 
     org, project = received_args.bucket.split("/")
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     write_directory = received_args.output_dir
@@ -91,13 +92,13 @@ if __name__ == "__main__":
 
     trace_ids = query_traces(forge_instance, raise_if_empty=True)
 
-    traces = Pool().starmap(retrieve_wrapper, [(t_id, forge_instance, 'Retrieve', False) for t_id in trace_ids])
+    traces = get_concurrency_controller().starmap(retrieve_wrapper, [(t_id, forge_instance, 'Retrieve', False) for t_id in trace_ids])
 
     traces = [t for t in traces if not t._store_metadata._deprecated]
 
     logger.info(f"Found {len(trace_ids)} ExperimentalTrace ids and {len(traces)} resources in {org}/{project}")
 
-    res = Pool().starmap(
+    res = get_concurrency_controller().starmap(
         create_update_curated_annotation_on_trace,
         [(trace, forge_instance, forge_neurosciencegraph_datamodels) for trace in traces]
     )
@@ -19,20 +19,24 @@ import io
 
 from src.logger import logger
 
-from src.helpers import _as_list, Deployment, allocate_with_default_views, authenticate_from_parser_arguments
+from src.helpers import _as_list, Deployment, allocate_with_default_views, authenticate_from_parser_arguments, init_run
 
 from src.trace.query.query import query_traces
 from src.forge_extension import _retrieve_file_metadata, _exists
 from src.trace.arguments import trace_command_line_args
+from src.schemas.local_validation import LocalShaclValidator, DeltaSchemaSource, resource_graph
 # from src.trace.thumbnail import data_from_content_url
 # from src.get_projects import get_all_projects
 
 from src.trace.types_and_schemas import (
-    EXPERIMENTAL_TRACE_SCHEMA, EXPERIMENTAL_TRACE_TYPE, TRACE_WEB_DATA_CONTAINER_TYPE
+    EXPERIMENTAL_TRACE_SCHEMA, EXPERIMENTAL_TRACE_TYPE, TRACE_WEB_DATA_CONTAINER_TYPE, DATASET_SCHEMA
 )
 
 stimulus_type_exists_cache = {}
 
+# When set, trace and dataset schema validations run in-process, see here_we_go
+local_validator: Optional[LocalShaclValidator] = None
+
 
 def exists_wrapper(
         id_: Union[str, List[str]], forge: KnowledgeGraphForge, operation_str: str, is_file: bool
@@ -80,7 +84,11 @@ def retrieve_wrapper(
     return res
 
 
-def validate_wrapper(resource: Resource, forge: KnowledgeGraphForge, type_: str) -> bool:
+def validate_wrapper(resource: Resource, forge: KnowledgeGraphForge, type_: str, schema_id: Optional[str] = None) -> bool:
+    if local_validator is not None and schema_id is not None:
+        conforms, _ = local_validator.validate(schema_id, resource_graph(resource, forge))
+        return conforms
+
     f = io.StringIO()
     with redirect_stdout(f):
         forge.validate(resource, type_=type_)
@@ -88,7 +96,7 @@ def validate_wrapper(resource: Resource, forge: KnowledgeGraphForge, type_: str)
 
 
 def complete_minds_metadata(resource: Resource, forge: KnowledgeGraphForge) -> bool:
-    return validate_wrapper(resource, forge, type_="Dataset")
+    return validate_wrapper(resource, forge, type_="Dataset", schema_id=DATASET_SCHEMA)
 
 
 # 21.997    0.440
@@ -321,7 +329,9 @@ def trace_quality_check(
     resource_schema = resource._store_metadata._constrainedBy
     resource_self = resource._store_metadata._self
     trace_has_right_schema = resource_schema == EXPERIMENTAL_TRACE_SCHEMA
-    trace_validates_bool = validate_wrapper(resource=resource, type_=EXPERIMENTAL_TRACE_TYPE, forge=forge)
+    trace_validates_bool = validate_wrapper(
+        resource=resource, type_=EXPERIMENTAL_TRACE_TYPE, forge=forge, schema_id=EXPERIMENTAL_TRACE_SCHEMA
+    )
 
     flags = {
         "Trace Identifier": resource.get_identifier(),
@@ -392,8 +402,16 @@ def stringify(v: Union[str, bool]) -> str:
 
 async def here_we_go(
         output_dir: str, deployment: Deployment, token: str, org: str, project: str, curated: str,
-        excel_file_name="traces", error_filename="error_traces"
+        excel_file_name="traces", error_filename="error_traces", local_validation: bool = False
 ):
+    global local_validator
+
+    if local_validation:
+        local_validator = LocalShaclValidator(DeltaSchemaSource(endpoint=deployment.value, token=token))
+        # Loaded before the pool is created, so that worker processes inherit them
+        for schema_id in [EXPERIMENTAL_TRACE_SCHEMA, DATASET_SCHEMA]:
+            local_validator.closure(schema_id)
+
     forge_datamodels_instance = allocate_with_default_views(
         "neurosciencegraph", "datamodels", deployment=deployment, token=token
     )
@@ -463,9 +481,14 @@ async def here_we_go(
 if __name__ == "__main__":
 
     parser = trace_command_line_args(with_bucket=True, with_curated=True)
+    parser.add_argument(
+        "--local_validation", help="Whether to validate against schemas locally rather than with forge.validate",
+        type=str, choices=["yes", "no"], default="no"
+    )
 
     received_args, leftovers = parser.parse_known_args()
 
+    init_run(received_args)
     deployment, auth_token = authenticate_from_parser_arguments(received_args)
 
     curated = received_args.curated
@@ -477,6 +500,7 @@ if __name__ == "__main__":
     asyncio.run(
         here_we_go(
             output_dir=output_dir, deployment=deployment, token=auth_token,
-            curated=curated, org=org, project=project
+            curated=curated, org=org, project=project,
+            local_validation=received_args.local_validation == "yes"
         )
     )
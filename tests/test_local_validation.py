@@ -0,0 +1,43 @@
+from rdflib import Graph, Literal, URIRef
+from rdflib.namespace import RDFS
+
+from src.schemas.local_validation import _disjoint_batches, check_fixtures
+
+EX = "http://example.org/"
+
+
+def _graph(*triples) -> Graph:
+    graph = Graph()
+    for s, p, o in triples:
+        graph.add((URIRef(EX + s), URIRef(EX + p), URIRef(EX + o) if not isinstance(o, Literal) else o))
+    return graph
+
+
+def test_check_fixtures():
+    assert check_fixtures()
+
+
+def test_disjoint_batches_separates_graphs_sharing_a_node():
+    graphs = [
+        _graph(("a", "brainRegion", "region")),
+        _graph(("b", "brainRegion", "region")),
+        _graph(("c", "brainRegion", "other_region")),
+    ]
+    assert _disjoint_batches(graphs) == [[0, 2], [1]]
+
+
+def test_disjoint_batches_shared_literal_is_not_a_shared_node():
+    graphs = [
+        _graph(("a", "name", Literal("same name"))),
+        _graph(("b", "name", Literal("same name"))),
+    ]
+    assert _disjoint_batches(graphs) == [[0, 1]]
+
+
+def test_disjoint_batches_subject_pointed_to_by_another_graph():
+    region = Graph()
+    region.add((URIRef(EX + "region"), RDFS.label, Literal("Region")))
+    graphs = [_graph(("a", "brainRegion", "region")), region, _graph(("b", "name", Literal("b")))]
+    batches = _disjoint_batches(graphs)
+    assert batches == [[0, 2], [1]]
+    assert sorted(i for batch in batches for i in batch) == [0, 1, 2]